@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of evedir.analytics on an in-memory SQLite database. Skipped without NumPy.
+#
+#   python analytics_test.py
+
+from datetime import date, datetime
+from decimal import Decimal
+from threading import Event
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from evedir.analytics import HAS_NUMPY, Categorical, TransactionColumns, WalletColumnsCache, \
+    daily_rolling, daily_sums, group_sum, item_margins, numpy, rolling_mean
+from evedir.model import DeclarativeBase, WalletSyncState, WalletTransaction
+
+WALLET = ('corp', 1000125, '1000')
+OTHER_WALLET = ('corp', 1000125, '1001')
+
+def _transaction(transactionID, typeID, quantity, price, transactionType='sell', accountKey='1000'):
+    return {'transaction': transactionID, 'corporationID': 1000125, 'character': None,
+            'accountKey': accountKey, 'datetime': datetime(2011, 5, 1, 12, transactionID % 60),
+            'quantity': quantity, 'typeName': u'Type %d' % typeID, 'typeID': typeID, 'price': Decimal(price),
+            'clientID': 90000001, 'clientName': u'Client', 'stationID': 60003760, 'stationName': u'Jita',
+            'transactionType': transactionType, 'transactionFor': 'corporation',
+            'executorID': 90000000, 'executorName': u'Pilot', 'tag': None}
+
+class IOLoop(object):
+    # runs the callbacks added by other threads when told to
+
+    def __init__(self):
+        self.callbacks = []
+        self.added = Event()
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+        self.added.set()
+
+    def run(self):
+        self.added.wait(5)
+        self.added.clear()
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+@unittest.skipIf(not HAS_NUMPY, "needs NumPy")
+class PrimitivesTest(unittest.TestCase):
+
+    def test_categorical(self):
+        values = Categorical([30, 10, 30])
+        self.assertEqual(values.categories.tolist(), [10, 30])
+        self.assertEqual(values.codes.tolist(), [1, 0, 1])
+        # new categories sorted in before known ones recode those
+        values.extend([20, 40, 10])
+        self.assertEqual(values.categories.tolist(), [10, 20, 30, 40])
+        self.assertEqual(values.codes.tolist(), [2, 0, 2, 1, 3, 0])
+        self.assertEqual(values.categories[values.codes].tolist(), [30, 10, 30, 20, 40, 10])
+        values.extend([])
+        self.assertEqual(len(values), 6)
+        empty = Categorical()
+        empty.extend([5, 5])
+        self.assertEqual((empty.categories.tolist(), empty.codes.tolist()), ([5], [0, 0]))
+
+    def test_group_sum(self):
+        codes = numpy.array([2, 0, 2, 2])
+        values = numpy.array([5, 7, 2 ** 60, 1], dtype='int64')
+        self.assertEqual(group_sum(codes, values, 4).tolist(), [7, 0, 2 ** 60 + 6, 0])
+        self.assertEqual(group_sum(codes[:0], values[:0], 2).tolist(), [0, 0])
+
+    def test_daily_sums(self):
+        datetimes = numpy.array(['2011-05-03T10:00:00', '2011-05-01T23:59:59', '2011-05-03T00:00:00'],
+                                dtype='datetime64[s]')
+        days, sums = daily_sums(datetimes, numpy.array([1, 2, 4], dtype='int64'))
+        self.assertEqual([day.item() for day in days], [date(2011, 5, 1), date(2011, 5, 2), date(2011, 5, 3)])
+        self.assertEqual(sums.tolist(), [2, 0, 5])
+        days, sums = daily_sums(datetimes[:0], numpy.zeros(0, dtype='int64'))
+        self.assertEqual((len(days), len(sums)), (0, 0))
+
+    def test_rolling_mean(self):
+        self.assertEqual(rolling_mean(numpy.array([1, 2, 3, 4, 10]), 2).tolist(), [1.0, 1.5, 2.5, 3.5, 7.0])
+        self.assertEqual(rolling_mean(numpy.array([3, 6]), 7).tolist(), [3.0, 4.5])
+
+    def test_daily_rolling(self):
+        class Journal(dict):
+            pass
+        journal = Journal(datetime=numpy.array(['2011-05-01T10:00:00', '2011-05-02T10:00:00'], dtype='datetime64[s]'),
+                          amount=numpy.array([150, -51], dtype='int64'))
+        self.assertEqual(daily_rolling(journal, window=2),
+                         [(date(2011, 5, 1), Decimal('1.5'), Decimal('1.5')),
+                          (date(2011, 5, 2), Decimal('-0.51'), Decimal('0.5'))])
+
+
+@unittest.skipIf(not HAS_NUMPY, "needs NumPy")
+class ColumnsTest(unittest.TestCase):
+
+    def setUp(self):
+        # one database for all threads
+        self.engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+        DeclarativeBase.metadata.create_all(self.engine)
+        self.transactions = WalletTransaction.__table__
+        self.engine.execute(self.transactions.insert(), [
+            _transaction(1, 34, 10, '5.00', 'buy'),
+            _transaction(2, 34, 4, '6.25'),
+            _transaction(3, 36, 1, '100.00', 'buy'),
+            _transaction(4, 34, 100, '1.00', accountKey='1001'),
+        ])
+        self.synced(1000, 3, 'WalletTransactions')
+
+    def synced(self, accountKey, high_water_mark, endpoint):
+        state = WalletSyncState.__table__
+        criteria = (state.c.accountKey == str(accountKey)) & (state.c.endpoint == endpoint)
+        if not self.engine.execute(state.update().where(criteria).values(high_water_mark=high_water_mark)).rowcount:
+            self.engine.execute(state.insert(), corporationID=1000125, character=None, accountKey=str(accountKey),
+                                endpoint=endpoint, high_water_mark=high_water_mark)
+
+    def test_load(self):
+        columns = TransactionColumns()
+        self.assertEqual(columns.load(self.engine, WALLET), 3)
+        self.assertEqual(columns['transactionID'].tolist(), [1, 2, 3])
+        self.assertEqual(columns['price'].tolist(), [500, 625, 10000])
+        self.assertEqual(columns['side'].tolist(), [-1, 1, -1])
+        self.assertEqual(columns.categories('typeID')[columns['typeID']].tolist(), [34, 34, 36])
+        self.assertEqual(columns.labels['typeName'], {34: u'Type 34', 36: u'Type 36'})
+
+    def test_extended_up_to_high_water_mark(self):
+        columns = TransactionColumns()
+        columns.load(self.engine, WALLET)
+        self.engine.execute(self.transactions.insert(), [_transaction(5, 35, 2, '7.00'), _transaction(6, 33, 1, '1')])
+        # rows above the high-water mark may be of a synchronization which has not finished yet
+        self.assertEqual(columns.load(self.engine, WALLET), 0)
+        self.synced(1000, 5, 'WalletTransactions')
+        self.assertEqual(columns.load(self.engine, WALLET), 1)
+        self.assertEqual(columns['transactionID'].tolist(), [1, 2, 3, 5])
+        self.assertEqual(columns.categories('typeID')[columns['typeID']].tolist(), [34, 34, 36, 35])
+        self.synced(1000, 6, 'WalletTransactions')
+        self.assertEqual(columns.load(self.engine, WALLET), 1)
+        # the new category is sorted in before the others, whose codes have changed
+        self.assertEqual(columns.categories('typeID').tolist(), [33, 34, 35, 36])
+        self.assertEqual(columns.categories('typeID')[columns['typeID']].tolist(), [34, 34, 36, 35, 33])
+
+    def test_no_sync_state(self):
+        columns = TransactionColumns()
+        self.assertEqual(columns.load(self.engine, OTHER_WALLET), 0)
+        self.assertEqual(len(columns), 0)
+
+    def test_item_margins(self):
+        columns = TransactionColumns()
+        columns.load(self.engine, WALLET)
+        margins = item_margins(columns)
+        self.assertEqual([(m.typeID, m.bought, m.spent, m.sold, m.earned) for m in margins],
+                         [(34, 10, Decimal('50'), 4, Decimal('25')), (36, 1, Decimal('100'), 0, Decimal('0'))])
+        self.assertEqual(margins[0].margin, 0.25)
+        self.assertEqual(margins[1].margin, None)
+
+    def test_fetch(self):
+        io_loop = IOLoop()
+        cache = WalletColumnsCache(2, io_loop)
+        fetched = []
+        cache.fetch(self.engine, WALLET, fetched.append)
+        # waits for the load in progress
+        cache.fetch(self.engine, WALLET, fetched.append)
+        self.assertEqual(fetched, [])
+        io_loop.run()
+        self.assertEqual(len(fetched), 2)
+        self.assertTrue(fetched[0] is fetched[1])
+        self.assertEqual(len(fetched[0].transactions), 3)
+        self.assertTrue(cache.get(self.engine, WALLET) is fetched[0])
+
+    def test_fetch_invalidated(self):
+        io_loop = IOLoop()
+        cache = WalletColumnsCache(2, io_loop)
+        fetched = []
+        cache.fetch(self.engine, WALLET, fetched.append)
+        cache.invalidate(WALLET)
+        io_loop.run()
+        self.assertEqual(len(fetched[0].transactions), 3)
+        # not kept, as it may be missing what has been changed meanwhile
+        self.assertEqual(cache._wallets, {})
+
+    def test_fetch_failed(self):
+        io_loop = IOLoop()
+        cache = WalletColumnsCache(2, io_loop)
+        fetched = []
+        cache.fetch(create_engine('sqlite://'), WALLET, fetched.append)
+        io_loop.run()
+        self.assertEqual(fetched, [None])
+        self.assertEqual((cache._wallets, cache._loading), ({}, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of evedir.archive, on an in-memory SQLite database and a temporary directory.
+#
+#   python archive_test.py
+
+from datetime import date, datetime
+from decimal import Decimal
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import unittest
+
+from sqlalchemy import create_engine, select
+
+from anzu.options import options
+import evedir.option_definitions
+from evedir import archive
+from evedir.model import DeclarativeBase, WalletArchive, WalletJournalEntry
+
+CORPORATION = (1000125, None, '1000')
+CHARACTER = (None, 90000000, '1000')
+
+def _entry(refID, wallet, when, amount='1.50'):
+    corporationID, character, accountKey = wallet
+    return {'refID': refID, 'corporationID': corporationID, 'character': character, 'accountKey': accountKey,
+            'datetime': when, 'refTypeID': 10, 'ownerName1': u'Pilot \xdc', 'ownerID1': 1,
+            'ownerName2': u'Corp, "Co"', 'ownerID2': 2, 'argName1': None, 'argID1': 0, 'amount': Decimal(amount),
+            'reason': u''}
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        DeclarativeBase.metadata.create_all(self.engine)
+        self.directory = mkdtemp()
+        self.hot_months = options.hot_months
+        options.hot_months = 2
+        self.journal = WalletJournalEntry.__table__
+        self.engine.execute(self.journal.insert(), [
+            _entry(1, CORPORATION, datetime(2011, 2, 1)),
+            _entry(2, CORPORATION, datetime(2011, 2, 1, 23, 59, 59, 500000), '-2.25'),
+            _entry(3, CHARACTER, datetime(2011, 2, 28, 23, 59, 59)),
+            _entry(4, CORPORATION, datetime(2011, 3, 15)),
+            _entry(5, CORPORATION, datetime(2011, 6, 1)),
+        ])
+
+    def tearDown(self):
+        options.hot_months = self.hot_months
+        rmtree(self.directory)
+
+    def archive(self, month):
+        return archive.archive_month('wallet_journal', month, self.engine, self.directory)
+
+    def archived_rows(self, **kw):
+        rows = archive.archived_rows('wallet_journal', bind=self.engine, directory=self.directory, **kw)
+        return [row['refID'] for row in rows]
+
+    def stored(self):
+        return [row[0] for row in self.engine.execute(select([self.journal.c.refID]).order_by(self.journal.c.refID))]
+
+    def test_archivable_months(self):
+        self.assertEqual(archive.hot_since(date(2011, 6, 20)), date(2011, 4, 1))
+        self.assertEqual(archive.archivable_months('wallet_journal', self.engine, today=date(2011, 6, 20)),
+                         [date(2011, 2, 1), date(2011, 3, 1)])
+
+    def test_archive_month(self):
+        self.assertEqual(self.archive(date(2011, 2, 1)), 3)
+        self.assertEqual(self.stored(), [4, 5])
+        record = self.engine.execute(WalletArchive.__table__.select()).first()
+        self.assertEqual((record.table_name, record.month, record.rows), ('wallet_journal', date(2011, 2, 1), 3))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, record.path)))
+        self.assertEqual(archive.archived_until('wallet_journal', self.engine), date(2011, 3, 1))
+        # nothing left to archive of that month
+        self.assertEqual(self.archive(date(2011, 2, 1)), 0)
+
+    def test_archive_again(self):
+        self.archive(date(2011, 2, 1))
+        # rows of the month which have been synchronized late
+        self.engine.execute(self.journal.insert(), [_entry(6, CORPORATION, datetime(2011, 2, 10))])
+        self.assertEqual(self.archive(date(2011, 2, 1)), 1)
+        self.assertEqual(self.archived_rows(), [1, 2, 3, 6])
+        self.assertEqual(self.engine.execute(select([WalletArchive.__table__.c.rows])).scalar(), 4)
+
+    def test_archived_rows(self):
+        self.archive(date(2011, 2, 1))
+        self.archive(date(2011, 3, 1))
+        self.assertEqual(self.archived_rows(), [1, 2, 3, 4])
+        self.assertEqual(self.archived_rows(since=date(2011, 2, 1), until=date(2011, 2, 2)), [1, 2])
+        self.assertEqual(self.archived_rows(since=date(2011, 2, 2), until=date(2011, 3, 1)), [3])
+        self.assertEqual(self.archived_rows(since=date(2011, 2, 1), until=date(2011, 3, 1)), [1, 2, 3])
+        self.assertEqual(self.archived_rows(since=date(2011, 2, 28), until=date(2011, 3, 16)), [3, 4])
+        self.assertEqual(self.archived_rows(since=datetime(2011, 3, 15)), [4])
+        self.assertEqual(self.archived_rows(until=date(2011, 2, 1)), [])
+        self.assertEqual(self.archived_rows(where=dict(zip(('corporationID', 'character', 'accountKey'), CHARACTER))),
+                         [3])
+
+    def test_values(self):
+        original = dict((row.refID, tuple(row)) for row in self.engine.execute(self.journal.select()))
+        self.archive(date(2011, 2, 1))
+        rows = list(archive.archived_rows('wallet_journal', bind=self.engine, directory=self.directory))
+        for row in rows:
+            expected = dict(zip(self.journal.c.keys(), original[row['refID']]))
+            self.assertEqual(row, expected)
+        self.assertEqual(rows[1]['datetime'], datetime(2011, 2, 1, 23, 59, 59, 500000))
+        self.assertEqual(rows[2]['ownerName1'], u'Pilot \xdc')
+        self.assertEqual(rows[0]['argName1'], None)
+        self.assertEqual(rows[0]['reason'], u'')
+
+    def test_restore(self):
+        original = sorted(tuple(row) for row in self.engine.execute(self.journal.select()))
+        self.archive(date(2011, 2, 1))
+        result, wallets = archive.restore('wallet_journal', date(2011, 2, 1), self.engine, self.directory)
+        self.assertEqual(tuple(result), (3, 0))
+        self.assertEqual(wallets, sorted([CORPORATION, CHARACTER]))
+        self.assertEqual(sorted(tuple(row) for row in self.engine.execute(self.journal.select())), original)
+        self.assertEqual(self.engine.execute(WalletArchive.__table__.select()).fetchall(), [])
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'wallet_journal')), [])
+        self.assertRaises(ValueError, archive.restore, 'wallet_journal', date(2011, 2, 1), self.engine,
+                          self.directory)
+
+    def test_unknown_table(self):
+        self.assertRaises(ValueError, archive.archive_month, 'users', date(2011, 2, 1), self.engine, self.directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
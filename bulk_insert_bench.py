@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmark: loads a synthetic wallet journal into a database through the bulk writer,
+# page by page as the synchronization does, then loads the last pages again to measure
+# how fast rows already present are skipped.
+#
+#   python bulk_insert_bench.py [rows] [database-url] [batch-size]
+#
+# rows defaults to 10^5; try up to 10^7. The database defaults to a temporary SQLite file;
+# give e.g. postgresql://localhost/evedir_bench for a PostgreSQL stand-in. Its tables get dropped!
+
+import os
+import sys
+from datetime import datetime
+from decimal import Decimal
+from tempfile import mkstemp
+from time import time
+
+from anzu.options import options
+from sqlalchemy import create_engine
+
+import evedir.option_definitions
+from evedir.bulk import bulk_writer_for
+from evedir.model import DeclarativeBase, Corporation, WalletJournalEntry
+
+PAGE_SIZE = 2560 # rows per API call
+CORPORATION_ID = 1000125
+
+COLUMNS = ['refID', 'accountKey', 'corporationID', 'character', 'datetime', 'refTypeID',
+           'ownerName1', 'ownerID1', 'ownerName2', 'ownerID2', 'argName1', 'argID1',
+           'amount', 'balance', 'reason', 'taxReceiverID', 'taxAmount']
+
+def synthetic_page(first_refID, num_rows):
+    rows = []
+    for refID in xrange(first_refID, first_refID + num_rows):
+        rows.append((
+            refID, '1000', CORPORATION_ID, None,
+            datetime.utcfromtimestamp(1306922400 + refID * 7),
+            2 if refID % 3 else 85,
+            u'Pilot %d' % (refID % 977), 90000000 + refID % 977,
+            u'Corp', CORPORATION_ID,
+            u'%d' % refID, 0,
+            Decimal('1000.50'), Decimal(refID) + Decimal('0.25'),
+            u'DESC: "%d"' % refID if refID % 5 == 0 else None,
+            None, None,
+        ))
+    return rows
+
+def load(writer, num_rows, first_refID=1):
+    inserted = skipped = 0
+    start = time()
+    for offset in xrange(0, num_rows, PAGE_SIZE):
+        result = writer.write(COLUMNS, synthetic_page(first_refID + offset, min(PAGE_SIZE, num_rows - offset)))
+        inserted += result.inserted
+        skipped += result.skipped
+    return time() - start, inserted, skipped
+
+def report(label, elapsed, inserted, skipped):
+    total = inserted + skipped
+    print '%-22s %9d rows in %7.2f s = %9.0f rows/s (%d inserted, %d skipped)' \
+          % (label, total, elapsed, total / elapsed if elapsed else 0, inserted, skipped)
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10**5
+    url = sys.argv[2] if len(sys.argv) > 2 else None
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else options.bulk_batch_size
+
+    temporary_file = None
+    if url is None:
+        fd, temporary_file = mkstemp(suffix='.db')
+        os.close(fd)
+        url = 'sqlite:///' + temporary_file
+    engine = create_engine(url)
+    try:
+        DeclarativeBase.metadata.drop_all(engine)
+        DeclarativeBase.metadata.create_all(engine)
+        engine.execute(Corporation.__table__.insert(), corporationID=CORPORATION_ID, corp_name=u'Bench Corp')
+
+        writer = bulk_writer_for(WalletJournalEntry.__table__, engine, batch_size)
+        print '%s on %s, batches of %d rows' % (type(writer).__name__, engine.dialect.name, batch_size)
+        report('fresh', *load(writer, num_rows))
+        replayed = min(num_rows, max(PAGE_SIZE, num_rows // 10))
+        report('already present', *load(writer, replayed, num_rows - replayed + 1))
+        report('half new', *load(writer, PAGE_SIZE, num_rows - PAGE_SIZE // 2 + 1))
+    finally:
+        engine.dispose()
+        if temporary_file:
+            os.remove(temporary_file)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of evedir.bulk on an in-memory SQLite database.
+#
+#   python bulk_test.py
+
+from datetime import datetime
+from decimal import Decimal
+import unittest
+
+from sqlalchemy import BigInteger, and_, Column, Integer, MetaData, Table, Unicode, create_engine, select
+
+import evedir.option_definitions
+from evedir.bulk import BulkWriteResult, BulkWriter, SQLiteBulkWriter, bulk_writer_for, key_ranges
+from evedir.model import DeclarativeBase, WalletJournalEntry
+
+COLUMNS = ['refID', 'accountKey', 'corporationID', 'character', 'datetime', 'refTypeID',
+           'ownerName1', 'ownerID1', 'ownerName2', 'ownerID2', 'argName1', 'argID1', 'amount']
+
+def _entry(refID, amount='1.25'):
+    return (refID, '1000', 1000125, None, datetime(2011, 5, 1, 12, 0, refID % 60), 10,
+            u'Pilot', 90000000, u'Corp', 1000125, None, 0, Decimal(amount))
+
+class BulkWriterTest(unittest.TestCase):
+    writer = BulkWriter
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        DeclarativeBase.metadata.create_all(self.engine)
+        self.table = WalletJournalEntry.__table__
+
+    def write(self, rows, batch_size=3):
+        return self.writer(self.table, self.engine, batch_size).write(COLUMNS, rows)
+
+    def stored(self):
+        # SQLite keeps amounts as floating point
+        return [(refID, amount.quantize(Decimal('0.01'))) for refID, amount in self.engine.execute(
+            select([self.table.c.refID, self.table.c.amount]).order_by(self.table.c.refID))]
+
+    def test_insert(self):
+        self.assertEqual(self.write([_entry(i) for i in range(10)]), BulkWriteResult(10, 0))
+        self.assertEqual([refID for refID, amount in self.stored()], range(10))
+
+    def test_present(self):
+        self.write([_entry(i) for i in range(5)])
+        # overlapping, unordered and with duplicates within a batch
+        rows = [_entry(i, '2.50') for i in (7, 3, 8, 3, 4, 9, 5, 6, 7)]
+        self.assertEqual(self.write(rows), BulkWriteResult(5, 4))
+        self.assertEqual(self.write(rows), BulkWriteResult(0, 9))
+        stored = dict(self.stored())
+        self.assertEqual(sorted(stored), range(10))
+        # present rows are left alone
+        self.assertEqual(stored[3], Decimal('1.25'))
+        self.assertEqual(stored[7], Decimal('2.50'))
+
+    def test_values(self):
+        self.write([_entry(1, '-835249.77'), _entry(2, '0.01')])
+        self.assertEqual(self.stored(), [(1, Decimal('-835249.77')), (2, Decimal('0.01'))])
+        row = self.engine.execute(self.table.select()).first()
+        self.assertEqual(row.datetime, datetime(2011, 5, 1, 12, 0, 1))
+        self.assertEqual(row.ownerName1, u'Pilot')
+        self.assertEqual(row.argName1, None)
+
+    def test_empty(self):
+        self.assertEqual(self.write([]), BulkWriteResult(0, 0))
+
+    def test_rollback(self):
+        self.write([_entry(0)])
+        invalid = list(_entry(5))
+        invalid[COLUMNS.index('datetime')] = '2011-05-01'
+        # the first batch has been written already when the second one fails
+        self.assertRaises(TypeError, self.write, [_entry(i) for i in range(1, 5)] + [tuple(invalid)])
+        self.assertEqual([refID for refID, amount in self.stored()], [0])
+
+class SQLiteBulkWriterTest(BulkWriterTest):
+    writer = SQLiteBulkWriter
+
+    def test_writer_for(self):
+        self.assertTrue(isinstance(bulk_writer_for(self.table, self.engine), SQLiteBulkWriter))
+
+
+class CompositeKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.table = Table('pairs', MetaData(),
+            Column('a', Integer, primary_key=True, autoincrement=False),
+            Column('b', Integer, primary_key=True, autoincrement=False),
+            Column('name', Unicode(16)),
+        )
+        self.table.create(self.engine)
+
+    def test_write(self):
+        rows = [(1, 1, u'x'), (1, 2, u'y'), (2, 1, u'z'), (1, 1, u'again')]
+        self.assertEqual(BulkWriter(self.table, self.engine, 2).write(['a', 'b', 'name'], rows), BulkWriteResult(3, 1))
+        self.assertEqual(SQLiteBulkWriter(self.table, self.engine, 2).write(['a', 'b', 'name'], rows),
+                         BulkWriteResult(0, 4))
+        self.assertEqual(sorted(tuple(row) for row in self.engine.execute(self.table.select())),
+                         [(1, 1, u'x'), (1, 2, u'y'), (2, 1, u'z')])
+
+
+class KeyRangesTest(unittest.TestCase):
+
+    def test_chunks(self):
+        engine = create_engine('sqlite://')
+        table = Table('numbers', MetaData(), Column('n', BigInteger, primary_key=True, autoincrement=False))
+        table.create(engine)
+        engine.execute(table.insert(), [{'n': n} for n in range(0, 100, 3)])
+        chunks = []
+        for low, criteria in key_ranges(table.c.n, 10, engine):
+            query = select([table.c.n], and_(*criteria))
+            chunks.append((low, [row[0] for row in engine.execute(query)]))
+        self.assertEqual([low for low, numbers in chunks], [0, 30, 60, 90])
+        self.assertEqual([len(numbers) for low, numbers in chunks], [10, 10, 10, 4])
+        self.assertEqual(sum((numbers for low, numbers in chunks), []), range(0, 100, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
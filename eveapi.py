@@ -99,58 +99,430 @@
 import urlparse
 import urllib
 import copy
+import os
+from collections import OrderedDict
 import logging
 import types
 
 try:
 	from anzu.httputil import HTTPHeaders
-	from anzu.httpclient import HTTPRequest, HTTPClient
+	from anzu.httpclient import HTTPRequest, HTTPError, AsyncHTTPClient
 except:
 	from tornado.httputil import HTTPHeaders
-	from tornado.httpclient import HTTPRequest, HTTPClient
+	from tornado.httpclient import HTTPRequest, HTTPError, AsyncHTTPClient
 
 from xml.parsers import expat
-from time import strptime
-from calendar import timegm
-
+from time import sleep, strptime, time
+from calendar import monthrange, timegm
+import httplib
+import socket
+import threading
+import zlib
+
+import redis
 from redis import Redis
 
 proxy = None
 
+# Set this to an object with methods count(name, value=1, **labels) and
+# observe(name, seconds, **labels) to have requests and parsing measured.
+metrics = None
+
 __all__ = [
-	'RedisEVEAPICacheHandler', 'Error', 'EVEAPIConnection',
+	'RedisEVEAPICacheHandler', 'TieredEVEAPICacheHandler', 'Error', 'EVEAPIConnection', 'AsyncEVEAPIConnection',
 ]
 
 #-----------------------------------------------------------------------------
 
+def _count(name, value=1, **labels):
+	if metrics is not None:
+		metrics.count(name, value, **labels)
+
+def _observe(name, seconds, **labels):
+	if metrics is not None:
+		metrics.observe(name, seconds, **labels)
+
+def _cache_key(host, path, params):
+	return ''.join([
+		host, path,
+		'?', urllib.urlencode(params),
+	])
+
+
+_redisPools = {}
+
+def RedisConnectionPool(**kw):
+	# Returns the Redis ConnectionPool for the given connection arguments,
+	# which is shared by all cache handlers (and other users) within this
+	# process. Forked processes get a pool of their own.
+	key = (os.getpid(), tuple(sorted(kw.items())))
+	pool = _redisPools.get(key)
+	if pool is None:
+		pool = _redisPools[key] = redis.ConnectionPool(**kw)
+	return pool
+
+
+_compressedMarker = "\x00z"
+
+# deletes a lock only while it still has the token its holder set
+_releaseScript = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+	return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
 class RedisEVEAPICacheHandler(object):
+	# Caches the XML documents in Redis, for as long as the API server says.
+	#
+	# compressAbove - documents larger than this many bytes are stored
+	#                 zlib-compressed. None disables compression.
+	#
+	# lockTimeout - on a miss, the caller takes a lock on the key for this
+	#               many seconds and fetches the document. Concurrent callers
+	#               of other processes wait for it to be stored instead of
+	#               requesting it, too. None disables this.
+	#
+	# waitTimeout - for how many seconds a caller waits for the document
+	#               before it fetches the document by itself. Use 0 where
+	#               calls must not block, like in the IOLoop.
+	#
+	# connection_pool - defaults to the RedisConnectionPool for the remaining
+	#                   keyword arguments, which are those of Redis().
 
-	def __init__(self, **kw):
-		self.redis = Redis(**kw)
+	def __init__(self, compressAbove=4096, lockTimeout=30, waitTimeout=10, connection_pool=None, **kw):
+		self.redis = Redis(connection_pool=connection_pool or RedisConnectionPool(**kw))
+		self.compressAbove = compressAbove
+		self.lockTimeout = lockTimeout
+		self.waitTimeout = waitTimeout
+		self.hits = self.misses = self.coalesced = 0
+		self._locks = {}
 
 	def _key_for(self, host, path, params):
-		return ''.join([
-			host, path,
-			'?', urllib.urlencode(params),
-		])
+		return _cache_key(host, path, params)
+
+	def _encode(self, doc):
+		if isinstance(doc, unicode):
+			doc = doc.encode("utf-8")
+		if self.compressAbove is not None and len(doc) > self.compressAbove:
+			return _compressedMarker + zlib.compress(doc)
+		return doc
+
+	def _decode(self, doc):
+		if doc.startswith(_compressedMarker):
+			doc = zlib.decompress(doc[len(_compressedMarker):])
+		return doc
+
+	def _counted(self, key, doc):
+		# decodes a document read from Redis, counting it as a hit, or as
+		# a miss if there is none
+		if doc:
+			self.hits += 1
+			doc = self._decode(doc)
+			logging.debug('Cache hit for "%s". XML document size: %d', key, len(doc))
+			return doc
+		self.misses += 1
+		logging.debug('Cache miss for "%s".', key)
+		return None
+
+	def _await_flight(self, key):
+		# Returns None if the caller shall fetch the document, which is the
+		# case if it got the lock or nobody stored the document in time.
+		lock = "lock:" + key
+		token = os.urandom(8).encode("hex")
+		if self.redis.set(lock, token, ex=self.lockTimeout, nx=True):
+			self._locks[key] = token
+			return None
+
+		deadline = time() + self.waitTimeout
+		delay = 0.05
+		while time() < deadline:
+			sleep(delay)
+			delay = min(2 * delay, 1.0)
+			doc = self.redis.get(key)
+			if doc:
+				# counted as coalesced only, neither as a miss nor a hit
+				self.coalesced += 1
+				logging.debug('Request for "%s" has been coalesced with a concurrent one.', key)
+				return self._decode(doc)
+			if not self.redis.exists(lock):
+				# the holder has failed; don't wait for the lock to expire
+				break
+		return None
 
 	def retrieve(self, host, path, params):
 		key = self._key_for(host, path, params)
 		doc = self.redis.get(key)
-		if doc:
-			logging.debug('Cache hit for "%s". XML document size: %d', key, len(doc))
-		else:
-			logging.debug('Cache miss for "%s".', key)
-		return doc
+		if not doc and self.lockTimeout:
+			doc = self._await_flight(key)
+			if doc:
+				return doc
+		return self._counted(key, doc)
+
+	def retrieve_many(self, requests):
+		# Fetches the documents for a list of (host, path, params) in one
+		# round trip, such as to prefetch them. Returns them in the same
+		# order, None for misses; unlike retrieve(), no lock is taken on
+		# misses. Paths are those retrieve() gets, including ".xml.aspx".
+		keys = [self._key_for(host, path, params) for host, path, params in requests]
+		if not keys:
+			return []
+		return [self._counted(key, doc) for key, doc in zip(keys, self.redis.mget(keys))]
 
 	def store(self, host, path, params, doc, obj):
 		key = self._key_for(host, path, params)
 
 		cachedFor = obj.cachedUntil - obj.currentTime
 		logging.debug('Document "%s" with size %d will be cached for %d seconds.', key, len(doc), cachedFor)
-		if cachedFor:
-			self.redis.set(key, doc)
-			self.redis.expire(key, cachedFor)
+		if cachedFor > 0:
+			self.redis.setex(name=key, value=self._encode(doc), time=cachedFor)
+		self.release(host, path, params)
+
+	def release(self, host, path, params):
+		# Gives up the lock retrieve() has taken on a miss, if any. Called
+		# by store(), and by callers which failed to get the document, so
+		# others waiting for it stop doing so and fetch it themselves.
+		key = self._key_for(host, path, params)
+		token = self._locks.pop(key, None)
+		if token:
+			# the lock may have expired and been taken by another caller
+			self.redis.eval(_releaseScript, 1, "lock:" + key, token)
+
+	def stats(self):
+		# Redis evicts on its own; evicted_keys is its count over all keys.
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'coalesced': self.coalesced,
+			'evictions': self.redis.info().get('evicted_keys', 0),
+		}
+
+
+class TieredEVEAPICacheHandler(object):
+	# Keeps the parsed objects of recent calls in an in-process LRU in front
+	# of a second, shared cache handler such as RedisEVEAPICacheHandler. A
+	# hit in the LRU skips parsing the XML document again.
+	#
+	# secondTier - the cache handler consulted on misses and written through
+	#              on store(). Can be None for a process-local cache only.
+	#
+	# maxEntries - how many parsed objects are kept. The least recently used
+	#              ones are evicted first.
+	#
+	# Entries expire at the object's cachedUntil. Objects handed out are shared
+	# by all callers and hence must be treated as read-only.
+
+	def __init__(self, secondTier=None, maxEntries=256):
+		self.secondTier = secondTier
+		self.maxEntries = maxEntries
+		self.hits = self.misses = self.evictions = 0
+		self._entries = OrderedDict()
+
+	def _key_for(self, host, path, params):
+		return _cache_key(host, path, params)
+
+	def _remember(self, key, obj):
+		# Streamed calls store the document's meta data only, which would be
+		# no answer to later calls; their document goes to the second tier.
+		if not getattr(obj, "result", False):
+			return
+		now = time()
+		cachedFor = obj.cachedUntil - obj.currentTime
+		# don't trust the local clock to be in sync with the API server's
+		expires = min(obj.cachedUntil, now + cachedFor)
+		if expires <= now:
+			return
+		self._entries.pop(key, None)
+		self._entries[key] = (expires, obj)
+		while len(self._entries) > self.maxEntries:
+			self._entries.popitem(last=False)
+			self.evictions += 1
+
+	def _lookup(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is not None and entry[0] > time():
+			self._entries[key] = entry
+			self.hits += 1
+			return entry[1]
+		self.misses += 1
+		return None
+
+	def _parsed(self, key, doc):
+		if doc is None or isinstance(doc, Element):
+			return doc
+		obj = _Parser().Parse(doc, hasattr(doc, "read"))
+		self._remember(key, obj)
+		return obj
+
+	def retrieve(self, host, path, params):
+		key = self._key_for(host, path, params)
+		obj = self._lookup(key)
+		if obj is None and self.secondTier is not None:
+			obj = self._parsed(key, self.secondTier.retrieve(host, path, params))
+		return obj
+
+	def retrieve_many(self, requests):
+		# Like RedisEVEAPICacheHandler.retrieve_many, but returns objects. The
+		# second tier is asked only once, for all calls missing in the LRU.
+		keys = [self._key_for(host, path, params) for host, path, params in requests]
+		results = [self._lookup(key) for key in keys]
+		missing = [i for i, obj in enumerate(results) if obj is None]
+		if not missing or self.secondTier is None:
+			return results
+
+		if hasattr(self.secondTier, 'retrieve_many'):
+			docs = self.secondTier.retrieve_many([requests[i] for i in missing])
+		else:
+			docs = [self.secondTier.retrieve(*requests[i]) for i in missing]
+		for i, doc in zip(missing, docs):
+			results[i] = self._parsed(keys[i], doc)
+		return results
+
+	def store(self, host, path, params, doc, obj):
+		self._remember(self._key_for(host, path, params), obj)
+		if self.secondTier is not None:
+			self.secondTier.store(host, path, params, doc, obj)
+
+	def release(self, host, path, params):
+		if hasattr(self.secondTier, 'release'):
+			self.secondTier.release(host, path, params)
+
+	def stats(self):
+		# Returns the counters by tier.
+		tiers = {
+			'memory': {
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+			},
+		}
+		if hasattr(self.secondTier, 'stats'):
+			tiers['second'] = self.secondTier.stats()
+		return tiers
+
+
+#-----------------------------------------------------------------------------
+
+class ConnectionPool(object):
+	# Keeps idle keep-alive connections to one (scheme, host, proxy) around,
+	# so consecutive API calls skip the TCP and TLS handshakes.
+	#
+	# maxSize - how many idle connections will be kept at most. Surplus ones
+	#           are closed when they are released.
+	#
+	# idleTimeout - seconds after which an idle connection is not reused
+	#               anymore, as the server will likely have closed it.
+	#
+	# The counters 'created', 'reused' and 'discarded' tell how many
+	# connections have been opened, taken from the pool, and closed because
+	# they were stale, broken or surplus.
+
+	def __init__(self, scheme, host, proxy=None, maxSize=4, idleTimeout=60, timeout=60):
+		self.scheme = scheme
+		self.host = host
+		self.proxy = proxy
+		self.maxSize = maxSize
+		self.idleTimeout = idleTimeout
+		self.timeout = timeout
+		self.created = self.reused = self.discarded = 0
+		self._idle = []
+		self._lock = threading.Lock()
+
+	def _connect(self):
+		if self.proxy:
+			if self.scheme == "https":
+				conn = httplib.HTTPSConnection(*self.proxy, timeout=self.timeout)
+				conn.set_tunnel(self.host)
+			else:
+				conn = httplib.HTTPConnection(*self.proxy, timeout=self.timeout)
+		elif self.scheme == "https":
+			conn = httplib.HTTPSConnection(self.host, timeout=self.timeout)
+		else:
+			conn = httplib.HTTPConnection(self.host, timeout=self.timeout)
+		self.created += 1
+		return conn
+
+	def acquire(self):
+		# returns (connection, whether it has been reused)
+		with self._lock:
+			now = time()
+			while self._idle:
+				conn, since = self._idle.pop()
+				if now - since < self.idleTimeout:
+					self.reused += 1
+					return conn, True
+				conn.close()
+				self.discarded += 1
+			return self._connect(), False
+
+	def release(self, conn):
+		with self._lock:
+			if len(self._idle) < self.maxSize:
+				self._idle.append((conn, time()))
+				return
+			self.discarded += 1
+		conn.close()
+
+	def close(self):
+		with self._lock:
+			idle, self._idle = self._idle, []
+		for conn, since in idle:
+			conn.close()
+
+	def stats(self):
+		return {
+			'created': self.created,
+			'reused': self.reused,
+			'discarded': self.discarded,
+			'idle': len(self._idle),
+		}
+
+	def fetch(self, method, path, body=None, headers={}):
+		# Sends the request over a pooled connection and returns
+		# (status, HTTPHeaders, body). A reused connection which turns out to
+		# have been closed by the server is replaced once, by a new one: the
+		# others idle for as long have likely been closed as well.
+		if self.proxy and self.scheme != "https":
+			url = "%s://%s%s" % (self.scheme, self.host, path)
+		else:
+			url = path
+
+		conn, reused = self.acquire()
+		while True:
+			try:
+				conn.request(method, url, body, headers)
+				response = conn.getresponse()
+				data = response.read()
+			except (httplib.HTTPException, socket.error):
+				conn.close()
+				with self._lock:
+					self.discarded += 1
+				if not reused:
+					raise
+				with self._lock:
+					conn, reused = self._connect(), False
+				continue
+			break
+
+		if response.will_close:
+			conn.close()
+		else:
+			self.release(conn)
+
+		responseHeaders = HTTPHeaders()
+		for name, value in response.getheaders():
+			responseHeaders.add(name, value)
+		return response.status, responseHeaders, data
+
+
+class _PooledResponse(object):
+	# The attributes of a fetched response which _RootContext._decode uses.
+
+	def __init__(self, code, headers, body):
+		self.code = code
+		self.headers = headers
+		self.body = body
+		self.error = None if code == 200 else httplib.responses.get(code, "Unknown")
 
 
 #-----------------------------------------------------------------------------
@@ -161,7 +533,7 @@ class Error(StandardError):
 		self.args = (message.rstrip("."),)
 
 
-def EVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None):
+def EVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None, poolSize=4, idleTimeout=60):
 	# Creates an API object through which you can call remote functions.
 	#
 	# The following optional arguments may be provided:
@@ -171,6 +543,11 @@ def EVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None):
 	# proxy - (host,port) specifying a proxy server through which to request
 	#         the API pages. Specifying a proxy overrides default proxy.
 	#
+	# poolSize, idleTimeout - connections to the API server are kept alive
+	#         and reused. These limit how many idle connections are kept,
+	#         and for how many seconds. See ConnectionPool. The pools'
+	#         counters are returned by poolstats() of the API object.
+	#
 	# cacheHandler - an object which must support the following interface:
 	#
 	#      retrieve(host, path, params)
@@ -197,16 +574,46 @@ def EVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None):
 	#          this object.
 	#
 
+	ctx = _connect(_RootContext, url, cacheHandler, proxy)
+	ctx._poolSize = poolSize
+	ctx._idleTimeout = idleTimeout
+	return ctx
+
+
+def AsyncEVEAPIConnection(url="api.eveonline.com", cacheHandler=None, proxy=None, io_loop=None):
+	# Same as EVEAPIConnection, except that calls made through the returned
+	# object do not block but are served by the IOLoop.
+	#
+	# Every call takes a keyword argument 'callback', which will be called
+	# as callback(result, error) when the call has completed. On success,
+	# result is what a call through EVEAPIConnection would have returned and
+	# error is None. Else result is None and error the exception which the
+	# blocking call would have raised, such as Error.
+	#
+	# Stream() takes the callback, too, and calls it with the RowStream once
+	# the document has been fetched; only parsing is left to iterating it.
+	#
+	# io_loop - the IOLoop to use, defaults to the global instance.
+	#
+	# Note that cacheHandler is still called synchronously.
+
+	ctx = _connect(_AsyncRootContext, url, cacheHandler, proxy)
+	ctx._io_loop = io_loop
+	return ctx
+
+
+def _connect(rootClass, url, cacheHandler, proxy):
 	if not url.startswith("http"):
 		url = "https://" + url
 	p = urlparse.urlparse(url, "https")
 	if p.path and p.path[-1] == "/":
 		p.path = p.path[:-1]
-	ctx = _RootContext(None, p.path, {}, {})
+	ctx = rootClass(None, p.path, {}, {})
 	ctx._handler = cacheHandler
 	ctx._scheme = p.scheme
 	ctx._host = p.netloc
 	ctx._proxy = proxy or globals()["proxy"]
+	ctx._pools = {}
 	return ctx
 
 
@@ -217,6 +624,25 @@ def ParseXML(file_or_string):
 		raise TypeError("XML data must be provided as string or file-like object")
 
 
+def ParseRows(file_or_string, batchSize=500):
+	# Streaming counterpart of ParseXML(). Returns a RowStream which yields
+	# the rows of the document's rowsets in Rowset batches of at most
+	# batchSize rows, without building the Element tree first.
+	return RowStream(file_or_string, batchSize)
+
+
+def _ErrorIn(body):
+	# Returns the Error a document reports, or None if it is no API error document.
+	try:
+		obj = _Parser().Parse(body, False)
+	except Exception:
+		return None
+	error = getattr(obj, "error", None)
+	if not error:
+		return None
+	return Error(error.code, error.data)
+
+
 def _ParseXML(response, fromContext, storeFunc):
 	# pre/post-process XML or Element data
 
@@ -284,7 +710,7 @@ class _Context(object):
 		# perform arcane attribute majick trick
 		return _Context(self._root, self._path + "/" + this, self.parameters)
 
-	def __call__(self, **kw):
+	def _merged(self, kw):
 		if kw:
 			# specified keywords override contextual ones
 			for k, v in self.parameters.iteritems():
@@ -293,9 +719,17 @@ class _Context(object):
 		else:
 			# no keywords provided, just update with contextual ones.
 			kw.update(self.parameters)
+		return kw
 
+	def __call__(self, **kw):
 		# now let the root context handle it further
-		return self._root(self._path, **kw)
+		return self._root(self._path, **self._merged(kw))
+
+	def Stream(self, batchSize=500, **kw):
+		# Like calling this context, but returns a RowStream over the rows of
+		# the response instead of the parsed result. Meant for calls which
+		# return large rowsets, such as WalletJournal.
+		return self._root._stream(self._path, batchSize, self._merged(kw))
 
 
 class _AuthContext(_Context):
@@ -325,16 +759,78 @@ class _RootContext(_Context):
 	def setcachehandler(self, handler):
 		self._root._handler = handler
 
-	def __call__(self, path, **kw):
+	def _prepare(self, path, kw):
 		# convert list type arguments to something the API likes
 		for k, v in kw.iteritems():
 			if isinstance(v, _listtypes):
 				kw[k] = ','.join(map(str, list(v)))
 
+		return path + ".xml.aspx"
+
+	def _request(self, path, kw):
+		# construct the request
+		request = HTTPRequest(url='https://'+self._host+path)
+		request.use_gzip = True
+		if kw:
+			request.body = urllib.urlencode(kw)
+			request.method = 'POST'
+		if self._proxy:
+			request.url = path
+			request.proxy_host, request.proxy_port = self._proxy
+		return request
+
+	def _decode(self, path, response):
+		if response.code != 200:
+			if response.code == 404:
+				raise AttributeError("'%s' not available on API server (404 Not Found)" % path)
+			else:
+				raise RuntimeError("'%s' request failed (%d %s)" % (path, response.code, response.error))
+		return self._body(response)
+
+	def _body(self, response):
+		# take the response's charset into account
+		if type(response.body) != types.UnicodeType and 'charset' in response.headers.get("Content-Type", ""):
+			charset = response.headers["Content-Type"].split('charset=')[1].strip()
+			return response.body.decode(charset)
+		else:
+			return response.body
+
+	def poolstats(self):
+		# Returns the counters of the connection pools, by (scheme, host, proxy).
+		return dict((key, pool.stats()) for key, pool in self._root._pools.iteritems())
+
+	def _pooled_fetch(self, path, kw):
+		root = self._root
+		key = (self._scheme, self._host, self._proxy)
+		pool = root._pools.get(key)
+		if pool is None:
+			pool = root._pools[key] = ConnectionPool(self._scheme, self._host, self._proxy,
+				maxSize=root._poolSize, idleTimeout=root._idleTimeout)
+
+		headers = {"Accept-Encoding": "gzip", "Connection": "keep-alive"}
+		if kw:
+			headers["Content-Type"] = "application/x-www-form-urlencoded"
+			code, responseHeaders, body = pool.fetch("POST", path, urllib.urlencode(kw), headers)
+		else:
+			code, responseHeaders, body = pool.fetch("GET", path, None, headers)
+
+		if responseHeaders.get("Content-Encoding") == "gzip":
+			body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+		if code != 200:
+			# The API answers some errors with a status other than 200, but
+			# still explains them in an <error> document.
+			error = _ErrorIn(body)
+			if error is not None:
+				raise error
+			# the blocking HTTPClient used before raised this, too
+			raise HTTPError(code)
+		return _PooledResponse(code, responseHeaders, body)
+
+	def _fetch(self, path, kw):
 		cache = self._root._handler
 
 		# now send the request
-		path += ".xml.aspx"
+		path = self._prepare(path, kw)
 
 		if cache:
 			response = cache.retrieve(self._host, path, kw)
@@ -342,36 +838,40 @@ class _RootContext(_Context):
 			response = None
 
 		if response is None:
-			# construct the request
-			request = HTTPRequest(url='https://'+self._host+path)
-			request.use_gzip = True
-			if kw:
-				request.body = urllib.urlencode(kw)
-				request.method = 'POST'
-			if self._proxy:
-				request.url = path
-				request.proxy_host, request.proxy_port = self._proxy
-
 			# fetch from server
-			http_client = HTTPClient()
-			response = http_client.fetch(request)
-
-			if response.code != 200:
-				if response.code == 404:
-					raise AttributeError("'%s' not available on API server (404 Not Found)" % path)
-				else:
-					raise RuntimeError("'%s' request failed (%d %s)" % (path, response.code, response.error))
-			# take the response's charset into account
-			if type(response.body) != types.UnicodeType and 'charset' in response.headers["Content-Type"]:
-				charset = response.headers["Content-Type"].split('charset=')[1].strip()
-				response = response.body.decode(charset)
-			else:
-				response = response.body
-
+			start = time()
+			try:
+				response = self._decode(path, self._pooled_fetch(path, kw))
+			except:
+				self._release(path, kw)
+				raise
+			_observe("eveapi_fetch_seconds", time() - start, path=path)
+			_count("eveapi_requests_total", path=path, source="server")
 			store = not not cache
 		else:
+			_count("eveapi_requests_total", path=path, source="cache")
 			store = False
 
+		return path, response, store
+
+	def _release(self, path, kw):
+		# lets others waiting for the document know it will not be stored
+		cache = self._root._handler
+		if cache and hasattr(cache, "release"):
+			cache.release(self._host, path, kw)
+
+	def _parse(self, path, kw, response, store):
+		if isinstance(response, Element):
+			return self._parse_document(path, kw, response, store)
+		start = time()
+		try:
+			return self._parse_document(path, kw, response, store)
+		finally:
+			_observe("eveapi_parse_seconds", time() - start, path=path)
+
+	def _parse_document(self, path, kw, response, store):
+		cache = self._root._handler
+
 		retrieve_fallback = cache and getattr(cache, "retrieve_fallback", False)
 		if retrieve_fallback:
 			# implementor is handling fallbacks...
@@ -386,10 +886,122 @@ class _RootContext(_Context):
 			# implementor is not handling fallbacks...
 			return _ParseXML(response, True, store and (lambda obj: cache.store(self._host, path, kw, response, obj)))
 
+	def _stream(self, path, batchSize, kw):
+		path, response, store = self._fetch(path, kw)
+		return self._rowstream(path, kw, response, store, batchSize)
+
+	def _rowstream(self, path, kw, response, store, batchSize):
+		# the stream gives up the cache handler's lock once done with it
+		cache = self._root._handler
+		stream = RowStream(response, batchSize, store and (lambda obj: cache.store(self._host, path, kw, response, obj)),
+			store and (lambda: self._release(path, kw)))
+		stream._path = path
+		return stream
+
+	def __call__(self, path, **kw):
+		path, response, store = self._fetch(path, kw)
+		try:
+			return self._parse(path, kw, response, store)
+		finally:
+			if store:
+				self._release(path, kw)
+
+
+class _AsyncRootContext(_RootContext):
+	# Root of connections made by AsyncEVEAPIConnection. Calls do not block:
+	# they take a callback, which is invoked with (result, error) once the
+	# document has been retrieved from the cache handler or the IOLoop has
+	# fetched it from the API server. Exactly one of both is None.
+
+	def __call__(self, path, callback=None, **kw):
+		if callback is None:
+			raise ValueError("Calls on asynchronous connections need a callback")
+
+		def respond(path, response, store):
+			try:
+				self._respond(callback, path, kw, response, store)
+			finally:
+				if store:
+					self._release(path, kw)
+
+		self._retrieve(path, kw, callback, respond)
+
+	def _stream(self, path, batchSize, kw):
+		callback = kw.pop("callback", None)
+		if callback is None:
+			raise ValueError("Calls on asynchronous connections need a callback")
+
+		def respond(path, response, store):
+			callback(self._rowstream(path, kw, response, store, batchSize), None)
+
+		self._retrieve(path, kw, callback, respond)
+
+	def _retrieve(self, path, kw, callback, respond):
+		# Gets the document from the cache handler, or has the IOLoop fetch
+		# it, and passes it on as respond(path, response, store). respond()
+		# has to give up the cache handler's lock once done with the
+		# document. Failed requests are reported to callback instead.
+		cache = self._root._handler
+		path = self._prepare(path, kw)
+
+		if cache:
+			response = cache.retrieve(self._host, path, kw)
+			if response is not None:
+				respond(path, response, False)
+				return
+
+		def on_response(response):
+			try:
+				if response.error:
+					# The API explains most errors in an <error> document,
+					# whatever the status; prefer that, as the pooled fetch does.
+					body = response.body and self._body(response)
+					error = (body and _ErrorIn(body)) or response.error
+				else:
+					error = None
+					body = self._decode(path, response)
+			except Exception, e:
+				error = e
+			if error is not None:
+				self._release(path, kw)
+				callback(None, error)
+				return
+			respond(path, body, not not cache)
+
+		http_client = AsyncHTTPClient(io_loop=self._io_loop)
+		http_client.fetch(self._request(path, kw), on_response)
+
+	def _respond(self, callback, path, kw, response, store):
+		try:
+			result = self._parse(path, kw, response, store)
+		except Exception, e:
+			callback(None, e)
+		else:
+			callback(result, None)
+
 #-----------------------------------------------------------------------------
 # XML Parser
 #-----------------------------------------------------------------------------
 
+def _castdate(value):
+	# parses the API's "%Y-%m-%d %H:%M:%S" format like strptime() does, but
+	# without it for values which have exactly that format and a valid date.
+	fields = (value[0:4], value[5:7], value[8:10], value[11:13], value[14:16], value[17:19])
+	if len(value) == 19 and value[4] == '-' and value[7] == '-' and value[10] == ' ' and value[13] == ':' \
+	   and value[16] == ':' and all(field.isdigit() for field in fields):
+		timetuple = tuple(map(int, fields))
+		year, month, day, hour, minute, second = timetuple
+		if not (year >= 1 and 1 <= month <= 12 and 1 <= day <= monthrange(year, month)[1]
+		        and hour <= 23 and minute <= 59 and second <= 61):
+			raise ValueError("not a date: %r" % value)
+	else:
+		timetuple = strptime(value, "%Y-%m-%d %H:%M:%S")
+	try:
+		return max(0, int(timegm(timetuple)))
+	except OverflowError:
+		raise ValueError("not a date: %r" % value)
+
+
 def _autocast(key, value):
 	# attempts to cast an XML string to the most probable type.
 	try:
@@ -406,9 +1018,7 @@ def _autocast(key, value):
 	if len(value) == 19 and value[10] == ' ':
 		# it could be a date string
 		try:
-			return max(0, int(timegm(strptime(value, "%Y-%m-%d %H:%M:%S"))))
-		except OverflowError:
-			pass
+			return _castdate(value)
 		except ValueError:
 			pass
 
@@ -416,6 +1026,76 @@ def _autocast(key, value):
 	return value
 
 
+# Converters of rowset columns, by rowset name and column name.
+_columnCasters = {}
+
+def _caster(key, value):
+	# Infers the type of a column from one of its values, like _autocast does,
+	# and returns a function casting values of that column. Every value is
+	# cast exactly as _autocast would: the function only tries the inferred
+	# type first, and passes values which are not of it on to _autocast.
+	# Returns None if value is empty, as nothing can be inferred from it.
+	if not value:
+		return None
+
+	if value.strip("-").isdigit():
+		def cast(value):
+			if value.strip("-").isdigit():
+				try:
+					return int(value)
+				except ValueError:
+					pass
+			return _autocast(key, value)
+		return cast
+
+	try:
+		float(value)
+	except ValueError:
+		pass
+	else:
+		def cast(value):
+			if not value.strip("-").isdigit():
+				try:
+					return float(value)
+				except ValueError:
+					pass
+			return _autocast(key, value)
+		return cast
+
+	if len(value) == 19 and value[10] == ' ':
+		def cast(value):
+			if len(value) == 19 and value[10] == ' ':
+				try:
+					return _castdate(value)
+				except ValueError:
+					pass
+			return _autocast(key, value)
+		return cast
+
+	def cast(value):
+		# text starting with a letter is neither a number, unless it is
+		# one of the "inf" and "nan" float() takes, nor a date
+		if value[:1].isalpha() and value[0] not in "iInN":
+			return value
+		return _autocast(key, value)
+	return cast
+
+
+def _castrow(casters, attributes):
+	# Casts the attributes of a row using the converters in casters, which
+	# is the dict of the row's rowset in _columnCasters.
+	row = []
+	for i in xrange(0, len(attributes), 2):
+		cast = casters.get(attributes[i])
+		if cast is None:
+			cast = _caster(attributes[i], attributes[i+1])
+			if cast is None:
+				row.append(_autocast(attributes[i], attributes[i+1]))
+				continue
+			casters[attributes[i]] = cast
+		row.append(cast(attributes[i+1]))
+	return row
+
 
 class _Parser(object):
 
@@ -477,6 +1157,7 @@ class _Parser(object):
 
 
 			this._name = attributes[attributes.index('name')+1]
+			this._casters = _columnCasters.setdefault(this._name, {})
 			this.__catch = "row" # tag to auto-add to rowset.
 		else:
 			this = Element()
@@ -496,7 +1177,7 @@ class _Parser(object):
 			if not self.container._cols:
 				self.container._cols = attributes[0::2]
 
-			self.container.append([_autocast(attributes[i], attributes[i+1]) for i in xrange(0, len(attributes), 2)])
+			self.container.append(_castrow(self.container._casters, attributes))
 			this._isrow = True
 			this._attributes = this._attributes2 = None
 		else:
@@ -611,6 +1292,114 @@ class _Parser(object):
 
 
 
+_streamChunkSize = 65536
+
+class _RowStreamParser(object):
+	# Push parser behind RowStream. Unlike _Parser it does not build Element
+	# objects: the attributes of every row are cast and collected as a plain
+	# list as soon as expat reports the tag, and full batches are handed out
+	# after each chunk of input has been fed.
+	#
+	# Besides rowsets, only the scalar children of the document root (such as
+	# currentTime and cachedUntil) and <error> are kept. Tags nested inside
+	# rows are skipped, so this is meant for flat rowsets like the wallet's.
+
+	def __init__(self, batchSize):
+		self.batchSize = batchSize
+		self.ready = []
+		self.meta = Element()
+		self.meta._name = "eveapi"
+		self.hasResult = False
+		self._rowsets = []
+		self._depth = 0
+		self._skipBelow = 0
+		self._text = None
+		p = self._parser = expat.ParserCreate()
+		p.StartElementHandler = self.tag_start
+		p.CharacterDataHandler = self.tag_cdata
+		p.EndElementHandler = self.tag_end
+		p.ordered_attributes = True
+		p.buffer_text = True
+
+	def feed(self, data, isFinal=False):
+		self._parser.Parse(data, isFinal)
+		ready, self.ready = self.ready, []
+		return ready
+
+	def _flush(self, rowset):
+		batch = Rowset(rowset._cols, rowset._rows)
+		batch._name = rowset._name
+		self.ready.append(batch)
+		rowset._rows = []
+
+	def tag_start(self, name, attributes):
+		self._depth += 1
+		depth = self._depth
+		if self._skipBelow and depth > self._skipBelow:
+			return
+
+		# see _Parser.tag_start() for this hack
+		if ":" in name:
+			name = name[:name.index(":")]
+
+		if depth == 1:
+			if name != "eveapi":
+				raise RuntimeError("Invalid API response")
+		elif depth == 2:
+			self.hasResult = self.hasResult or name == "result"
+			self._text = []
+			self._textAttributes = attributes
+
+		rowsets = self._rowsets
+		if name == "rowset":
+			try:
+				columns = attributes[attributes.index('columns')+1].split(",")
+			except ValueError:
+				# columns will be extracted from first row instead.
+				columns = []
+			this = Rowset(cols=columns)
+			this._name = attributes[attributes.index('name')+1]
+			this._casters = _columnCasters.setdefault(this._name, {})
+			this._depth = depth
+			rowsets.append(this)
+		elif name == "row" and rowsets and rowsets[-1]._depth == depth - 1:
+			this = rowsets[-1]
+			if not this._cols:
+				this._cols = attributes[0::2]
+			this._rows.append(_castrow(this._casters, attributes))
+			if len(this._rows) >= self.batchSize:
+				self._flush(this)
+			self._skipBelow = depth
+
+	def tag_cdata(self, data):
+		if self._depth == 2 and self._text is not None:
+			self._text.append(data)
+
+	def tag_end(self, name):
+		depth = self._depth
+		self._depth -= 1
+		if self._skipBelow:
+			if depth > self._skipBelow:
+				return
+			if depth == self._skipBelow:
+				self._skipBelow = 0
+				return
+
+		rowsets = self._rowsets
+		if rowsets and rowsets[-1]._depth == depth:
+			this = rowsets.pop()
+			if this._rows:
+				self._flush(this)
+		elif depth == 2:
+			data = "".join(self._text).strip()
+			attributes = self._textAttributes
+			self._text = None
+			if name == "error":
+				raise Error(int(attributes[attributes.index('code')+1]), data)
+			if data:
+				setattr(self.meta, name, _autocast(name, data))
+
+
 #-----------------------------------------------------------------------------
 # XML Data Containers
 #-----------------------------------------------------------------------------
@@ -634,6 +1423,12 @@ class Row(object):
 	#
 	# To conserve resources, Row objects are only created on-demand. This is
 	# typically done by Rowsets (e.g. when iterating over the rowset).
+	#
+	# Rowsets hand out instances of a subclass compiled for their column
+	# layout (see _rowclass), which resolves columns through properties with
+	# fixed offsets instead of searching _cols.
+
+	__slots__ = ("_cols", "_row")
 
 	def __init__(self, cols=None, row=None):
 		self._cols = cols or []
@@ -649,14 +1444,17 @@ class Row(object):
 		return self.__cmp__(other) == 0
 
 	def __cmp__(self, other):
-		if type(other) != type(self):
+		if not isinstance(other, Row):
 			raise TypeError("Incompatible comparison type")
 		return cmp(self._cols, other._cols) or cmp(self._row, other._row)
 
 	def __getattr__(self, this):
+		if this in Row.__slots__:
+			# unset slot, e.g. while unpickling
+			raise AttributeError, this
 		try:
 			return self._row[self._cols.index(this)]
-		except:
+		except (ValueError, IndexError):
 			raise AttributeError, this
 
 	def __getitem__(self, this):
@@ -665,6 +1463,36 @@ class Row(object):
 	def __str__(self):
 		return "Row(" + ','.join(map(_fmt, zip(self._cols, self._row))) + ")"
 
+	def __reduce__(self):
+		return (_row, (self._cols, self._row))
+
+	def __setstate__(self, state):
+		# rows pickled before Row had __slots__ carry their __dict__
+		self._cols, self._row = state["_cols"], state["_row"]
+
+
+_rowclasses = {}
+
+def _rowclass(cols):
+	# Returns the Row subclass for the given column layout, creating it on
+	# first use. Every column becomes a property reading its fixed offset in
+	# the row; names which would shadow Row's own attributes are left to
+	# Row.__getattr__.
+	key = tuple(cols)
+	cls = _rowclasses.get(key)
+	if cls is None:
+		namespace = {"__slots__": ()}
+		for i, col in enumerate(key):
+			if col not in namespace and not hasattr(Row, col):
+				namespace[col] = property(lambda self, i=i: self._row[i])
+		cls = _rowclasses[key] = type("Row", (Row,), namespace)
+	return cls
+
+
+def _row(cols, row):
+	# unpickles and creates Rows of the compiled class for cols
+	return _rowclass(cols)(cols, row)
+
 
 class Rowset(object):
 	# Rowsets are collections of Row objects.
@@ -763,7 +1591,13 @@ class Rowset(object):
 	def __getitem__(self, ix):
 		if type(ix) is slice:
 			return Rowset(self._cols, self._rows[ix])
-		return Row(self._cols, self._rows[ix])
+		return _row(self._cols, self._rows[ix])
+
+	def __iter__(self):
+		cols = self._cols
+		rowclass = _rowclass(cols)
+		for row in self._rows:
+			yield rowclass(cols, row)
 
 	def sort(self, *args, **kw):
 		self._rows.sort(*args, **kw)
@@ -779,6 +1613,114 @@ class Rowset(object):
 
 
 
+class RowStream(object):
+	# A RowStream is an iterable over the rows of an API response, yielding
+	# them as Rowset batches of at most batchSize rows each. Every batch has
+	# the name of the rowset it was taken from as _name.
+	#
+	# Rows are produced while the XML is parsed, so memory use stays flat
+	# regardless of the size of the response. Batches of a rowset share its
+	# column list.
+	#
+	# Once the stream has been exhausted, _meta holds the document's scalar
+	# data like currentTime and cachedUntil, as result._meta would. If the
+	# document is an API error, Error is raised during iteration.
+	#
+	# Streams returned by Stream() hold the cache handler's lock on the
+	# document until they have been iterated. Call close(), or use the
+	# stream in a with statement, to give it up earlier, such as when the
+	# stream may not be iterated at all.
+
+	def __init__(self, source, batchSize=500, storeFunc=None, releaseFunc=None):
+		self.batchSize = batchSize
+		self._source = source
+		self._storeFunc = storeFunc
+		self._releaseFunc = releaseFunc
+		self._meta = None
+		self._path = ""
+
+	def __iter__(self):
+		source = self._source
+		if isinstance(source, Element):
+			batches = self._iter_element(source)
+		elif type(source) in (str, unicode):
+			batches = self._iter_chunks(source[i:i+_streamChunkSize] for i in xrange(0, len(source), _streamChunkSize))
+		elif hasattr(source, "read"):
+			batches = self._iter_chunks(iter(lambda: source.read(_streamChunkSize), source.read(0)))
+		else:
+			raise TypeError("XML data must be provided as string, file-like object or an Element instance")
+		return self._released(batches)
+
+	def _released(self, batches):
+		# calls releaseFunc once the stream has been exhausted, has failed or
+		# has been abandoned, whether the document has been stored or not
+		try:
+			for batch in batches:
+				yield batch
+		finally:
+			self.close()
+
+	def close(self):
+		# Gives up the cache handler's lock on the document, if it is still
+		# held. An iteration in progress can go on.
+		releaseFunc, self._releaseFunc = self._releaseFunc, None
+		if releaseFunc:
+			releaseFunc()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def __del__(self):
+		# a stream which has never been iterated; those being iterated are
+		# referenced by their iterator until it has been closed
+		self.close()
+
+	def _iter_chunks(self, chunks):
+		parser = _RowStreamParser(self.batchSize)
+		parsing = 0.0 # seconds, not counting the time the consumer takes
+		for chunk in chunks:
+			start = time()
+			ready = parser.feed(chunk)
+			parsing += time() - start
+			for batch in ready:
+				yield batch
+		start = time()
+		ready = parser.feed("", True)
+		parsing += time() - start
+		_observe("eveapi_parse_seconds", parsing, path=self._path)
+		for batch in ready:
+			yield batch
+
+		if not parser.hasResult:
+			raise RuntimeError("API object does not contain result")
+		self._finish(parser.meta)
+
+	def _iter_element(self, obj):
+		error = getattr(obj, "error", False)
+		if error:
+			raise Error(error.code, error.data)
+		result = getattr(obj, "result", False)
+		if not result:
+			raise RuntimeError("API object does not contain result")
+
+		for rowset in result.__dict__.values():
+			if isinstance(rowset, Rowset):
+				for i in xrange(0, len(rowset), self.batchSize):
+					batch = rowset[i:i+self.batchSize]
+					batch._name = rowset._name
+					yield batch
+		self._finish(obj)
+
+	def _finish(self, meta):
+		self._meta = meta
+		if self._storeFunc:
+			self._storeFunc(meta)
+			self._storeFunc = None
+
+
 class IndexRowset(Rowset):
 	# An IndexRowset is a Rowset that keeps an index on a column.
 	#
@@ -796,7 +1738,7 @@ class IndexRowset(Rowset):
 			if default:
 				return default[0]
 			raise KeyError, key
-		return Row(self._cols, row)
+		return _row(self._cols, row)
 
 	# -------------
 
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of AsyncEVEAPIConnection. Its requests are answered right
+# away by canned responses instead of being fetched by the IOLoop.
+#
+#   python eveapi_async_test.py
+
+from cStringIO import StringIO
+import unittest
+
+import eveapi
+from eveapi_cache_test import ERROR, DictCacheHandler, _document
+
+try:
+    from anzu.httpclient import HTTPResponse
+    from anzu.httputil import HTTPHeaders
+except ImportError:
+    from tornado.httpclient import HTTPResponse
+    from tornado.httputil import HTTPHeaders
+
+class AsyncHTTPClient(object):
+    # answers every request with the response the test has set
+
+    response = None
+    requests = []
+
+    def __init__(self, io_loop=None):
+        pass
+
+    def fetch(self, request, callback):
+        code, body = AsyncHTTPClient.response
+        AsyncHTTPClient.requests.append(request)
+        headers = HTTPHeaders({'Content-Type': 'text/xml; charset=utf-8'})
+        callback(HTTPResponse(request, code, headers, StringIO(body)))
+
+class LockingCacheHandler(DictCacheHandler):
+    # tells which documents would be locked by a shared cache
+
+    def __init__(self):
+        DictCacheHandler.__init__(self)
+        self.locked = set()
+
+    def retrieve(self, host, path, params):
+        doc = DictCacheHandler.retrieve(self, host, path, params)
+        if doc is None:
+            self.locked.add(path)
+        return doc
+
+    def release(self, host, path, params):
+        self.locked.discard(path)
+
+class AsyncConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = eveapi.AsyncHTTPClient
+        eveapi.AsyncHTTPClient = AsyncHTTPClient
+        AsyncHTTPClient.requests = []
+        self.cache = LockingCacheHandler()
+        self.api = eveapi.AsyncEVEAPIConnection(cacheHandler=self.cache)
+        self.results = []
+
+    def tearDown(self):
+        eveapi.AsyncHTTPClient = self.client
+
+    def callback(self, result, error):
+        self.results.append((result, error))
+
+    def respond(self, code, body):
+        AsyncHTTPClient.response = (code, body)
+
+    def test_call(self):
+        self.respond(200, _document())
+        self.api.char.WalletJournal(characterID=1, callback=self.callback)
+        self.api.char.WalletJournal(characterID=1, callback=self.callback)
+        self.assertEqual(len(AsyncHTTPClient.requests), 1)
+        for result, error in self.results:
+            self.assertEqual(error, None)
+            self.assertEqual([row.refID for row in result.entries], [1000, 1001, 1002])
+        self.assertEqual(self.cache.locked, set())
+
+    def test_stream(self):
+        self.respond(200, _document(rows=5))
+        self.api.char.WalletJournal.Stream(batchSize=2, characterID=1, callback=self.callback)
+        (stream, error), = self.results
+        self.assertEqual(error, None)
+        # locked until the stream has been read
+        self.assertEqual(len(self.cache.locked), 1)
+        self.assertEqual([len(batch) for batch in stream], [2, 2, 1])
+        self.assertEqual(self.cache.locked, set())
+        self.assertEqual(len(self.cache.documents), 1)
+
+        # from the cache
+        self.api.char.WalletJournal.Stream(characterID=1, callback=self.callback)
+        self.assertEqual(sum(len(batch) for batch in self.results[1][0]), 5)
+        self.assertEqual(len(AsyncHTTPClient.requests), 1)
+        self.assertRaises(ValueError, self.api.char.WalletJournal.Stream, characterID=1)
+
+    def test_error_document(self):
+        for code in (200, 403, 404):
+            self.respond(code, ERROR)
+            self.api.char.WalletJournal(characterID=code, callback=self.callback)
+            self.api.char.WalletJournal.Stream(characterID=code, callback=self.callback)
+            call, stream = self.results[-2:]
+            self.assertEqual(call[0], None)
+            self.assertTrue(isinstance(call[1], eveapi.Error))
+            self.assertEqual(call[1].code, 203)
+            if code == 200:
+                # told by reading the stream, like a blocking call does
+                self.assertRaises(eveapi.Error, list, stream[0])
+            else:
+                self.assertEqual(stream[0], None)
+                self.assertEqual(stream[1].code, 203)
+        self.assertEqual(self.cache.locked, set())
+
+    def test_http_error(self):
+        self.respond(500, 'Internal Server Error')
+        self.api.char.WalletJournal(characterID=1, callback=self.callback)
+        (result, error), = self.results
+        self.assertEqual(result, None)
+        self.assertEqual(error.code, 500)
+        self.assertEqual(self.cache.locked, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
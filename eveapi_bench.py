@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmark: attribute access on rows of a wallet journal sized Rowset,
+# comparing the rows compiled per column layout against the former Row, which
+# searched _cols on every access.
+#
+#   python eveapi_bench.py [rows] [repeat]
+
+import sys
+from timeit import Timer
+
+import eveapi
+
+COLUMNS = ['date', 'refID', 'refTypeID', 'ownerName1', 'ownerID1', 'ownerName2', 'ownerID2',
+           'argName1', 'argID1', 'amount', 'balance', 'reason', 'taxReceiverID', 'taxAmount']
+
+class LegacyRow(object):
+    # Row as it was before the compiled row classes.
+
+    def __init__(self, cols=None, row=None):
+        self._cols = cols or []
+        self._row = row or []
+
+    def __getattr__(self, this):
+        try:
+            return self._row[self._cols.index(this)]
+        except:
+            raise AttributeError, this
+
+def synthetic_rowset(num_rows):
+    rows = []
+    for i in xrange(num_rows):
+        rows.append([1306922400 - i, 4000000000 - i, 2, u'Pilot', 90000000 + i, u'Corp', 1000125,
+                     u'%d' % i, 0, 1000.5, 123456789.25, u'', u'', u''])
+    return eveapi.Rowset(COLUMNS, rows)
+
+def read_all_columns(rowset, rowclass=None):
+    cols = rowset._cols
+    if rowclass is None:
+        rows = rowset
+    else:
+        rows = (rowclass(cols, row) for row in rowset._rows)
+    for row in rows:
+        for colname in cols:
+            getattr(row, colname)
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2560
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    rowset = synthetic_rowset(num_rows)
+
+    results = []
+    for label, rowclass in [('legacy Row', LegacyRow), ('compiled Row', None)]:
+        timer = Timer(lambda: read_all_columns(rowset, rowclass))
+        best = min(timer.repeat(repeat=repeat, number=1))
+        results.append(best)
+        print '%-14s %8.2f ms per %d rows x %d columns' % (label, best * 1000, num_rows, len(COLUMNS))
+    print 'speedup        %8.2fx' % (results[0] / results[1])
+
+if __name__ == "__main__":
+    main()
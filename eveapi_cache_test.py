@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of the cache handlers. Calls go through an EVEAPIConnection
+# whose requests to the API server are answered by canned documents.
+#
+#   python eveapi_cache_test.py
+
+from threading import Timer
+from time import gmtime, strftime, time
+import unittest
+
+import eveapi
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+ROW = '<row refID="%d" amount="%d.50" />'
+
+DOCUMENT = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>%s</currentTime>
+  <result>
+    <rowset name="entries" key="refID" columns="refID,amount">
+      %s
+    </rowset>
+  </result>
+  <cachedUntil>%s</cachedUntil>
+</eveapi>"""
+
+ERROR = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2011-06-01 10:00:00</currentTime>
+  <error code="203">Authentication failure.</error>
+  <cachedUntil>2011-06-02 10:00:00</cachedUntil>
+</eveapi>"""
+
+def _document(rows=3, cachedFor=1800):
+    # the API server's clock is the local one
+    now = time()
+    return DOCUMENT % (strftime('%Y-%m-%d %H:%M:%S', gmtime(now)),
+                       '\n'.join(ROW % (1000 + i, i) for i in range(rows)),
+                       strftime('%Y-%m-%d %H:%M:%S', gmtime(now + cachedFor)))
+
+
+class DictCacheHandler(object):
+    # keeps the documents as they are stored, like a shared cache would
+
+    def __init__(self):
+        self.documents = {}
+        self.retrieved = 0
+
+    def retrieve(self, host, path, params):
+        self.retrieved += 1
+        return self.documents.get(eveapi._cache_key(host, path, params))
+
+    def store(self, host, path, params, doc, obj):
+        self.documents[eveapi._cache_key(host, path, params)] = doc
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def connect(self, handler, doc):
+        self.fetched = 0
+        api = eveapi.EVEAPIConnection(cacheHandler=handler)
+        def fetch(path, kw):
+            self.fetched += 1
+            if isinstance(doc, Exception):
+                raise doc
+            return eveapi._PooledResponse(200, {'Content-Type': 'text/xml'}, doc)
+        api._pooled_fetch = fetch
+        return api
+
+    def assertEntries(self, result, rows=3):
+        self.assertEqual([row.refID for row in result.entries], range(1000, 1000 + rows))
+
+
+class TieredCacheHandlerTest(CacheTestCase):
+
+    def test_hit(self):
+        handler = eveapi.TieredEVEAPICacheHandler()
+        api = self.connect(handler, _document())
+        first = api.char.WalletJournal(characterID=1)
+        second = api.char.WalletJournal(characterID=1)
+        self.assertEqual(self.fetched, 1)
+        self.assertTrue(second is first)
+        self.assertEqual(handler.stats()['memory'], {'hits': 1, 'misses': 1, 'evictions': 0})
+        api.char.WalletJournal(characterID=2)
+        self.assertEqual(self.fetched, 2)
+
+    def test_second_tier(self):
+        second = DictCacheHandler()
+        api = self.connect(eveapi.TieredEVEAPICacheHandler(second), _document())
+        self.assertEntries(api.char.WalletJournal(characterID=1))
+        self.assertEqual(len(second.documents), 1)
+
+        # another process, with the document in the shared cache only
+        handler = eveapi.TieredEVEAPICacheHandler(second)
+        api = self.connect(handler, _document())
+        self.assertEntries(api.char.WalletJournal(characterID=1))
+        self.assertEntries(api.char.WalletJournal(characterID=1))
+        self.assertEqual((self.fetched, second.retrieved), (0, 2))
+        self.assertEqual(handler.hits, 1)
+
+    def test_not_cached(self):
+        handler = eveapi.TieredEVEAPICacheHandler()
+        api = self.connect(handler, _document(cachedFor=0))
+        api.char.WalletJournal(characterID=1)
+        api.char.WalletJournal(characterID=1)
+        self.assertEqual(self.fetched, 2)
+        self.assertEqual(len(handler._entries), 0)
+
+    def test_evictions(self):
+        handler = eveapi.TieredEVEAPICacheHandler(maxEntries=2)
+        api = self.connect(handler, _document())
+        for characterID in (1, 2, 1, 3):
+            api.char.WalletJournal(characterID=characterID)
+        self.assertEqual(self.fetched, 3)
+        self.assertEqual(handler.evictions, 1)
+        # 2 has been used least recently
+        api.char.WalletJournal(characterID=1)
+        api.char.WalletJournal(characterID=2)
+        self.assertEqual(self.fetched, 4)
+
+    def test_stream_not_remembered(self):
+        second = DictCacheHandler()
+        handler = eveapi.TieredEVEAPICacheHandler(second)
+        api = self.connect(handler, _document())
+        self.assertEqual(sum(len(batch) for batch in api.char.WalletJournal.Stream(characterID=1)), 3)
+        # a stream stores the document's meta data, which has no rows
+        self.assertEqual(len(handler._entries), 0)
+        self.assertEqual(len(second.documents), 1)
+        self.assertEntries(api.char.WalletJournal(characterID=1))
+        self.assertEqual(sum(len(batch) for batch in api.char.WalletJournal.Stream(characterID=1)), 3)
+        self.assertEqual(self.fetched, 1)
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class RedisCacheHandlerTest(CacheTestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+
+    def handler(self, **kw):
+        kw.setdefault('waitTimeout', 0)
+        handler = eveapi.RedisEVEAPICacheHandler(**kw)
+        handler.redis = self.redis
+        return handler
+
+    def assertUnlocked(self, handler):
+        self.assertEqual(self.redis.keys('lock:*'), [])
+        self.assertEqual(handler._locks, {})
+
+    def test_hit(self):
+        handler = self.handler()
+        api = self.connect(handler, _document())
+        self.assertEntries(api.char.WalletJournal(characterID=1))
+        self.assertEntries(api.char.WalletJournal(characterID=1))
+        self.assertEqual(self.fetched, 1)
+        self.assertEqual((handler.hits, handler.misses), (1, 1))
+        self.assertUnlocked(handler)
+
+    def test_compressed(self):
+        handler = self.handler(compressAbove=100)
+        api = self.connect(handler, _document(rows=50))
+        api.char.WalletJournal(characterID=1)
+        key, = self.redis.keys('*WalletJournal*')
+        self.assertTrue(self.redis.get(key).startswith(eveapi._compressedMarker))
+        self.assertEntries(api.char.WalletJournal(characterID=1), rows=50)
+        self.assertEqual(self.fetched, 1)
+
+    def test_lock(self):
+        handler = self.handler()
+        self.assertEqual(handler.retrieve('host', '/path', {}), None)
+        self.assertEqual(len(self.redis.keys('lock:*')), 1)
+        # another process fetches the document itself rather than waiting forever
+        other = self.handler()
+        self.assertEqual(other.retrieve('host', '/path', {}), None)
+        handler.store('host', '/path', {}, _document(), eveapi._Parser().Parse(_document()))
+        self.assertUnlocked(handler)
+
+    def test_coalesced(self):
+        doc = _document()
+        handler = self.handler()
+        handler.retrieve('host', '/path', {})
+        waiting = self.handler(waitTimeout=5)
+        Timer(0.2, handler.store, ('host', '/path', {}, doc, eveapi._Parser().Parse(doc))).start()
+        self.assertEqual(waiting.retrieve('host', '/path', {}), doc)
+        # neither a miss nor a hit
+        self.assertEqual((waiting.coalesced, waiting.hits, waiting.misses), (1, 0, 0))
+        self.assertUnlocked(handler)
+
+    def test_release_keeps_others_lock(self):
+        handler = self.handler(lockTimeout=1)
+        handler.retrieve('host', '/path', {})
+        # the lock has expired, and another process holds it now
+        lock, = self.redis.keys('lock:*')
+        self.redis.set(lock, 'other')
+        handler.release('host', '/path', {})
+        self.assertEqual(self.redis.get(lock), 'other')
+        self.assertEqual(handler._locks, {})
+
+    def test_retrieve_many(self):
+        handler = self.handler()
+        first, second = _document(rows=1), _document(rows=2)
+        requests = [('host', '/first', {'a': 1}), ('host', '/missing', {}), ('host', '/second', {})]
+        handler.store(*requests[0] + (first, eveapi._Parser().Parse(first)))
+        handler.store(*requests[2] + (second, eveapi._Parser().Parse(second)))
+        self.assertEqual(handler.retrieve_many(requests), [first, None, second])
+        self.assertEqual(handler.retrieve_many([]), [])
+        self.assertEqual((handler.hits, handler.misses), (2, 1))
+        # prefetching does not lock what is missing
+        self.assertUnlocked(handler)
+
+    def test_tiered_retrieve_many(self):
+        handler = self.handler()
+        tiered = eveapi.TieredEVEAPICacheHandler(handler)
+        doc = _document()
+        requests = [('host', '/memory', {}), ('host', '/redis', {}), ('host', '/missing', {})]
+        remembered = eveapi._Parser().Parse(doc)
+        tiered.store(*requests[0] + (doc, remembered))
+        handler.store(*requests[1] + (doc, eveapi._Parser().Parse(doc)))
+        handler.hits = handler.misses = 0
+        results = tiered.retrieve_many(requests)
+        self.assertTrue(results[0] is remembered)
+        self.assertEqual([row.refID for row in results[1].result.entries], [1000, 1001, 1002])
+        self.assertEqual(results[2], None)
+        # only the calls missing in memory have been asked of Redis
+        self.assertEqual((handler.hits, handler.misses), (1, 1))
+        self.assertTrue(tiered.retrieve_many(requests[1:2])[0] is results[1])
+        self.assertEqual(handler.hits, 1)
+
+    def test_released_on_failure(self):
+        handler = self.handler()
+        api = self.connect(handler, eveapi.Error(500, 'down'))
+        self.assertRaises(eveapi.Error, api.char.WalletJournal, characterID=1)
+        self.assertUnlocked(handler)
+        self.assertRaises(eveapi.Error, api.char.WalletJournal.Stream, characterID=1)
+        self.assertUnlocked(handler)
+
+    def test_released_on_error_document(self):
+        handler = self.handler()
+        api = self.connect(handler, ERROR)
+        self.assertRaises(eveapi.Error, api.char.WalletJournal, characterID=1)
+        self.assertUnlocked(handler)
+        self.assertRaises(eveapi.Error, list, api.char.WalletJournal.Stream(characterID=1))
+        self.assertUnlocked(handler)
+
+    def test_released_by_stream(self):
+        handler = self.handler()
+        api = self.connect(handler, _document(rows=5))
+        stream = api.char.WalletJournal.Stream(batchSize=2, characterID=1)
+        self.assertEqual(len(self.redis.keys('lock:*')), 1)
+        self.assertEqual(sum(len(batch) for batch in stream), 5)
+        self.assertUnlocked(handler)
+
+        # abandoned before the document could be stored
+        api = self.connect(handler, _document(rows=5))
+        batches = iter(api.char.WalletJournal.Stream(batchSize=2, characterID=2))
+        batches.next()
+        batches.close()
+        self.assertUnlocked(handler)
+        self.assertEqual(len(self.redis.keys('*WalletJournal*')), 1)
+
+    def test_released_unread_stream(self):
+        handler = self.handler()
+        api = self.connect(handler, _document())
+        with api.char.WalletJournal.Stream(characterID=1) as stream:
+            self.assertEqual(len(self.redis.keys('lock:*')), 1)
+        self.assertUnlocked(handler)
+        stream.close()
+
+        # dropped without having been closed
+        api.char.WalletJournal.Stream(characterID=2)
+        self.assertUnlocked(handler)
+        self.assertEqual(self.fetched, 2)
+
+    def test_tiered(self):
+        handler = self.handler()
+        tiered = eveapi.TieredEVEAPICacheHandler(handler)
+        api = self.connect(tiered, eveapi.Error(500, 'down'))
+        self.assertRaises(eveapi.Error, api.char.WalletJournal, characterID=1)
+        self.assertUnlocked(handler)
+        api = self.connect(tiered, _document())
+        self.assertEqual(sum(len(batch) for batch in api.char.WalletJournal.Stream(characterID=1)), 3)
+        self.assertUnlocked(handler)
+        self.assertEntries(api.char.WalletJournal(characterID=1))
+        self.assertEqual(self.fetched, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
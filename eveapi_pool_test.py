@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of eveapi.ConnectionPool, whose connections are stand-ins
+# which answer or fail as told.
+#
+#   python eveapi_pool_test.py
+
+import httplib
+import unittest
+
+import eveapi
+
+class Response(object):
+    status = 200
+    will_close = False
+
+    def read(self):
+        return 'body'
+
+    def getheaders(self):
+        return [('Content-Type', 'text/xml')]
+
+class Connection(object):
+
+    def __init__(self, broken=False):
+        self.broken = broken
+        self.closed = False
+        self.requests = 0
+
+    def request(self, method, url, body, headers):
+        self.requests += 1
+        if self.broken:
+            raise httplib.BadStatusLine('')
+
+    def getresponse(self):
+        return Response()
+
+    def close(self):
+        self.closed = True
+
+class Pool(eveapi.ConnectionPool):
+    # opens the connections of the list made, in order
+
+    def __init__(self, *made, **kw):
+        eveapi.ConnectionPool.__init__(self, 'https', 'api.example.com', **kw)
+        self.made = list(made)
+
+    def _connect(self):
+        self.created += 1
+        return self.made.pop(0)
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def test_reused(self):
+        conn = Connection()
+        pool = Pool(conn)
+        self.assertEqual(pool.fetch('GET', '/path')[0], 200)
+        self.assertEqual(pool.fetch('GET', '/path')[2], 'body')
+        self.assertEqual(conn.requests, 2)
+        self.assertEqual(pool.stats(), {'created': 1, 'reused': 1, 'discarded': 0, 'idle': 1})
+
+    def test_stale_replaced_once(self):
+        stale, fresh = Connection(broken=True), Connection()
+        pool = Pool(fresh)
+        pool.release(Connection(broken=True))
+        pool.release(stale)
+        self.assertEqual(pool.fetch('GET', '/path')[0], 200)
+        # the other idle connection has not been tried, but a new one made instead
+        self.assertTrue(stale.closed)
+        self.assertEqual(pool.stats(), {'created': 1, 'reused': 1, 'discarded': 1, 'idle': 2})
+
+    def test_new_connection_failed(self):
+        stale, broken = Connection(broken=True), Connection(broken=True)
+        pool = Pool(broken)
+        pool.release(stale)
+        self.assertRaises(httplib.BadStatusLine, pool.fetch, 'GET', '/path')
+        self.assertEqual(broken.requests, 1)
+        self.assertEqual(pool.stats(), {'created': 1, 'reused': 1, 'discarded': 2, 'idle': 0})
+
+    def test_surplus_closed(self):
+        conns = [Connection() for i in range(3)]
+        pool = Pool(maxSize=2)
+        for conn in conns:
+            pool.release(conn)
+        self.assertEqual([conn.closed for conn in conns], [False, False, True])
+        self.assertEqual(pool.stats()['discarded'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
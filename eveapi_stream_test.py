@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of the streaming parser: the rows a RowStream yields for a
+# document have to be those ParseXML() builds the Element tree of.
+#
+#   python eveapi_stream_test.py
+
+from StringIO import StringIO
+import unittest
+
+import eveapi
+
+JOURNAL = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2011-06-01 10:00:00</currentTime>
+  <result>
+    <rowset name="entries" key="refID" columns="date,refID,refTypeID,ownerName1,ownerID1,ownerName2,ownerID2,argName1,argID1,amount,balance,reason,taxReceiverID,taxAmount">
+      <row date="2011-05-01 12:00:00" refID="1000000002" refTypeID="37" ownerName1="Some Pilot" ownerID1="90000000" ownerName2="Corp &amp; Co" ownerID2="1000125" argName1="3000000000" argID1="0" amount="747124.33" balance="136222580.91" reason="DESC: &quot;foo&quot;" taxReceiverID="" taxAmount="" />
+      <row date="2011-05-02 12:01:01" refID="1000000001" refTypeID="10" ownerName1="Some Pilot" ownerID1="90000001" ownerName2="Corp &amp; Co" ownerID2="1000125" argName1="2999999997" argID1="0" amount="-835249.77" balance="578880016.45" reason="" taxReceiverID="" taxAmount="" />
+      <row date="2011-05-03 12:02:02" refID="1000000000" refTypeID="85" ownerName1="Pilot Ünicode" ownerID1="90000002" ownerName2="Corp &amp; Co" ownerID2="1000125" argName1="Jita" argID1="30000142" amount="-61225" balance="109995681.01" reason="007" taxReceiverID="1000125" taxAmount="12.50" />
+    </rowset>
+  </result>
+  <cachedUntil>2011-06-01 10:30:00</cachedUntil>
+</eveapi>"""
+
+# two rowsets; the second refers to the first by its transactions' journalTransactionID
+TWO_ROWSETS = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2011-06-01 10:00:00</currentTime>
+  <result>
+    <rowset name="accounts" key="accountID" columns="accountID,accountKey,balance">
+      <row accountID="4807144" accountKey="1000" balance="209127823.31" />
+      <row accountID="4807145" accountKey="1001" balance="0.00" />
+    </rowset>
+    <rowset name="transactions" key="transactionID" columns="transactionDateTime,transactionID,quantity,typeName,typeID,price,journalTransactionID">
+      <row transactionDateTime="2011-05-01 12:00:00" transactionID="1309776438" quantity="1" typeName="Tritanium" typeID="34" price="5.01" journalTransactionID="1000000002" />
+    </rowset>
+  </result>
+  <cachedUntil>2011-06-01 10:15:00</cachedUntil>
+</eveapi>"""
+
+ERROR = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2011-06-01 10:00:00</currentTime>
+  <error code="203">Authentication failure.</error>
+  <cachedUntil>2011-06-02 10:00:00</cachedUntil>
+</eveapi>"""
+
+NO_ROWS = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2011-06-01 10:00:00</currentTime>
+  <result>
+    <rowset name="entries" key="refID" columns="date,refID,amount" />
+  </result>
+  <cachedUntil>2011-06-01 10:30:00</cachedUntil>
+</eveapi>"""
+
+
+def _rowsets(obj):
+    return dict((name, rowset) for name, rowset in obj.__dict__.items() if isinstance(rowset, eveapi.Rowset))
+
+class RowStreamTest(unittest.TestCase):
+
+    def assertStreamedAsParsed(self, doc, stream):
+        parsed = _rowsets(eveapi.ParseXML(doc))
+        streamed = {}
+        for batch in stream:
+            self.assertTrue(0 < len(batch) <= stream.batchSize)
+            self.assertEqual(batch._cols, parsed[batch._name]._cols)
+            streamed.setdefault(batch._name, []).extend(batch._rows)
+        self.assertEqual(sorted(streamed), sorted(name for name, rowset in parsed.items() if rowset))
+        for name, rows in streamed.items():
+            self.assertEqual(rows, parsed[name]._rows)
+
+    def test_rows_as_parsed(self):
+        self.assertStreamedAsParsed(JOURNAL, eveapi.ParseRows(JOURNAL))
+
+    def test_batches(self):
+        stream = eveapi.ParseRows(JOURNAL, batchSize=2)
+        self.assertEqual([len(batch) for batch in stream], [2, 1])
+        self.assertStreamedAsParsed(JOURNAL, eveapi.ParseRows(JOURNAL, batchSize=1))
+
+    def test_sources(self):
+        self.assertStreamedAsParsed(JOURNAL, eveapi.ParseRows(StringIO(JOURNAL)))
+        self.assertStreamedAsParsed(TWO_ROWSETS, eveapi.ParseRows(TWO_ROWSETS.decode('utf-8')))
+        self.assertStreamedAsParsed(JOURNAL, eveapi.RowStream(eveapi._Parser().Parse(JOURNAL)))
+
+    def test_chunks(self):
+        # the document split in the middle of rows and attribute values
+        chunkSize = eveapi._streamChunkSize
+        eveapi._streamChunkSize = 7
+        try:
+            self.assertStreamedAsParsed(JOURNAL, eveapi.ParseRows(JOURNAL))
+        finally:
+            eveapi._streamChunkSize = chunkSize
+
+    def test_rowsets(self):
+        self.assertStreamedAsParsed(TWO_ROWSETS, eveapi.ParseRows(TWO_ROWSETS))
+
+    def test_values(self):
+        entries = eveapi.ParseXML(JOURNAL).entries
+        rows = [row for batch in eveapi.ParseRows(JOURNAL) for row in batch]
+        for streamed, parsed in zip(rows, entries):
+            self.assertEqual(type(streamed), type(parsed))
+            for column in entries._cols:
+                self.assertEqual(getattr(streamed, column), getattr(parsed, column))
+                self.assertEqual(type(getattr(streamed, column)), type(getattr(parsed, column)))
+        self.assertEqual(rows[0].date, 1304251200)
+        self.assertEqual(rows[0].ownerName2, u'Corp & Co')
+        self.assertEqual(rows[0].reason, u'DESC: "foo"')
+        self.assertEqual(rows[2].ownerName1, u'Pilot \xdcnicode')
+        self.assertEqual(rows[2].taxAmount, 12.5)
+        self.assertEqual(rows[2].amount, -61225.0)
+        self.assertEqual(rows[1].taxAmount, u'')
+
+    def test_casters(self):
+        # a column's caster casts every value as _autocast does, whatever its first value was
+        values = ['7', '-7', '1.5', '-1e3', 'inf', 'nan', '', ' 12 ', '2011-05-01 12:00:00', '2011-02-30 12:00:00',
+                  '2011-05-01T12:00:00', '         1         ', 'Jita', 'Infinite', u'Pilot \xdcnicode', u'\u0661',
+                  u'\xdc', '007']
+        for first in values:
+            cast = eveapi._caster('column', first)
+            if cast is None:
+                self.assertEqual(first, '')
+                continue
+            for value in values:
+                expected = eveapi._autocast('column', value)
+                # by repr, as nan is unequal to itself
+                self.assertEqual(repr(cast(value)), repr(expected))
+
+    def test_meta(self):
+        stream = eveapi.ParseRows(JOURNAL)
+        self.assertEqual(stream._meta, None)
+        list(stream)
+        parsed = eveapi.ParseXML(JOURNAL)._meta
+        self.assertEqual(stream._meta.currentTime, parsed.currentTime)
+        self.assertEqual(stream._meta.cachedUntil, parsed.cachedUntil)
+
+    def test_store_func(self):
+        stored = []
+        stream = eveapi.RowStream(JOURNAL, storeFunc=stored.append)
+        batches = iter(stream)
+        batches.next()
+        self.assertEqual(stored, [])
+        list(batches)
+        self.assertEqual(stored, [stream._meta])
+
+    def test_no_rows(self):
+        stream = eveapi.ParseRows(NO_ROWS)
+        self.assertEqual(list(stream), [])
+        self.assertEqual(stream._meta.cachedUntil - stream._meta.currentTime, 1800)
+
+    def test_error(self):
+        stream = eveapi.ParseRows(ERROR)
+        try:
+            list(stream)
+        except eveapi.Error, e:
+            self.assertEqual(e.code, 203)
+        else:
+            self.fail("Error not raised")
+        self.assertRaises(eveapi.Error, list, eveapi.RowStream(eveapi._Parser().Parse(ERROR)))
+
+
+if __name__ == '__main__':
+    unittest.main()
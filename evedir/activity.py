@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Notifications of new wallet rows, from the synchronization processes to the web server.
+
+Every wallet has a version in Redis, which is incremented whenever rows have been added to it or modified.
+The new version is published along with what has changed, so pages showing the wallet know when to refetch,
+and what has been computed from a wallet can be cached by its version.
+"""
+
+from collections import defaultdict, namedtuple
+from functools import partial
+import logging
+from threading import Thread
+from time import sleep
+
+from anzu.ioloop import IOLoop
+
+__all__ = ['WalletActivity', 'publish', 'changed', 'current_version', 'wallet_of', 'ActivityListener']
+
+CHANNEL = 'evedir:wallet:activity'
+VERSION = 'evedir:wallet:version:%s:%d:%s'
+
+# endpoint of WalletActivity about rows which have changed, such as by being tagged, instead of being added
+CHANGED = 'changed'
+
+# seconds to wait before subscribing again after the connection to Redis has been lost
+RECONNECT_DELAY = 5
+
+class WalletActivity(namedtuple('WalletActivity', 'owner ownerID accountKey endpoint rows newest version')):
+    """
+    Rows which have been added to a wallet; owner is 'corp' or 'char' like in the URLs of reports.
+
+    newest is the highest refID or transactionID among them. If rows have been modified instead,
+    endpoint is CHANGED and rows and newest are 0.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return '%s:%d:%s:%s:%d:%d:%d' % self
+
+    @classmethod
+    def parse(cls, message):
+        owner, ownerID, accountKey, endpoint, rows, newest, version = message.split(':')
+        return cls(owner, int(ownerID), accountKey, endpoint, int(rows), int(newest), int(version))
+
+    @property
+    def wallet(self):
+        return (self.owner, self.ownerID, self.accountKey)
+
+
+def publish(redis, owner, ownerID, accountKey, endpoint, rows, newest):
+    """Bumps the wallet's version and tells all listeners about the rows. Returns the WalletActivity."""
+    version = redis.incr(VERSION % (owner, ownerID, accountKey))
+    activity = WalletActivity(owner, ownerID, accountKey, endpoint, rows, newest, version)
+    redis.publish(CHANNEL, str(activity))
+    return activity
+
+def changed(redis, wallet):
+    """Bumps the version of the wallet, given as (owner, ownerID, accountKey), whose rows have been modified."""
+    owner, ownerID, accountKey = wallet
+    return publish(redis, owner, ownerID, accountKey, CHANGED, 0, 0)
+
+def wallet_of(corporationID, character, accountKey):
+    """Returns the wallet as (owner, ownerID, accountKey) of rows with the given columns."""
+    if corporationID is not None:
+        return ('corp', corporationID, accountKey)
+    return ('char', character, accountKey)
+
+def current_version(redis, wallet):
+    """Returns the version of the wallet, given as (owner, ownerID, accountKey)."""
+    return int(redis.get(VERSION % wallet) or 0)
+
+
+class ActivityListener(object):
+    """
+    Receives WalletActivity in a thread of its own, and passes it on to callbacks waiting for the wallet.
+
+    Callbacks are run by the IOLoop, as are all other methods except start(). A waiting callback costs
+    no more than its entry in a dict, so any number of clients can wait at once.
+    """
+
+    def __init__(self, redis, io_loop=None):
+        self.redis = redis
+        self.io_loop = io_loop or IOLoop.instance()
+        self._versions = {} # wallet -> latest version
+        self._waiters = defaultdict(set) # wallet -> callbacks
+        self._watchers = []
+
+    def start(self):
+        thread = Thread(target=self._listen, name='activity-listener')
+        thread.daemon = True
+        thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe(CHANNEL)
+                # anything published while not subscribed has been missed
+                self.io_loop.add_callback(self._versions.clear)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.io_loop.add_callback(partial(self._dispatch, WalletActivity.parse(message['data'])))
+            except Exception, e:
+                logging.warning("Listening for wallet activity failed (%r). Trying again in %d seconds.",
+                                e, RECONNECT_DELAY)
+                sleep(RECONNECT_DELAY)
+
+    def _dispatch(self, activity):
+        wallet = activity.wallet
+        self._versions[wallet] = max(activity.version, self._versions.get(wallet, 0))
+        for callback in self._watchers + list(self._waiters.pop(wallet, ())):
+            try:
+                callback(activity)
+            except Exception:
+                logging.exception("Error in a callback waiting for %s", activity)
+
+    def version(self, wallet):
+        if wallet not in self._versions:
+            self._versions[wallet] = current_version(self.redis, wallet)
+        return self._versions[wallet]
+
+    def wait(self, wallet, callback):
+        """Has callback called with the next WalletActivity of the wallet."""
+        self._waiters[wallet].add(callback)
+
+    def watch(self, callback):
+        """Has callback called with every WalletActivity, of any wallet, from now on."""
+        self._watchers.append(callback)
+
+    def cancel(self, wallet, callback):
+        waiters = self._waiters.get(wallet)
+        if waiters is not None:
+            waiters.discard(callback)
+            if not waiters:
+                del self._waiters[wallet]
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Analysis of wallets in memory, on their rows loaded into NumPy arrays column by column.
+
+Amounts are int64 ISK cents, times datetime64 and IDs such as typeID, stationID and tag categorical codes,
+so group-by and aggregates run vectorized instead of as one query, or a loop in a template, per figure.
+The columns of a wallet are cached by WalletColumnsCache and extended by the rows sync adds.
+Only rows in the database are loaded, which excludes months archived by evedir.archive.
+
+NumPy is optional: install the extra 'analytics'. Without it HAS_NUMPY is False and nothing here can be used.
+"""
+
+from collections import OrderedDict, namedtuple
+from decimal import Decimal
+from functools import partial
+import logging
+from threading import Thread
+
+from anzu.ioloop import IOLoop
+from sqlalchemy import BigInteger, and_, case, cast, func, select
+
+from evedir.activity import CHANGED
+from evedir.model import WalletJournalEntry, WalletSyncState, WalletTransaction
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['HAS_NUMPY', 'Categorical', 'TransactionColumns', 'JournalColumns', 'WalletColumns', 'WalletColumnsCache',
+           'group_sum', 'group_count', 'daily_sums', 'rolling_mean',
+           'ItemMargin', 'item_margins', 'StationTotal', 'station_totals', 'daily_rolling']
+
+HAS_NUMPY = numpy is not None
+
+ItemMargin = namedtuple('ItemMargin', 'typeID typeName bought spent sold earned margin')
+StationTotal = namedtuple('StationTotal', 'stationID stationName bought sold')
+
+
+def _cents(column):
+    # computed by the database, which has the exact Numeric
+    return cast(func.round(column * 100), BigInteger)
+
+def _isk(cents):
+    return Decimal(int(cents)) / 100
+
+
+class Categorical(object):
+    """Values as codes into categories, the sorted array of distinct values."""
+
+    def __init__(self, values=()):
+        self.categories, self.codes = numpy.unique(numpy.asarray(values, dtype='int64'), return_inverse=True)
+
+    def extend(self, values):
+        values = numpy.asarray(values, dtype='int64')
+        categories = numpy.union1d(self.categories, values)
+        # codes of known values change as new ones are sorted in before them
+        recoded = numpy.searchsorted(categories, self.categories)
+        self.codes = numpy.concatenate([recoded[self.codes], numpy.searchsorted(categories, values)])
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class Columns(object):
+    """
+    The rows of a wallet table, as one array per column, which can be extended by newer rows.
+
+    fields are triples of name, kind and dtype in the order of the columns of query():
+    'value' is an array of dtype, 'category' a Categorical, and 'label' the name of the preceding category
+    as dict by its value. Rows are loaded up to the wallet's high-water mark only, as those above
+    may belong to a synchronization which has not finished yet.
+    """
+    endpoint = None
+    fields = ()
+
+    def __init__(self):
+        self.arrays = {}
+        self.labels = {}
+        for name, kind, dtype in self.fields:
+            if kind == 'value':
+                self.arrays[name] = numpy.zeros(0, dtype=dtype)
+            elif kind == 'category':
+                self.arrays[name] = Categorical()
+            else:
+                self.labels[name] = {}
+        self.high_water_mark = None
+
+    def __getitem__(self, name):
+        """Returns the array of a value column, or the codes of a categorical one."""
+        column = self.arrays[name]
+        return column.codes if isinstance(column, Categorical) else column
+
+    def categories(self, name):
+        return self.arrays[name].categories
+
+    def __len__(self):
+        return len(self.arrays[self.fields[0][0]])
+
+    def _of_wallet(self, table, wallet):
+        owner, ownerID, accountKey = wallet
+        column = table.c.corporationID if owner == 'corp' else table.c.character
+        return [column == ownerID, table.c.accountKey == accountKey]
+
+    def query(self, wallet, low, high):
+        raise NotImplementedError()
+
+    def load(self, bind, wallet):
+        """Adds the rows of the wallet which are new since the last call. Returns their number."""
+        state = WalletSyncState.__table__
+        high = bind.execute(select([state.c.high_water_mark],
+                                   and_(state.c.endpoint == self.endpoint, *self._of_wallet(state, wallet)))).scalar()
+        if high is None or high == self.high_water_mark:
+            return 0
+        rows = bind.execute(self.query(wallet, self.high_water_mark, high)).fetchall()
+        self.high_water_mark = high
+        if rows:
+            self._append(zip(*rows))
+        return len(rows)
+
+    def _append(self, columns):
+        for (name, kind, dtype), values in zip(self.fields, columns):
+            if kind == 'value':
+                self.arrays[name] = numpy.concatenate([self.arrays[name], numpy.asarray(values, dtype=dtype)])
+            elif kind == 'category':
+                self.arrays[name].extend(values)
+                category = values
+            else:
+                self.labels[name].update(zip(category, values))
+
+
+class TransactionColumns(Columns):
+    """wallet_transactions; side is 1 for sales and -1 for purchases, price in cents."""
+    endpoint = 'WalletTransactions'
+    fields = (
+        ('transactionID', 'value', 'int64'),
+        ('datetime', 'value', 'datetime64[s]'),
+        ('typeID', 'category', None),
+        ('typeName', 'label', None),
+        ('stationID', 'category', None),
+        ('stationName', 'label', None),
+        ('tag', 'category', None),
+        ('quantity', 'value', 'int64'),
+        ('price', 'value', 'int64'),
+        ('side', 'value', 'int8'),
+    )
+
+    def query(self, wallet, low, high):
+        wt = WalletTransaction.__table__
+        key = wt.c['transaction']
+        criteria = self._of_wallet(wt, wallet) + [key <= high]
+        if low is not None:
+            criteria.append(key > low)
+        return select([key, wt.c.datetime, wt.c.typeID, wt.c.typeName, wt.c.stationID, wt.c.stationName,
+                       func.coalesce(wt.c.tag, 0), wt.c.quantity, _cents(wt.c.price),
+                       case([(wt.c.transactionType == 'sell', 1)], else_=-1)],
+                      and_(*criteria)).order_by(key)
+
+class JournalColumns(Columns):
+    """wallet_journal, with amount in cents."""
+    endpoint = 'WalletJournal'
+    fields = (
+        ('refID', 'value', 'int64'),
+        ('datetime', 'value', 'datetime64[s]'),
+        ('refTypeID', 'category', None),
+        ('amount', 'value', 'int64'),
+    )
+
+    def query(self, wallet, low, high):
+        journal = WalletJournalEntry.__table__
+        criteria = self._of_wallet(journal, wallet) + [journal.c.refID <= high]
+        if low is not None:
+            criteria.append(journal.c.refID > low)
+        return select([journal.c.refID, journal.c.datetime, journal.c.refTypeID,
+                       func.coalesce(_cents(journal.c.amount), 0)],
+                      and_(*criteria)).order_by(journal.c.refID)
+
+
+WalletColumns = namedtuple('WalletColumns', 'transactions journal')
+
+class WalletColumnsCache(object):
+    """
+    The columns of the wallets used last, at most max_wallets of them, by wallet as (owner, ownerID, accountKey).
+
+    Rows added by sync are loaded whenever a wallet is asked for. Modified rows, such as retagged ones,
+    make the wallet load anew: pass update() to ActivityListener.watch, or call invalidate().
+
+    On the IOLoop, use fetch() instead of get(): the first load of a wallet reads all of its rows.
+    Its callbacks, and all other methods, are run by the IOLoop then.
+    """
+
+    def __init__(self, max_wallets, io_loop=None):
+        self.max_wallets = max_wallets
+        self.io_loop = io_loop or IOLoop.instance()
+        self._wallets = OrderedDict()
+        self._loading = {} # wallet -> callbacks waiting for it
+        self._invalidated = set() # wallets modified while being loaded
+
+    def get(self, bind, wallet):
+        """Returns the WalletColumns of the wallet, up to date."""
+        columns = self._wallets.pop(wallet, None) or WalletColumns(TransactionColumns(), JournalColumns())
+        for table in columns:
+            table.load(bind, wallet)
+        self._keep(wallet, columns)
+        return columns
+
+    def fetch(self, bind, wallet, callback):
+        """
+        Has callback called with the WalletColumns of the wallet, up to date, or with None if loading failed.
+
+        The rows are loaded by a thread of its own, while the IOLoop goes on. Callers asking for a wallet
+        which is being loaded already wait for that load.
+        """
+        if wallet in self._loading:
+            self._loading[wallet].append(callback)
+            return
+        self._loading[wallet] = [callback]
+        # out of the cache while the thread extends them
+        columns = self._wallets.pop(wallet, None) or WalletColumns(TransactionColumns(), JournalColumns())
+        thread = Thread(target=self._load, args=(bind, wallet, columns), name='analytics-load')
+        thread.daemon = True
+        thread.start()
+
+    def _load(self, bind, wallet, columns):
+        try:
+            for table in columns:
+                table.load(bind, wallet)
+        except Exception:
+            logging.exception("Loading the rows of %s failed", wallet)
+            columns = None
+        self.io_loop.add_callback(partial(self._loaded, wallet, columns))
+
+    def _loaded(self, wallet, columns):
+        if columns is not None and wallet not in self._invalidated:
+            self._keep(wallet, columns)
+        self._invalidated.discard(wallet)
+        for callback in self._loading.pop(wallet):
+            try:
+                callback(columns)
+            except Exception:
+                logging.exception("Error in a callback waiting for the rows of %s", wallet)
+
+    def _keep(self, wallet, columns):
+        self._wallets[wallet] = columns
+        while len(self._wallets) > self.max_wallets:
+            self._wallets.popitem(last=False)
+
+    def invalidate(self, wallet):
+        self._wallets.pop(wallet, None)
+        if wallet in self._loading:
+            self._invalidated.add(wallet)
+
+    def update(self, activity):
+        if activity.endpoint == CHANGED:
+            self.invalidate(activity.wallet)
+
+
+# --- primitives
+
+def group_sum(codes, values, groups):
+    """Sums values by their code, of groups 0 to groups - 1. Integers are summed exactly."""
+    sums = numpy.zeros(groups, dtype=values.dtype)
+    if len(codes):
+        order = numpy.argsort(codes, kind='mergesort')
+        codes, values = codes[order], values[order]
+        starts = numpy.flatnonzero(numpy.concatenate([[True], codes[1:] != codes[:-1]]))
+        sums[codes[starts]] = numpy.add.reduceat(values, starts)
+    return sums
+
+def group_count(codes, groups):
+    return numpy.bincount(codes, minlength=groups)
+
+def daily_sums(datetimes, values):
+    """Returns every day from the first to the last of datetimes as datetime64[D], and the sum of values by day."""
+    if not len(datetimes):
+        return numpy.zeros(0, dtype='datetime64[D]'), numpy.zeros(0, dtype=values.dtype)
+    days = datetimes.astype('datetime64[D]')
+    first = days.min()
+    codes = (days - first).astype(numpy.int64)
+    groups = codes.max() + 1
+    return first + numpy.arange(groups), group_sum(codes, values, groups)
+
+def rolling_mean(values, window):
+    """The mean of every value and the window - 1 before it, of fewer at the start."""
+    sums = numpy.cumsum(values, dtype=numpy.float64)
+    sums[window:] = sums[window:] - sums[:-window]
+    return sums / numpy.minimum(numpy.arange(1, len(values) + 1), window)
+
+
+# --- for reports
+
+def item_margins(transactions):
+    """
+    Returns an ItemMargin for every item bought or sold, the most profitable first.
+
+    spent and earned are in ISK, margin is how much higher the average selling price is than the buying price,
+    as fraction of the latter, or None if the item has not been bought and sold.
+    """
+    t = transactions
+    groups = len(t.categories('typeID'))
+    sold = t['side'] > 0
+    volume = t['quantity'] * t['price']
+    quantity = {}
+    total = {}
+    for side, rows in (('sold', sold), ('bought', ~sold)):
+        quantity[side] = group_sum(t['typeID'][rows], t['quantity'][rows], groups)
+        total[side] = group_sum(t['typeID'][rows], volume[rows], groups)
+    margins = []
+    for i in numpy.argsort(total['bought'] - total['sold'], kind='mergesort'):
+        margin = None
+        if quantity['bought'][i] and quantity['sold'][i]:
+            bought_at = float(total['bought'][i]) / quantity['bought'][i]
+            margin = (float(total['sold'][i]) / quantity['sold'][i] - bought_at) / bought_at if bought_at else None
+        typeID = int(t.categories('typeID')[i])
+        margins.append(ItemMargin(typeID, t.labels['typeName'].get(typeID),
+                                  int(quantity['bought'][i]), _isk(total['bought'][i]),
+                                  int(quantity['sold'][i]), _isk(total['sold'][i]), margin))
+    return margins
+
+def station_totals(transactions):
+    """Returns a StationTotal for every station, with the ISK spent and earned there, the highest turnover first."""
+    t = transactions
+    groups = len(t.categories('stationID'))
+    volume = t['quantity'] * t['price']
+    sold = t['side'] > 0
+    bought_at = group_sum(t['stationID'][~sold], volume[~sold], groups)
+    sold_at = group_sum(t['stationID'][sold], volume[sold], groups)
+    totals = []
+    for i in numpy.argsort(-(bought_at + sold_at), kind='mergesort'):
+        stationID = int(t.categories('stationID')[i])
+        totals.append(StationTotal(stationID, t.labels['stationName'].get(stationID),
+                                   _isk(bought_at[i]), _isk(sold_at[i])))
+    return totals
+
+def daily_rolling(journal, window=7):
+    """Returns the days of the journal as date, each with its sum and the rolling mean of the sums, in ISK."""
+    days, sums = daily_sums(journal['datetime'], journal['amount'])
+    means = rolling_mean(sums, window)
+    return [(day.item(), _isk(total), _isk(round(mean))) for day, total, mean in zip(days, sums, means)]
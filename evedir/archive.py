@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Archival of old months of wallet rows into compressed files.
+
+wallet_journal and wallet_transactions need to keep only the rows of the last options.hot_months months
+besides the current one, which is what tagging and the details of reports read. Older months are moved,
+one table and month at a time, into gzipped CSV files below options.file_storage, and recorded
+by WalletArchive. Their daily sums stay in the database, so reports still cover a wallet's whole history.
+
+Archived rows can be read with archived_rows, which opens the files of the months asked for only,
+or be put back into their table with restore.
+"""
+
+import csv
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+import gzip
+import logging
+import os
+
+from anzu.options import options
+from sqlalchemy import Date, DateTime, Integer, Numeric, Unicode, and_, func, select
+
+from evedir.bulk import bulk_writer_for
+from evedir.model import WalletArchive, WalletJournalEntry, WalletTransaction
+
+__all__ = ['ARCHIVED_TABLES', 'hot_since', 'archive_directory', 'archivable_months', 'archive_month',
+           'archived_until', 'archived_rows', 'restore']
+
+# in the order they are archived in; transactions refer to journal entries, not the other way round
+ARCHIVED_TABLES = ['wallet_transactions', 'wallet_journal']
+
+_tables = {
+    'wallet_transactions': WalletTransaction.__table__,
+    'wallet_journal': WalletJournalEntry.__table__,
+}
+
+# written for NULL, which CSV cannot tell from the empty string otherwise
+NULL = '\\N'
+
+# keys per DELETE statement
+KEYS_PER_STATEMENT = 500
+
+ONE_SECOND = timedelta(seconds=1)
+
+
+def _first_of_month(day):
+    return date(day.year, day.month, 1)
+
+def _add_months(month, n):
+    months = month.year * 12 + month.month - 1 + n
+    return date(months // 12, months % 12 + 1, 1)
+
+def _midnight(day):
+    return datetime(day.year, day.month, day.day)
+
+def _as_datetime(value):
+    return value if isinstance(value, datetime) else _midnight(value)
+
+def hot_since(today=None):
+    """Returns the first day of the oldest month which is kept in the database."""
+    return _add_months(_first_of_month(today or datetime.utcnow().date()), -options.hot_months)
+
+def archive_directory():
+    return os.path.join(options.file_storage, 'archive')
+
+def _table(table_name):
+    try:
+        return _tables[table_name]
+    except KeyError:
+        raise ValueError("Only %s are archived, not %s." % (', '.join(ARCHIVED_TABLES), table_name))
+
+def _in_month(table, month):
+    return [table.c.datetime >= _midnight(month), table.c.datetime < _midnight(_add_months(month, 1))]
+
+
+def _format_value(value):
+    if value is None:
+        return NULL
+    if isinstance(value, unicode):
+        return value.encode('UTF-8')
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+def _parse_datetime(value):
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+
+def _parser(column):
+    type_ = column.type
+    if isinstance(type_, DateTime):
+        return _parse_datetime
+    if isinstance(type_, Date):
+        return lambda v: datetime.strptime(v, '%Y-%m-%d').date()
+    if isinstance(type_, Numeric):
+        return Decimal
+    if isinstance(type_, Integer):
+        return int
+    if isinstance(type_, Unicode):
+        return lambda v: v.decode('UTF-8')
+    return str
+
+def _read(path, table):
+    """Yields the rows of an archive file as dicts by column name."""
+    with gzip.open(path, 'rb') as f:
+        reader = csv.reader(f)
+        columns = reader.next()
+        parsers = [_parser(table.c[name]) for name in columns]
+        for record in reader:
+            yield dict((name, None if value == NULL else parse(value))
+                       for name, parse, value in zip(columns, parsers, record))
+
+def _archived(bind, table_name, month):
+    wa = WalletArchive.__table__
+    return bind.execute(wa.select().where(and_(wa.c.table_name == table_name, wa.c.month == month))).first()
+
+
+def archivable_months(table_name, bind=None, today=None):
+    """Returns the first days of all months of the table which have rows but are older than hot_since()."""
+    table = _table(table_name)
+    bind = bind or table.bind
+    oldest = bind.execute(select([func.min(table.c.datetime)])).scalar()
+    months = []
+    if oldest is not None:
+        month, since = _first_of_month(oldest), hot_since(today)
+        while month < since:
+            if bind.execute(select([table.c.datetime], and_(*_in_month(table, month))).limit(1)).first():
+                months.append(month)
+            month = _add_months(month, 1)
+    return months
+
+def archive_month(table_name, month, bind=None, directory=None):
+    """
+    Moves all rows of the table from the month, given by its first day, into its archive file.
+    Returns the number of rows moved.
+
+    Rows of a month which has been archived before are added to its file. The file is complete
+    before any row is deleted, and rows are deleted in the same transaction which records the file.
+    """
+    table = _table(table_name)
+    bind = bind or table.bind
+    directory = directory or archive_directory()
+    key = list(table.primary_key.columns)[0]
+    columns = [column.name for column in table.c]
+
+    existing = _archived(bind, table_name, month)
+    relative = os.path.join(table_name, '%04d-%02d.csv.gz' % (month.year, month.month))
+    path = os.path.join(directory, relative)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    moved, rows = [], 0
+    with gzip.open(path + '.tmp', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        archived_keys = set()
+        if existing is not None:
+            for row in _read(os.path.join(directory, existing.path), table):
+                archived_keys.add(row[key.name])
+                writer.writerow([_format_value(row[name]) for name in columns])
+                rows += 1
+        query = select(list(table.c), and_(*_in_month(table, month))).order_by(key)
+        for row in bind.execute(query):
+            moved.append(row[key])
+            if row[key] not in archived_keys:
+                writer.writerow([_format_value(value) for value in row])
+                rows += 1
+    if not moved:
+        os.remove(path + '.tmp')
+        return 0
+    os.rename(path + '.tmp', path)
+
+    wa = WalletArchive.__table__
+    connection = bind.connect()
+    try:
+        with connection.begin():
+            if existing is None:
+                connection.execute(wa.insert().values(table_name=table_name, month=month, path=unicode(relative),
+                                                      rows=rows))
+            else:
+                connection.execute(wa.update().where(wa.c.id == existing.id).values(rows=rows,
+                                                                                    archived=datetime.utcnow()))
+            for i in range(0, len(moved), KEYS_PER_STATEMENT):
+                connection.execute(table.delete().where(key.in_(moved[i:i + KEYS_PER_STATEMENT])))
+    finally:
+        connection.close()
+    logging.info("Archived %d rows of %s from %s into %s.", len(moved), table_name, month.strftime('%Y-%m'), path)
+    return len(moved)
+
+def archived_until(table_name, bind=None):
+    """Returns the day after the last archived month of the table, or None if nothing has been archived."""
+    wa = WalletArchive.__table__
+    bind = bind or wa.bind
+    month = bind.execute(select([func.max(wa.c.month)], wa.c.table_name == table_name)).scalar()
+    return _add_months(month, 1) if month is not None else None
+
+def archived_rows(table_name, since=None, until=None, where=None, bind=None, directory=None):
+    """
+    Yields the archived rows of the table from since up to, but not including, until (both dates or datetimes),
+    as dicts by column name, ordered by month.
+
+    where is a dict of column names and values the rows must have, such as {'corporationID': ..., 'accountKey': ...}.
+    Only the files of the months in question are read.
+    """
+    table = _table(table_name)
+    wa = WalletArchive.__table__
+    bind = bind or wa.bind
+    directory = directory or archive_directory()
+    criteria = [wa.c.table_name == table_name]
+    if since is not None:
+        since = _as_datetime(since)
+        criteria.append(wa.c.month >= _first_of_month(since))
+    if until is not None:
+        until = _as_datetime(until)
+        # the month of the last second before until
+        criteria.append(wa.c.month <= _first_of_month(until - ONE_SECOND))
+    where = (where or {}).items()
+    for archive in bind.execute(wa.select().where(and_(*criteria)).order_by(wa.c.month)):
+        for row in _read(os.path.join(directory, archive.path), table):
+            if since is not None and row['datetime'] < since or until is not None and row['datetime'] >= until:
+                continue
+            if all(row[name] == value for name, value in where):
+                yield row
+
+def restore(table_name, month, bind=None, directory=None):
+    """
+    Puts the archived rows of the month back into the table, and removes its archive.
+
+    Returns the BulkWriteResult, and the wallets restored as (corporationID, character, accountKey),
+    whose versions have to be bumped for what has been computed from them to be made anew.
+    Restore journal entries before the transactions of the same month, which refer to them.
+    """
+    table = _table(table_name)
+    bind = bind or table.bind
+    directory = directory or archive_directory()
+    existing = _archived(bind, table_name, month)
+    if existing is None:
+        raise ValueError("%s of %s has not been archived." % (table_name, month.strftime('%Y-%m')))
+    path = os.path.join(directory, existing.path)
+    columns = [column.name for column in table.c]
+    rows = list(_read(path, table))
+    result = bulk_writer_for(table, bind).write(columns, [tuple(row[name] for name in columns) for row in rows])
+    wallets = sorted(set((row['corporationID'], row['character'], row['accountKey']) for row in rows))
+    wa = WalletArchive.__table__
+    bind.execute(wa.delete().where(wa.c.id == existing.id))
+    os.remove(path)
+    return result, wallets
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk writing of rows into tables, skipping rows whose primary key is present already.
+
+Every database has its own fastest way of doing that. Writers for them are registered
+in WRITERS by dialect name; use bulk_writer_for to get the right one for a table.
+"""
+
+from collections import namedtuple
+from cStringIO import StringIO
+from datetime import datetime, date
+import logging
+
+from anzu.options import options
+from sqlalchemy import and_, bindparam, func, select
+
+__all__ = ['BulkWriteResult', 'BulkWriter', 'WRITERS', 'register_writer', 'bulk_writer_for', 'key_ranges']
+
+BulkWriteResult = namedtuple('BulkWriteResult', 'inserted skipped')
+
+WRITERS = {}
+
+def register_writer(cls):
+    for dialect_name in cls.dialects:
+        WRITERS[dialect_name] = cls
+    return cls
+
+def bulk_writer_for(table, bind=None, batch_size=None):
+    """Returns the BulkWriter which suits the database of the given table."""
+    bind = bind or table.bind
+    cls = WRITERS.get(bind.dialect.name, BulkWriter)
+    return cls(table, bind, batch_size)
+
+def key_ranges(column, chunk_size, bind=None):
+    """
+    Splits a table into chunks of chunk_size rows by its (integer) key column, for statements
+    which shall not touch all rows at once.
+
+    Yields lists of criteria, one for every chunk, together with the chunk's first key.
+    """
+    bind = bind or column.table.bind
+    low = bind.execute(select([func.min(column)])).scalar()
+    while low is not None:
+        high = bind.execute(select([column], column >= low).order_by(column).offset(chunk_size).limit(1)).scalar()
+        in_chunk = [column >= low]
+        if high is not None:
+            in_chunk.append(column < high)
+        yield low, in_chunk
+        low = high
+
+# by DB-API paramstyle; for 'named' the rows are handed to SQLAlchemy as dicts instead
+PLACEHOLDERS = {
+    'qmark': '?',
+    'format': '%s',
+    'pyformat': '%s',
+}
+
+class BulkWriter(object):
+    """
+    Inserts rows, given as tuples of values for a list of columns, in batches.
+
+    This one works with any database: It asks for the keys present in a batch and inserts the rest.
+    Subclasses replace _write_batch by something faster.
+    """
+    dialects = ()
+
+    def __init__(self, table, bind=None, batch_size=None):
+        self.table = table
+        self.bind = bind or table.bind
+        self.batch_size = batch_size or options.bulk_batch_size
+        self.primary_key = list(table.primary_key.columns)
+        self.preparer = self.bind.dialect.identifier_preparer
+        self._bind_processors = {}
+
+    def write(self, columns, rows):
+        """
+        Writes all rows in one transaction and returns a BulkWriteResult.
+
+        columns are the table's column names the values of every row are for, in that order.
+        """
+        inserted = skipped = 0
+        key_indexes = [columns.index(c.name) for c in self.primary_key]
+        connection = self.bind.connect()
+        transaction = connection.begin()
+        try:
+            self._begin(connection, columns)
+            for start in xrange(0, len(rows), self.batch_size):
+                batch, duplicates = self._unique(key_indexes, rows[start:start + self.batch_size])
+                written = self._write_batch(connection, columns, key_indexes, batch) if batch else 0
+                inserted += written
+                skipped += duplicates + len(batch) - written
+            self._end(connection)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+        logging.debug('Bulk write into %s: %d rows inserted, %d skipped.', self.table.name, inserted, skipped)
+        return BulkWriteResult(inserted, skipped)
+
+    @staticmethod
+    def _unique(key_indexes, rows):
+        """Drops rows whose key appears earlier in the batch. Returns the remaining rows and how many were dropped."""
+        seen = set()
+        unique = []
+        for row in rows:
+            key = tuple(row[i] for i in key_indexes)
+            if key not in seen:
+                seen.add(key)
+                unique.append(row)
+        return unique, len(rows) - len(unique)
+
+    def _begin(self, connection, columns):
+        pass
+
+    def _end(self, connection):
+        pass
+
+    def _insert(self, connection, columns, rows, prefix=''):
+        """Inserts the rows by one executemany, with the placeholders the DB-API driver expects."""
+        paramstyle = self.bind.dialect.paramstyle
+        if paramstyle == 'numeric':
+            placeholders = ', '.join(':%d' % (i + 1) for i in range(len(columns)))
+        elif paramstyle in PLACEHOLDERS:
+            placeholders = ', '.join(PLACEHOLDERS[paramstyle] for c in columns)
+        else:
+            inserter = self.table.insert().prefix_with(prefix) if prefix else self.table.insert()
+            return connection.execute(inserter, [dict(zip(columns, row)) for row in rows]).rowcount
+        statement = 'INSERT %sINTO %s (%s) VALUES (%s)' % (
+            prefix + ' ' if prefix else '', self.preparer.format_table(self.table),
+            ', '.join(self.preparer.quote_identifier(c) for c in columns), placeholders)
+        process = self._bind_processor(tuple(columns))
+        if process:
+            rows = [process(row) for row in rows]
+        return connection.execute(statement, rows).rowcount
+
+    def _bind_processor(self, columns):
+        """
+        Returns a function which applies the columns' type conversions to a row (such as Decimal to float
+        for SQLite), which SQLAlchemy does not do for textual statements; or None if there are none.
+        """
+        try:
+            return self._bind_processors[columns]
+        except KeyError:
+            pass
+        dialect = self.bind.dialect
+        namespace = {}
+        expressions = []
+        for i, name in enumerate(columns):
+            processor = self.table.c[name].type.dialect_impl(dialect).bind_processor(dialect)
+            if processor:
+                namespace['process_%d' % i] = processor
+                expressions.append('process_%d(row[%d])' % (i, i))
+            else:
+                expressions.append('row[%d]' % i)
+        if namespace:
+            exec 'def process(row):\n    return (%s)\n' % ''.join(e + ', ' for e in expressions) in namespace
+        process = self._bind_processors[columns] = namespace.get('process')
+        return process
+
+    def _write_batch(self, connection, columns, key_indexes, rows):
+        """Inserts those rows which are not present yet and returns how many have been inserted."""
+        if len(self.primary_key) == 1:
+            column, i = self.primary_key[0], key_indexes[0]
+            present = set(r[0] for r in connection.execute(select([column], column.in_([row[i] for row in rows]))))
+            missing = [row for row in rows if row[i] not in present]
+        else:
+            query = select(self.primary_key, and_(*[c == bindparam('pk_' + c.name) for c in self.primary_key]))
+            missing = [row for row in rows
+                       if not connection.execute(query, **dict(('pk_' + c.name, row[i])
+                                                               for c, i in zip(self.primary_key, key_indexes))).first()]
+        if missing:
+            self._insert(connection, columns, missing)
+        return len(missing)
+
+
+class IgnoringBulkWriter(BulkWriter):
+    """
+    For databases which skip duplicates on their own, given a prefix to INSERT.
+
+    The rowcount of executemany is the number of rows actually inserted.
+    """
+
+    def _write_batch(self, connection, columns, key_indexes, rows):
+        return self._insert(connection, columns, rows, self.insert_prefix)
+
+@register_writer
+class SQLiteBulkWriter(IgnoringBulkWriter):
+    dialects = ('sqlite', )
+    insert_prefix = 'OR IGNORE'
+
+@register_writer
+class MySQLBulkWriter(IgnoringBulkWriter):
+    dialects = ('mysql', )
+    insert_prefix = 'IGNORE'
+
+
+class StagingBulkWriter(BulkWriter):
+    """
+    For databases with a fast COPY: Batches are copied into a temporary staging table,
+    from which the rows with unknown keys are taken into the table in one statement.
+    """
+    staging_prefix = 'bulk_staging_'
+
+    def __init__(self, table, bind=None, batch_size=None):
+        super(StagingBulkWriter, self).__init__(table, bind, batch_size)
+        self.quoted_table = self.preparer.format_table(table)
+        self.quoted_staging = self.preparer.quote_identifier(self.staging_prefix + table.name)
+
+    def _begin(self, connection, columns):
+        self.quoted_columns = ', '.join(self.preparer.quote_identifier(c) for c in columns)
+        self._create_staging(connection)
+
+    @staticmethod
+    def _format_value(value, quote):
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            value = value.encode('UTF-8')
+        elif isinstance(value, datetime):
+            return value.isoformat(' ')
+        elif isinstance(value, date):
+            return value.isoformat()
+        elif isinstance(value, bool):
+            return 'true' if value else 'false'
+        elif isinstance(value, float):
+            return repr(value)
+        elif not isinstance(value, str):
+            return str(value)
+        return quote(value)
+
+    def _records(self, rows, quote):
+        out = StringIO()
+        for row in rows:
+            out.write(','.join(self._format_value(v, quote) for v in row))
+            out.write('\n')
+        return out.getvalue()
+
+    def _write_batch(self, connection, columns, key_indexes, rows):
+        connection.execute('DELETE FROM %s' % self.quoted_staging)
+        self._copy(connection, rows)
+        return connection.execute(self._take_over_statement()).rowcount
+
+@register_writer
+class PostgreSQLBulkWriter(StagingBulkWriter):
+    dialects = ('postgresql', )
+
+    def _create_staging(self, connection):
+        connection.execute('CREATE TEMPORARY TABLE %s (LIKE %s INCLUDING DEFAULTS) ON COMMIT DROP'
+                           % (self.quoted_staging, self.quoted_table))
+
+    def _copy(self, connection, rows):
+        # empty unquoted fields are NULL, whereas "" is the empty string
+        data = self._records(rows, lambda s: '"%s"' % s.replace('"', '""'))
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV' % (self.quoted_staging, self.quoted_columns),
+                               StringIO(data))
+        finally:
+            cursor.close()
+
+    def _take_over_statement(self):
+        return 'INSERT INTO %s (%s) SELECT %s FROM %s ON CONFLICT DO NOTHING' \
+               % (self.quoted_table, self.quoted_columns, self.quoted_columns, self.quoted_staging)
+
+@register_writer
+class MonetDBBulkWriter(StagingBulkWriter):
+    dialects = ('monetdb', )
+
+    def _create_staging(self, connection):
+        connection.execute('CREATE LOCAL TEMPORARY TABLE %s AS SELECT * FROM %s WITH NO DATA ON COMMIT PRESERVE ROWS'
+                           % (self.quoted_staging, self.quoted_table))
+
+    def _end(self, connection):
+        connection.execute('DROP TABLE %s' % self.quoted_staging)
+
+    def _copy(self, connection, rows):
+        # MonetDB takes the records right after the statement
+        data = self._records(rows, lambda s: '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"'))
+        # straight to the driver, which would take any % in the data for a placeholder
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute("COPY %d RECORDS INTO %s (%s) FROM STDIN USING DELIMITERS ',', '\\n', '\"' NULL AS '';\n%s"
+                           % (len(rows), self.quoted_staging, self.quoted_columns, data))
+        finally:
+            cursor.close()
+
+    def _take_over_statement(self):
+        if len(self.primary_key) == 1:
+            key = self.preparer.quote_identifier(self.primary_key[0].name)
+            condition = '%s NOT IN (SELECT %s FROM %s)' % (key, key, self.quoted_table)
+        else:
+            condition = 'NOT EXISTS (SELECT 1 FROM %s t WHERE %s)' % (self.quoted_table, ' AND '.join(
+                't.%s = %s.%s' % (k, self.quoted_staging, k)
+                for k in (self.preparer.quote_identifier(c.name) for c in self.primary_key)))
+        return 'INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s' \
+               % (self.quoted_table, self.quoted_columns, self.quoted_columns, self.quoted_staging, condition)
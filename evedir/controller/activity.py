@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+from time import time
+
+from anzu.options import options
+from anzu.web import path, authenticated, asynchronous
+
+from evedir.controller.bases import BaseHandler
+
+@path('/activity/(corp)/(\d+)/(100[0-6])')
+@path('/activity/(char)/(\d+)/(1000)')
+class ActivityHandler(BaseHandler):
+    """
+    Long poll for new rows of a wallet: Answers as soon as the wallet's version exceeds the argument 'since',
+    or after activity_poll_timeout seconds with the version unchanged.
+    """
+    wallet = None
+    _timeout = None
+
+    @authenticated
+    @asynchronous
+    def get(self, corc, corc_id, accountKey):
+        listener = self.application.activity
+        self.wallet = (corc, int(corc_id), accountKey)
+        version = listener.version(self.wallet)
+        if version > int(self.get_argument('since', 0)):
+            self._reply(version)
+            return
+        listener.wait(self.wallet, self._on_activity)
+        self._timeout = listener.io_loop.add_timeout(time() + options.activity_poll_timeout, self._on_timeout)
+
+    def _on_activity(self, activity):
+        self.application.activity.io_loop.remove_timeout(self._timeout)
+        self._reply(activity.version, activity)
+
+    def _on_timeout(self):
+        listener = self.application.activity
+        listener.cancel(self.wallet, self._on_activity)
+        self._reply(listener.version(self.wallet))
+
+    def on_connection_close(self):
+        listener = self.application.activity
+        if self.wallet is not None:
+            listener.cancel(self.wallet, self._on_activity)
+        if self._timeout is not None:
+            listener.io_loop.remove_timeout(self._timeout)
+
+    def _reply(self, version, activity=None):
+        reply = {'version': version}
+        if activity is not None:
+            reply.update(endpoint=activity.endpoint, rows=activity.rows, newest=activity.newest)
+        self.set_header('Cache-Control', 'no-cache')
+        self.finish(reply)
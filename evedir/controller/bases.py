@@ -24,8 +24,11 @@ class DatabaseMixin(object):
 
 class EveApiAccessorMixin(object):
 
-    def get_eveapi_for(self, keyID, vCode):
-        api = self.application.eveapi
+    def get_eveapi_for(self, keyID, vCode, nonblocking=False):
+        """
+        With nonblocking=True calls don't stall the IOLoop, but take a callback. See eveapi.AsyncEVEAPIConnection.
+        """
+        api = self.application.eveapi_async if nonblocking else self.application.eveapi
         return api.auth(keyID=keyID, vCode=vCode)
 
 
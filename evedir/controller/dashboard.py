@@ -34,12 +34,19 @@ class KeypairHandler(BaseHandler):
 #        _ = self.locale.translate
 #        errors = []
 
+from functools import partial
+
 from anzu.validators import error_handler, validate
 from anzu import validators
-from anzu.web import HTTPError
-from sqlalchemy import and_, func, exceptions as sql_exc
+from anzu.web import HTTPError, asynchronous
+from sqlalchemy import and_, func, select, exceptions as sql_exc
 
-from evedir.model import WalletJournalEntry, WalletTransaction, DefaultItemTag, WalletTag, ACCOUNT_KEYS
+from evedir import activity
+from evedir.model import WalletTransaction, DefaultItemTag, WalletTag, Toon, ACCOUNT_KEYS
+from evedir.analytics import item_margins
+from evedir.reports import cached_wallet_report
+from evedir.rollups import TRANSACTIONS_BY_DAY
+from evedir.tagging import apply_default_tags
 
 @location('/tagging')
 class TaggingLanding(BaseHandler):
@@ -123,6 +130,7 @@ class AddTagsHelper(BaseHandler):
         deftag = DefaultItemTag(
             user_id = corc_id if corc == 'user' else None,
             corporation_id = corc_id if corc == 'corp' else None,
+            accountKey = accountKey,
             typeID = self.value_for('typeID'),
             tagname = self.value_for('tagname'),
         )
@@ -150,14 +158,16 @@ class AddTagsHelper(BaseHandler):
                  )
         ).first()
         if tag:
-            self.db.query(WalletTransaction).filter(
-                and_(
-                    WalletTransaction.corporation_id == corc_id if corc == 'corp' else WalletTransaction.user_id == corc_id,
-                    WalletTransaction.typeID == deftag.typeID,
-                    WalletTransaction.tag_id == None
-                )
-            ).update({WalletTransaction.tag_id: tag.tag})
-            self.db.commit()
+            criteria = [WalletTransaction.typeID == deftag.typeID, WalletTransaction.accountKey == accountKey]
+            if corc == 'corp':
+                criteria.append(WalletTransaction.corporation_id == corc_id)
+            else:
+                # the user's wallets are those of their characters
+                criteria.append(WalletTransaction.character_id.in_(
+                    select([Toon.characterID], Toon.user_id == corc_id)))
+            if apply_default_tags(corc == 'corp', criteria):
+                for wallet in TRANSACTIONS_BY_DAY.refresh(criteria + [WalletTransaction.tag_id == tag.tag]):
+                    activity.changed(self.application.sync_scheduler.redis, activity.wallet_of(*wallet))
         else:
             self.set_status(410)
             logging.warning('An expected tag has gone away.')
@@ -177,59 +187,29 @@ class ReportsHandler(BaseHandler):
 @path('/report/(corp)/(\d+)/(100[0-6])')
 @path('/report/(char)/(\d+)/(1000)')
 class ReportGenerator(BaseHandler):
+    closed = False
 
     @authenticated
+    @asynchronous
     def get(self, corc, corc_id, accountKey):
-        aio = {}
-        # --- Wallet Transactions
-        is_owner = WalletTransaction.corporation_id == corc_id if corc == 'corp' else WalletTransaction.character_id == corc_id
-
-        # sell
-        ts = self.db.query(WalletTag.tagname, func.sum(WalletTransaction.quantity * WalletTransaction.price)) \
-            .join(WalletTransaction) \
-            .filter(and_(is_owner, WalletTransaction.transactionType == 'sell', WalletTransaction.accountKey == accountKey)) \
-            .group_by(WalletTag.tagname)
-        for tagname, sum in ts:
-            aio[tagname] = {'sell': sum, 'buy': 0}
-
-        # buy
-        tb = self.db.query(WalletTag.tagname, func.sum(WalletTransaction.quantity * WalletTransaction.price)) \
-            .join(WalletTransaction) \
-            .filter(and_(is_owner, WalletTransaction.transactionType == 'buy', WalletTransaction.accountKey == accountKey)) \
-            .group_by(WalletTag.tagname)
-        for tagname, sum in tb:
-            if tagname in aio:
-                aio[tagname]['buy'] = sum
-            else:
-                aio[tagname] = {'sell': 0, 'buy': sum}
-
-        # --- Journal Entries
-        is_owner = WalletJournalEntry.corporation_id == corc_id if corc == 'corp' else WalletJournalEntry.character_id == corc_id
-
-        # 10 --> deposits
-        jd = self.db.query(WalletJournalEntry.ownerName1, func.sum(WalletJournalEntry.amount)) \
-            .filter(and_(is_owner, WalletJournalEntry.refTypeID == 10, WalletJournalEntry.accountKey == accountKey)) \
-            .group_by(WalletJournalEntry.ownerName1)
-        deposits_payouts = [(name, amount) for name, amount in jd]
-
-        # 37 --> payouts
-        jd = self.db.query(WalletJournalEntry.ownerName2, func.sum(WalletJournalEntry.amount)) \
-            .filter(and_(is_owner, WalletJournalEntry.refTypeID == 37, WalletJournalEntry.accountKey == accountKey)) \
-            .group_by(WalletJournalEntry.ownerName2)
-        deposits_payouts += [(name, amount) for name, amount in jd]
-
-        # --- Journal Entries - Details
-        # 10 --> deposits
-        jd = self.db.query(WalletJournalEntry.ownerName1, WalletJournalEntry.amount, WalletJournalEntry.reason, WalletJournalEntry.ownerName2) \
-            .filter(and_(is_owner, WalletJournalEntry.refTypeID == 10, WalletJournalEntry.accountKey == accountKey))
-        deposits_payouts_details = [(name, amount, reason, other) for name, amount, reason, other in jd]
-
-        # 37 --> payouts
-        jd = self.db.query(WalletJournalEntry.ownerName2, WalletJournalEntry.amount, WalletJournalEntry.reason, WalletJournalEntry.argName1) \
-            .filter(and_(is_owner, WalletJournalEntry.refTypeID == 37, WalletJournalEntry.accountKey == accountKey))
-        deposits_payouts_details += [(name, amount, reason, other) for name, amount, reason, other in jd]
+        version, report = cached_wallet_report(self.application.sync_scheduler.redis, self.db,
+                                               corc, int(corc_id), accountKey)
+        render = partial(self._render, '/activity/%s/%s/%s' % (corc, corc_id, accountKey), version, report)
+        if self.application.analytics:
+            # the rows of a wallet are loaded off the IOLoop, which takes a while the first time
+            self.application.analytics.fetch(WalletTransaction.__table__.bind, (corc, int(corc_id), accountKey),
+                                             render)
+        else:
+            render(None)
+
+    def on_connection_close(self):
+        self.closed = True
 
+    def _render(self, activity_url, version, report, columns):
+        if self.closed:
+            return
         self.render('reports/sheet.html',
-                    transactions_by_tag = aio,
-                    deposits_payouts = deposits_payouts,
-                    deposits_payouts_details = deposits_payouts_details)
+                    activity_url = activity_url,
+                    activity_version = version,
+                    item_margins = item_margins(columns.transactions) if columns else None,
+                    **report)
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+from anzu.web import location
+
+from evedir.controller.bases import BaseHandler
+from evedir.metrics import render
+
+@location('/metrics')
+class MetricsHandler(BaseHandler):
+    """
+    Counters and timings of the wallet synchronization, for Prometheus to scrape.
+    """
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(render(self.application.sync_scheduler.redis))
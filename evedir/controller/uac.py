@@ -107,6 +107,7 @@ class RegistrationHandler(BaseHandler):
         'vCode': validators.UnicodeString(not_empty=True, min=56, max=128, strip=True),
     }
 
+    @asynchronous
     @error_handler(get)
     @validate(validators=register_fields)
     def post(self):
@@ -121,11 +122,12 @@ class RegistrationHandler(BaseHandler):
 
         # Does the API key work at all?
         logging.debug('About to fetch data from the EVE API servers.')
-        auth = self.get_eveapi_for(keyID=self.value_for('keyID'), vCode=self.value_for('vCode'))
-        try:
-            keyinfo = auth.account.APIKeyInfo()
-            characters = keyinfo.key.characters
-        except eveapi.Error, e:
+        auth = self.get_eveapi_for(keyID=self.value_for('keyID'), vCode=self.value_for('vCode'), nonblocking=True)
+        auth.account.APIKeyInfo(callback=self.async_callback(self._on_keyinfo, errors))
+
+    def _on_keyinfo(self, errors, keyinfo, e):
+        _ = self.locale.translate
+        if isinstance(e, eveapi.Error):
             self.set_status(400)
             self.request.validation_errors = {
                 'keyID': _("check this"),
@@ -133,6 +135,9 @@ class RegistrationHandler(BaseHandler):
             }
             errors.append(_('Having been presented your API keys, the EVE Online server said: "%s"') % e)
             return self.get(errors=errors)
+        elif e:
+            raise e
+        characters = keyinfo.key.characters
         logging.debug('%d characters are associated with keyID %d.', len(characters), self.value_for('keyID'))
         toon_ids = [int(character.characterID) for character in characters]
 
@@ -182,6 +187,7 @@ class RegistrationHandler(BaseHandler):
                         ))
             logging.debug('About to commit data for new account belonging to "%s".', user.email_address)
             self.db.commit()
+            self.application.sync_scheduler.schedule_keypair(keypair.keyID)
             logging.info('The account has been created! Redirecting user "%s".', user.email_address)
             self.redirect('/login')
         else:
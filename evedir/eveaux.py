@@ -1,52 +1,212 @@
 import logging
+from collections import Counter
+from contextlib import contextmanager
+from time import time
 
-from evedir.model import ACCOUNT_KEYS, WalletJournalEntry, WalletTransaction
+from sqlalchemy import and_
 
-def sync_wallet(keypair, eveapi_ctx):
-    api = eveapi_ctx.auth(keyID=keypair.keyID, vCode=keypair.vCode)
-    is_corpkey = keypair.type == 'Corporation'
+from eveapi import Rowset
+from evedir.model import ACCOUNT_KEYS, WalletJournalEntry, WalletTransaction, WalletSyncState
+from evedir.linking import MARKET_TRANSACTION, link_transactions
+from evedir.metrics import registry as metrics
+from evedir.rollups import JOURNAL_BY_DAY, TRANSACTIONS_BY_DAY
+from evedir.tagging import apply_default_tags
+
+# Rows are inserted while the API response is still being parsed, in batches of this size.
+WALLET_BATCH_SIZE = 500
+
+# How many rows are requested per page. This is the maximum the API permits.
+WALLET_ROW_COUNT = 2560
+
+# model and the rowset's ID column, by API endpoint
+WALLET_ENDPOINTS = {
+    'WalletJournal': (WalletJournalEntry, 'refID'),
+    'WalletTransactions': (WalletTransaction, 'transactionID'),
+}
 
-    if not (keypair.grants_access_to('WalletJournal') and keypair.grants_access_to('WalletTransactions')):
-        logging.debug('Keypair %r does not grant access to wallet. Skipping.', keypair)
-        return
+# daily sums to update, by API endpoint
+WALLET_ROLLUPS = {
+    'WalletJournal': JOURNAL_BY_DAY,
+    'WalletTransactions': TRANSACTIONS_BY_DAY,
+}
 
-    # determine char/corp/wallet combinations
+def grants_wallet_access(keypair):
+    return keypair.grants_access_to('WalletJournal') and keypair.grants_access_to('WalletTransactions')
+
+def wallet_combinations(keypair, api):
+    """
+    Returns the (characterID, accountKey) combinations whose wallets the keypair can read.
+
+    For character and account keys this asks the API for the associated toons.
+    """
     combinations = []
-    if is_corpkey:
+    if keypair.type == 'Corporation':
         for accountKey in ACCOUNT_KEYS:
-            combinations.append({'characterID': keypair.characterID, 'accountKey': accountKey})
+            combinations.append((keypair.characterID, accountKey))
     else:
         # fetch the associated toons
         keyinfo = api.account.APIKeyInfo()
         for character in keyinfo.key.characters:
-            combinations.append({'characterID': int(character.characterID), 'accountKey': ACCOUNT_KEYS[0]})
-
-    # do the magic
-    for params in combinations:
-        params['rowCount'] = 2560
-
-        # journal
-        response = api.corp.WalletJournal(**params) if is_corpkey else api.char.WalletJournal(**params)
-        rows = response.entries if hasattr(response, 'entries') else response.transactions
-        logging.debug('Got %d wallet journal entries for keypair %d, account %s.',
-                      len(rows), keypair.keyID, params['accountKey'])
-        if len(rows) > 0:
-            WalletJournalEntry.bulk_insert(
-                rows,
-                accountKey = params['accountKey'],
-                corporationID = keypair.corporationID if is_corpkey else None,
-                character = params['characterID'] if not is_corpkey else None
-            )
-
-        # transactions
-        response = api.corp.WalletTransactions(**params) if is_corpkey else api.char.WalletTransactions(**params)
-        rows = response.entries if hasattr(response, 'entries') else response.transactions
-        logging.debug('Got %d wallet transactions for keypair %d, account %s.',
-                      len(rows), keypair.keyID, params['accountKey'])
-        if len(rows) > 0:
-            WalletTransaction.bulk_insert(
-                rows,
-                accountKey = params['accountKey'],
-                corporationID = keypair.corporationID if is_corpkey else None,
-                character = params['characterID'] if not is_corpkey else None
-            )
+            combinations.append((int(character.characterID), ACCOUNT_KEYS[0]))
+    return combinations
+
+def sync_wallet_endpoint(db, keypair, api, endpoint, characterID, accountKey, known_ids=None, checkpoint=None,
+                         notify=None):
+    """
+    Fetches the rows of one wallet endpoint ('WalletJournal' or 'WalletTransactions') which are new to us.
+
+    Pages are walked backwards from the newest row until one reaches the stored high-water mark.
+    Without a mark, as on the first import, the full history the API provides is walked.
+    Rows in known_ids, a KnownIDs, are not even sent to the database.
+    After every page its progress is saved to checkpoint, a Checkpoint, and a run which has been
+    interrupted continues from there instead of from the newest row.
+    If rows have been added, notify is called with their number and the newest row's ID.
+
+    Returns the metadata of the first page, which carries 'currentTime' and 'cachedUntil',
+    and a Counter with statistics.
+    """
+    is_corpkey = keypair.type == 'Corporation'
+    model, id_column = WALLET_ENDPOINTS[endpoint]
+    owner = {
+        'accountKey': accountKey,
+        'corporationID': keypair.corporationID if is_corpkey else None,
+        'character': characterID if not is_corpkey else None,
+    }
+    state = db.query(WalletSyncState).filter(and_(
+        WalletSyncState.corporation_id == owner['corporationID'],
+        WalletSyncState.character_id == owner['character'],
+        WalletSyncState.accountKey == accountKey,
+        WalletSyncState.endpoint == endpoint,
+    )).first()
+    high_water_mark = state.high_water_mark if state else None
+
+    wallet = (endpoint, owner['corporationID'], owner['character'], accountKey)
+    id_attribute = getattr(model, id_column)
+    def load_ids(low, high):
+        query = db.query(id_attribute).filter(and_(
+            model.corporation_id == owner['corporationID'],
+            model.character_id == owner['character'],
+            model.accountKey == accountKey,
+            id_attribute >= low,
+        ))
+        if high is not None:
+            query = query.filter(id_attribute < high)
+        return [row[0] for row in query]
+
+    call = getattr(api.corp if is_corpkey else api.char, endpoint)
+    stats = Counter()
+    timings = Counter() # seconds by stage
+    @contextmanager
+    def timer(stage):
+        start = time()
+        try:
+            yield
+        finally:
+            timings[stage] += time() - start
+    def parsed(page):
+        # the batches of a page, which are parsed as they are taken
+        batches = iter(page)
+        while True:
+            with timer('parse'):
+                batch = next(batches, None)
+            if batch is None:
+                return
+            yield batch
+    started = time()
+    first_meta = None
+    newest = high_water_mark
+    fromID = None
+    resumed = checkpoint.load() if checkpoint is not None else {}
+    if 'fromID' in resumed:
+        logging.debug('Resuming %s of keypair %d, account %s, at %d.', endpoint, keypair.keyID, accountKey,
+                      resumed['fromID'])
+        fromID = resumed['fromID']
+        high_water_mark = resumed.get('high_water_mark')
+        newest = resumed.get('newest')
+    while True:
+        params = {'characterID': characterID, 'accountKey': accountKey, 'rowCount': WALLET_ROW_COUNT}
+        if fromID:
+            params['fromID'] = fromID
+        with timer('fetch'):
+            page = call.Stream(batchSize=WALLET_BATCH_SIZE, **params)
+        page_rows = 0
+        oldest = None
+        for batch in parsed(page):
+            ix = batch._cols.index(id_column)
+            ids = [row[ix] for row in batch._rows]
+            page_rows += len(ids)
+            oldest = min(ids) if oldest is None else min(oldest, min(ids))
+            newest = max(ids) if newest is None else max(newest, max(ids))
+            if high_water_mark is not None:
+                batch = Rowset(batch._cols, [row for row in batch._rows if row[ix] > high_water_mark])
+            if batch and known_ids is not None:
+                known = known_ids.known(wallet, [row[ix] for row in batch._rows], load_ids)
+                if known:
+                    batch = Rowset(batch._cols, [row for row in batch._rows if row[ix] not in known])
+                    stats['rows_prefiltered'] += len(known)
+            if batch:
+                with timer('insert'):
+                    written = model.bulk_insert(batch, **owner)
+                stats['rows_new'] += written.inserted
+                stats['rows_skipped'] += written.skipped
+                if known_ids is not None:
+                    known_ids.add(wallet, [row[ix] for row in batch._rows])
+                if endpoint == 'WalletTransactions':
+                    transaction_ids = [row[ix] for row in batch._rows]
+                else:
+                    # the transactions these journal entries are for
+                    ir, ia = batch._cols.index('refTypeID'), batch._cols.index('argName1')
+                    transaction_ids = [int(row[ia]) for row in batch._rows
+                                       if row[ir] == MARKET_TRANSACTION and unicode(row[ia]).isdigit()]
+                if transaction_ids:
+                    of_wallet = [
+                        WalletTransaction.corporation_id == owner['corporationID'] if is_corpkey
+                            else WalletTransaction.character_id == owner['character'],
+                        WalletTransaction.accountKey == accountKey,
+                        WalletTransaction.transactionID.in_(transaction_ids),
+                    ]
+                    with timer('link'):
+                        stats['rows_linked'] += link_transactions(is_corpkey, of_wallet)
+                    if endpoint == 'WalletTransactions':
+                        with timer('tag'):
+                            stats['rows_tagged'] += apply_default_tags(is_corpkey, of_wallet)
+                with timer('rollup'):
+                    WALLET_ROLLUPS[endpoint].refresh([id_attribute.in_([row[ix] for row in batch._rows])])
+        stats['api_calls'] += 1
+        stats['rows_fetched'] += page_rows
+        first_meta = first_meta or page._meta
+
+        if page_rows < WALLET_ROW_COUNT:
+            break # end of history
+        if high_water_mark is not None and oldest <= high_water_mark:
+            break # the rest is stored already
+        fromID = oldest
+        if checkpoint is not None:
+            checkpoint.save(fromID=fromID, newest=newest, high_water_mark=high_water_mark)
+
+    if newest is not None and newest != high_water_mark:
+        if not state:
+            state = WalletSyncState(corporation_id=owner['corporationID'], character_id=owner['character'],
+                                    accountKey=accountKey, endpoint=endpoint)
+            db.add(state)
+        state.high_water_mark = newest
+        db.commit()
+    if checkpoint is not None:
+        checkpoint.clear()
+    if notify is not None and stats['rows_new']:
+        notify(stats['rows_new'], newest)
+
+    timings['total'] = time() - started
+    for stage, seconds in timings.iteritems():
+        metrics.observe('evedir_sync_stage_seconds', seconds, endpoint=endpoint, stage=stage)
+    for name, value in stats.iteritems():
+        metrics.count('evedir_sync_%s_total' % name, value, endpoint=endpoint)
+
+    logging.debug('Synced %s of keypair %d, account %s: %d pages, %d rows, %d of them new, %d known beforehand. '
+                  'Took %.2fs: %.2fs fetching, %.2fs parsing, %.2fs inserting, %.2fs linking, %.2fs tagging, '
+                  '%.2fs summing up.',
+                  endpoint, keypair.keyID, accountKey,
+                  stats['api_calls'], stats['rows_fetched'], stats['rows_new'], stats['rows_prefiltered'],
+                  timings['total'], timings['fetch'], timings['parse'], timings['insert'], timings['link'],
+                  timings['tag'], timings['rollup'])
+    return first_meta, stats
@@ -1,10 +1,12 @@
 import logging
 from multiprocessing import Process as VanillaProcess
 import signal
+import sys
+from time import time
 
 from anzu.options import options
 
-__all__ = ['Process']
+__all__ = ['Process', 'Supervisor']
 
 class Process(VanillaProcess):
 
@@ -18,8 +20,66 @@ class Process(VanillaProcess):
                 logging.exception("Unhandled exception %s (signal is %r)", e, self.exitcode)
                 if options.debug:
                     raise
-                else:
-                    super(Process, self).run()
+                # the Supervisor will start the process again
+                sys.exit(1)
 
     # _bootstrap is not overwritten: we let the useless and harmless error messages be displayed
 
+
+class Supervisor(object):
+    """
+    Keeps co-processes running, starting them again after they have ended unexpectedly.
+
+    A process which ends within stable seconds of its start is started again only after a delay,
+    which doubles with every such crash in a row up to max_delay. check() is to be called periodically,
+    such as by the IOLoop.
+    """
+
+    def __init__(self, base_delay=1, max_delay=300, stable=60):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stable = stable
+        self.stopping = False
+        self._children = [] # dicts of: process, target, args, name, started, crashes, restart_at
+
+    def spawn(self, target, args=(), name=None):
+        child = {'target': target, 'args': args, 'name': name, 'crashes': 0, 'restart_at': None}
+        self._start(child)
+        self._children.append(child)
+
+    def _start(self, child):
+        child['process'] = Process(target=child['target'], args=child['args'], name=child['name'])
+        child['process'].start()
+        child['started'] = time()
+        child['restart_at'] = None
+
+    def check(self):
+        if self.stopping:
+            return
+        now = time()
+        for child in self._children:
+            process = child['process']
+            if process.is_alive():
+                continue
+            if child['restart_at'] is None:
+                if now - child['started'] < self.stable:
+                    child['crashes'] += 1
+                else:
+                    child['crashes'] = 0
+                delay = min(self.base_delay * 2 ** child['crashes'], self.max_delay) if child['crashes'] else 0
+                child['restart_at'] = now + delay
+                logging.warning("Process %s has ended with exit code %r. Starting it again in %d seconds.",
+                                process.name, process.exitcode, delay)
+            if now >= child['restart_at']:
+                self._start(child)
+
+    def stop(self, event, timeout):
+        """Sets the event the processes watch, and terminates those which have not ended after timeout seconds."""
+        self.stopping = True
+        event.set()
+        for child in self._children:
+            process = child['process']
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
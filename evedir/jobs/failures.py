@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import socket
+from random import uniform
+
+from anzu.options import options
+from anzu.httpclient import HTTPError
+
+import eveapi
+
+__all__ = [
+    'AUTHENTICATION', 'ACCESS_MASK', 'FORBIDDEN', 'TRANSIENT', 'OTHER',
+    'classify', 'backoff', 'CircuitBreaker',
+]
+
+# Kinds of failures, see classify().
+AUTHENTICATION = 'authentication'
+ACCESS_MASK = 'access_mask'
+FORBIDDEN = 'forbidden'
+TRANSIENT = 'transient'
+OTHER = 'other'
+
+# EVE API error codes by kind. Codes of 500 and above are transient.
+ERROR_CODES = {
+    # authentication failure; key expired, deleted or a legacy one; account disabled
+    AUTHENTICATION: frozenset([202, 203, 204, 205, 210, 211, 212, 222, 223]),
+    # the key's accessMask does not cover the call
+    ACCESS_MASK: frozenset([200, 221]),
+    # the character lacks roles, left the corporation, or the corporation is a NPC one
+    FORBIDDEN: frozenset([201, 206, 207, 208, 209, 220]),
+}
+
+def classify(e):
+    """
+    Tells what kind of failure the exception stands for:
+
+    AUTHENTICATION  the key will not work again
+    ACCESS_MASK     the key does not grant access to what has been requested
+    FORBIDDEN       the key works, but the character must not see what has been requested
+    TRANSIENT       the API server is having trouble, or could not be reached
+    OTHER           anything else
+    """
+    if isinstance(e, eveapi.Error):
+        try:
+            code = int(e.code)
+        except (TypeError, ValueError):
+            return OTHER
+        for kind, codes in ERROR_CODES.iteritems():
+            if code in codes:
+                return kind
+        return TRANSIENT if code >= 500 else OTHER
+    if isinstance(e, HTTPError):
+        # 599 is what the HTTP client reports for timeouts and refused connections
+        return TRANSIENT if e.code >= 500 or e.code in (408, 429) else OTHER
+    if isinstance(e, (socket.error, IOError)):
+        return TRANSIENT
+    return OTHER
+
+def backoff(failures):
+    """Returns the seconds to wait before the next try, after the given number of consecutive failures."""
+    delay = min(options.sync_backoff_base * 2 ** (failures - 1), options.sync_backoff_max)
+    return delay * uniform(0.8, 1.2)
+
+
+class CircuitBreaker(object):
+    """
+    Stops all processes from calling a host which keeps failing.
+
+    After threshold transient failures within cooldown seconds, the breaker is open for cooldown seconds.
+    The first call after that decides: a failure opens it again right away, a success closes it.
+    """
+    FAILURES = 'evedir:sync:breaker:%s:failures'
+    OPEN = 'evedir:sync:breaker:%s:open'
+    HALF_OPEN = 'evedir:sync:breaker:%s:trial'
+
+    def __init__(self, redis, host, threshold=None, cooldown=None):
+        self.redis = redis
+        self.host = host
+        self.threshold = threshold or options.sync_breaker_threshold
+        self.cooldown = cooldown or options.sync_breaker_cooldown
+
+    def open_for(self):
+        """Returns for how many more seconds calls must not be made, or 0."""
+        ttl = self.redis.ttl(self.OPEN % self.host)
+        return ttl if ttl and ttl > 0 else 0
+
+    def failure(self):
+        host = self.host
+        if self.redis.get(self.HALF_OPEN % host):
+            self._open()
+            return
+        pipe = self.redis.pipeline()
+        pipe.incr(self.FAILURES % host)
+        pipe.expire(self.FAILURES % host, self.cooldown)
+        failures = pipe.execute()[0]
+        if failures >= self.threshold:
+            self._open()
+
+    def success(self):
+        self.redis.delete(self.FAILURES % self.host, self.HALF_OPEN % self.host)
+
+    def _open(self):
+        host = self.host
+        pipe = self.redis.pipeline()
+        pipe.setex(name=self.OPEN % host, value=1, time=self.cooldown)
+        # remembered until the cooldown has passed twice; the first result after the cooldown decides
+        pipe.setex(name=self.HALF_OPEN % host, value=1, time=2 * self.cooldown)
+        pipe.delete(self.FAILURES % host)
+        pipe.execute()
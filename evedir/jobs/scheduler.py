@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from os import getpid
+from random import uniform
+from time import sleep, time
+
+from anzu.options import options
+
+__all__ = ['WorkItem', 'SyncScheduler', 'Checkpoint']
+
+class WorkItem(namedtuple('WorkItem', 'keyID endpoint characterID accountKey')):
+    """
+    Something the synchronization has to fetch from the EVE API: One endpoint of a keypair's wallet.
+
+    The endpoint 'APIKeyInfo' stands for (re-)discovering which wallets a keypair grants access to.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return '%d:%s:%d:%s' % self
+
+    @classmethod
+    def parse(cls, member):
+        keyID, endpoint, characterID, accountKey = member.split(':')
+        return cls(int(keyID), endpoint, int(characterID), accountKey)
+
+    @classmethod
+    def for_keypair(cls, keyID):
+        return cls(keyID, 'APIKeyInfo', 0, '0')
+
+
+# deletes KEYS[1] if its value is ARGV[1], in one step
+DELETE_IF_EQUAL = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# takes the earliest item of the queue KEYS[1] if it is due by ARGV[1], and unless ARGV[2] is empty records it in
+# the hash KEYS[2] as claimed by ARGV[2], in one step; returns {item} then, else {'', due} of the earliest item
+TAKE_DUE = """
+local head = redis.call('zrange', KEYS[1], 0, 0, 'withscores')
+if #head == 0 then
+    return {}
+end
+if tonumber(head[2]) > tonumber(ARGV[1]) then
+    return {'', head[2]}
+end
+redis.call('zrem', KEYS[1], head[1])
+if ARGV[2] ~= '' then
+    redis.call('hset', KEYS[2], head[1], ARGV[2])
+end
+return {head[1]}
+"""
+
+class SyncScheduler(object):
+    """
+    Persistent priority queue of WorkItems, ordered by when they are due.
+
+    The queue is a sorted set in Redis, so it survives restarts and is shared by all processes.
+    Processes waiting in next() are woken up when items are added which are due immediately.
+    The items of every keypair are indexed by a set, from when they are first scheduled until they are removed.
+
+    Items taken from the queue are recorded as claimed by the worker until they are released.
+    Workers prove they are alive by a heartbeat; recover() puts the claims of dead ones back into the queue.
+    """
+    QUEUE = 'evedir:sync:due'
+    WAKEUP = 'evedir:sync:wakeup'
+    KEYPAIR_ITEMS = 'evedir:sync:items:%d'
+    KEYPAIR_LOCK = 'evedir:sync:keypair:%d'
+    WALLET_LOCK = 'evedir:sync:wallet:%s:%d:%s:%s'
+    LOCKS = 'evedir:sync:locked'
+    FAILURES = 'evedir:sync:failures'
+    CLAIMED = 'evedir:sync:claimed'
+    HEARTBEAT = 'evedir:sync:worker:%s'
+    CHECKPOINT = 'evedir:sync:checkpoint:%s'
+
+    def __init__(self, redis, min_interval=None, jitter=None):
+        self.redis = redis
+        self.min_interval = options.sync_min_interval if min_interval is None else min_interval
+        self.jitter = options.sync_jitter if jitter is None else jitter
+        self._delete_if_equal = redis.register_script(DELETE_IF_EQUAL)
+        self._take_due = redis.register_script(TAKE_DUE)
+
+    def schedule(self, item, due):
+        pipe = self.redis.pipeline()
+        # ZADD's argument order differs between versions of redis-py
+        pipe.execute_command('ZADD', self.QUEUE, due, str(item))
+        pipe.sadd(self.KEYPAIR_ITEMS % item.keyID, str(item))
+        pipe.execute()
+        if due <= time():
+            self.wake()
+
+    def schedule_new(self, item, due):
+        """Like schedule, but leaves items alone which are already queued."""
+        if self.redis.zscore(self.QUEUE, str(item)) is None:
+            self.schedule(item, due)
+
+    def schedule_after(self, item, meta):
+        """
+        Queues the item again for when the API will have new data, which is after meta.cachedUntil.
+
+        Returns when that is.
+        """
+        cached_for = meta.cachedUntil - meta.currentTime
+        due = time() + max(cached_for, self.min_interval) + uniform(0, self.jitter)
+        self.schedule(item, due)
+        return due
+
+    def schedule_keypair(self, keyID):
+        """Gets the synchronization of a (newly registered) keypair started right away."""
+        self.schedule(WorkItem.for_keypair(keyID), time())
+
+    def items_of(self, keyID):
+        """Returns the keypair's items, whether they are queued or being worked on."""
+        return [WorkItem.parse(member) for member in self.redis.smembers(self.KEYPAIR_ITEMS % keyID)]
+
+    def remove(self, item):
+        self.redis.zrem(self.QUEUE, str(item))
+        self.redis.srem(self.KEYPAIR_ITEMS % item.keyID, str(item))
+        self.redis.hdel(self.FAILURES, str(item))
+        self.redis.delete(self.CHECKPOINT % str(item))
+
+    def failed(self, item):
+        """Records that the item failed once more in a row, and returns how often it has."""
+        return self.redis.hincrby(self.FAILURES, str(item), 1)
+
+    def succeeded(self, item):
+        self.redis.hdel(self.FAILURES, str(item))
+
+    def lock(self, item, wallet, timeout):
+        """
+        Marks the item's keypair, and its wallet as (owner, ownerID, accountKey, endpoint), as being synchronized
+        by this process, unless another one already does either. Then nothing is marked and False returned.
+
+        A keypair is synchronized by one process at a time, and so is a wallet, which several keypairs can be for.
+        The marks expire after timeout seconds, in case this process dies.
+        """
+        token = self._lock_token(getpid(), item)
+        locks = [self.KEYPAIR_LOCK % item.keyID, self.WALLET_LOCK % wallet]
+        self.redis.hset(self.LOCKS, str(item), ' '.join(locks))
+        for i, lock in enumerate(locks):
+            if not self.redis.set(lock, token, ex=timeout, nx=True):
+                self.unlock(item, locks[:i])
+                return False
+        return True
+
+    def unlock(self, item, locks=None, pid=None):
+        """Removes the marks lock() has set for the item, as far as they are still those of the process."""
+        if locks is None:
+            locks = (self.redis.hget(self.LOCKS, str(item)) or '').split()
+        # the mark may have expired and been set by another process since
+        token = self._lock_token(pid or getpid(), item)
+        for lock in locks:
+            self._delete_if_equal(keys=[lock], args=[token])
+        self.redis.hdel(self.LOCKS, str(item))
+
+    @staticmethod
+    def _lock_token(pid, item):
+        return '%s %s' % (pid, item)
+
+    def claim(self, item, worker):
+        """Records that the worker, a name stable across its restarts, is working on the item."""
+        self.redis.hset(self.CLAIMED, str(item), self._claim(worker))
+
+    @staticmethod
+    def _claim(worker):
+        return '%s %d' % (worker, getpid())
+
+    def release(self, item):
+        self.redis.hdel(self.CLAIMED, str(item))
+
+    def heartbeat(self, worker, timeout):
+        """Marks the worker as alive for the next timeout seconds."""
+        self.redis.setex(name=self.HEARTBEAT % worker, value=getpid(), time=timeout)
+
+    def recover(self, worker=None):
+        """
+        Queues the items again, due immediately, which have been claimed by workers whose heartbeat has stopped.
+
+        Claims of the given worker are recovered regardless, as it is the one which has just been (re)started.
+        Returns the recovered items.
+        """
+        recovered = []
+        for member, owner in self.redis.hgetall(self.CLAIMED).iteritems():
+            name, pid = owner.rsplit(' ', 1)
+            if name != worker and self.redis.exists(self.HEARTBEAT % name):
+                continue
+            # HDEL succeeds only for one of the competing processes
+            if not self.redis.hdel(self.CLAIMED, member):
+                continue
+            item = WorkItem.parse(member)
+            self.unlock(item, pid=pid)
+            self.schedule(item, time())
+            recovered.append(item)
+        return recovered
+
+    def checkpoint(self, item, timeout):
+        return Checkpoint(self.redis, self.CHECKPOINT % str(item), timeout)
+
+    def wake(self):
+        self.redis.rpush(self.WAKEUP, 1)
+        self.redis.ltrim(self.WAKEUP, 0, 15)
+
+    def _wait(self, seconds):
+        if seconds is None:
+            self.redis.blpop(self.WAKEUP, 0)
+        elif seconds >= 1:
+            # BLPOP has a resolution of one second; the rest is slept off in the next round.
+            self.redis.blpop(self.WAKEUP, int(seconds))
+        else:
+            sleep(seconds)
+
+    def next(self, timeout=None, worker=None):
+        """
+        Waits until the earliest item is due, takes it from the queue and returns it.
+
+        If a worker is given, the item is claimed by it in the same step, so it cannot get lost in between.
+        Returns None if no item became due within timeout seconds.
+        """
+        deadline = time() + timeout if timeout is not None else None
+        claim = self._claim(worker) if worker is not None else ''
+        while True:
+            now = time()
+            head = self._take_due(keys=[self.QUEUE, self.CLAIMED], args=[repr(now), claim])
+            if len(head) == 1:
+                return WorkItem.parse(head[0])
+            wait = float(head[1]) - now if head else None
+            if deadline is not None:
+                if now >= deadline:
+                    return None
+                wait = min(wait, deadline - now) if wait is not None else deadline - now
+            self._wait(wait)
+
+
+class Checkpoint(object):
+    """
+    Where the paging through an item's endpoint has got to, so an interrupted run can resume from there.
+
+    Stored as a hash in Redis, which expires after timeout seconds: the API's pages will have moved on by then.
+    """
+
+    def __init__(self, redis, key, timeout):
+        self.redis = redis
+        self.key = key
+        self.timeout = timeout
+
+    def load(self):
+        """Returns the saved state as dict of ints, which is empty if there is none."""
+        return dict((k, int(v)) for k, v in self.redis.hgetall(self.key).iteritems())
+
+    def save(self, **state):
+        """Replaces the saved state by the given ints; those which are None are left out."""
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key)
+        state = dict((k, v) for k, v in state.iteritems() if v is not None)
+        if state:
+            pipe.hmset(self.key, state)
+            pipe.expire(self.key, self.timeout)
+        pipe.execute()
+
+    def clear(self):
+        self.redis.delete(self.key)
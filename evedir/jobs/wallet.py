@@ -1,20 +1,41 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from functools import partial
 import logging
-from time import sleep
+from multiprocessing import current_process
+from threading import Thread
+from time import sleep, time
 from datetime import datetime
 
 from sqlalchemy import exc, or_, and_
 from anzu.options import options
-from anzu.httpclient import HTTPError
 
 import eveapi
-from evedir.model import Keypair
-from evedir.eveaux import sync_wallet
+from evedir import activity
+from evedir.model import DeclarativeBase, Keypair
+from evedir.eveaux import WALLET_ENDPOINTS, sync_wallet_endpoint, wallet_combinations
+from evedir.jobs.failures import AUTHENTICATION, ACCESS_MASK, FORBIDDEN, TRANSIENT, OTHER, \
+                                 classify, backoff, CircuitBreaker
+from evedir.jobs.scheduler import SyncScheduler, WorkItem
+from evedir.knownids import KnownIDs
+from evedir.metrics import registry as metrics
+from evedir.startaux import get_redis
 
 __all__ = ['wallet_synchronization']
 
+# seconds between checks whether the worker shall stop
+STOP_POLL_INTERVAL = 5
+# seconds after which a worker's marks on a keypair and wallet expire; longer than any wallet's sync should take
+LOCK_TIMEOUT = 1800
+# seconds by which items are postponed whose keypair or wallet is being synced by another worker
+BUSY_DELAY = 10
+# seconds between a worker's heartbeats, and after which a worker without one is considered dead
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 60
+# seconds a paging checkpoint is kept; the API's pages will have moved on by then
+CHECKPOINT_TIMEOUT = 6 * 3600
+
 def keypairs_with_wallet_access(db):
     """
     Gets keypairs which enable us to read wallet journal and transactions.
@@ -22,7 +43,7 @@ def keypairs_with_wallet_access(db):
     now = datetime.utcnow()
     key_is_working = and_(
         Keypair.valid == True,
-        or_(Keypair.expires < now, Keypair.expires == None)
+        or_(Keypair.expires > now, Keypair.expires == None)
     )
     key_grants_wallet_access = or_(
         and_(Keypair.type == 'Corporation',
@@ -40,32 +61,169 @@ def keypairs_with_wallet_access(db):
     return keypairs
 
 
-def wallet_synchronization(sessionmaker):
-    logging.info("Wallet synchronization has been started.")
-    eveapi_ctx = eveapi.EVEAPIConnection(cacheHandler=eveapi.RedisEVEAPICacheHandler())
-    db = sessionmaker()
-    sleep(20) # some seconds to get everything started
+def process_item(db, scheduler, eveapi_ctx, item, known_ids=None):
+    """
+    Fetches what the WorkItem stands for, and queues it again for when there will be new data.
+
+    Paging resumes from the item's checkpoint, if an earlier run has left one.
+    New rows are announced to the web server as WalletActivity.
+    A keypair is synchronized by one worker at a time, and so is a wallet, even if several keypairs grant access to it.
+    """
+    keypair = keypairs_with_wallet_access(db).filter(Keypair.keyID == item.keyID).first()
+    if not keypair:
+        logging.info('Keypair %d is gone, invalid or lacks access to the wallet. Dropping %s.', item.keyID, item)
+        scheduler.remove(item)
+        return
+    api = eveapi_ctx.auth(keyID=keypair.keyID, vCode=keypair.vCode)
+
+    if item.endpoint == 'APIKeyInfo':
+        # which wallets are there (now)?
+        items = set()
+        for characterID, accountKey in wallet_combinations(keypair, api):
+            for endpoint in WALLET_ENDPOINTS:
+                items.add(WorkItem(keypair.keyID, endpoint, characterID, accountKey))
+        for stale in set(scheduler.items_of(keypair.keyID)) - items - set([item]):
+            logging.debug('Wallet %s is not accessible anymore.', stale)
+            scheduler.remove(stale)
+        for new in items:
+            scheduler.schedule_new(new, time())
+        scheduler.schedule(item, time() + options.sync_wallets_every * 3600)
+    else:
+        if keypair.type == 'Corporation':
+            owner = ('corp', keypair.corporationID)
+        else:
+            owner = ('char', item.characterID)
+        if not scheduler.lock(item, owner + (item.accountKey, item.endpoint), LOCK_TIMEOUT):
+            logging.debug('The keypair or wallet is being synchronized by another worker. Postponing %s.', item)
+            scheduler.schedule(item, time() + BUSY_DELAY)
+            return
+        try:
+            notify = partial(activity.publish, scheduler.redis, owner[0], owner[1], item.accountKey, item.endpoint)
+            meta, stats = sync_wallet_endpoint(db, keypair, api, item.endpoint, item.characterID, item.accountKey,
+                                               known_ids, scheduler.checkpoint(item, CHECKPOINT_TIMEOUT), notify)
+        finally:
+            scheduler.unlock(item)
+        due = scheduler.schedule_after(item, meta)
+        logging.debug('%s is due again in %d seconds.', item, due - time())
+
+
+def handle_failure(db, scheduler, breaker, item, e):
+    """
+    Deals with the item having failed by exception e, depending on what kind of failure it is:
+
+    The keypair is marked invalid if it will not work anymore, or loses the access bit the API refused.
+    Transient failures are tried again with exponential backoff, and count against the host's circuit breaker.
+    Anything else is tried again in sync_wallets_every hours.
+
+    Returns the kind of failure.
+    """
+    kind = classify(e)
+    metrics.count('evedir_sync_errors_total', endpoint=item.endpoint, error=kind)
+    db.rollback()
 
+    if kind == TRANSIENT:
+        breaker.failure()
+        failures = scheduler.failed(item)
+        delay = backoff(failures)
+        logging.warning('%s failed %d times in a row (%r). Trying again in %d seconds.', item, failures, e, delay)
+        scheduler.schedule(item, time() + delay)
+        return kind
+
+    keypair = db.query(Keypair).get(item.keyID)
+    if kind == AUTHENTICATION and keypair:
+        logging.warning('Keypair %d has been rejected (%r). Marking it invalid.', item.keyID, e)
+        keypair.valid = False
+        db.commit()
+        scheduler.remove(item)
+        for other in scheduler.items_of(item.keyID):
+            scheduler.remove(other)
+            metrics.count('evedir_sync_skipped_total', endpoint=other.endpoint, reason=kind)
+    elif kind == ACCESS_MASK and keypair and item.endpoint in Keypair.ACCESS.get(keypair.type, {}):
+        logging.warning('Keypair %d does not grant access to %s (%r). Removing that from its accessMask.',
+                        item.keyID, item.endpoint, e)
+        keypair.accessMask = keypair.accessMask & ~Keypair.ACCESS[keypair.type][item.endpoint]
+        db.commit()
+        scheduler.remove(item)
+    elif kind in (ACCESS_MASK, FORBIDDEN):
+        # The next discovery of the keypair's wallets queues it again.
+        logging.info('%s is not accessible (%r). Dropping it.', item, e)
+        scheduler.remove(item)
+    else:
+        if isinstance(e, eveapi.Error):
+            logging.warning('%s failed: %r', item, e)
+        else:
+            logging.exception("Unhandled exception %s", e)
+        scheduler.schedule(item, time() + options.sync_wallets_every * 3600)
+    return kind
+
+
+# connection pools inherited from the parent process
+_inherited_pools = []
+
+def heartbeat(scheduler, worker):
+    """Keeps the worker marked alive for as long as this process runs, even while it waits for the API."""
     while True:
-        start = datetime.utcnow()
-        keypairs = keypairs_with_wallet_access(db)
-        logging.info('Wallet synchronization triggered.')
-
-        for keypair in keypairs:
-            try:
-                logging.debug('Syncing wallets of key with keyID=%d', keypair.keyID)
-                sync_wallet(keypair, eveapi_ctx)
-            except HTTPError, e:
-                logging.warning('HTTP Error %r', e)
-            except Exception, e:
-                logging.exception("Unhandled exception %s", e)
-                if options.debug:
-                    raise
-                else:
-                    # do nothing, the service must keep going on
-                    pass
-
-        seconds_passed = (datetime.utcnow() - start).seconds
-        seconds_to_sleep = options.sync_wallets_every * 3600 - seconds_passed
-        logging.info('Wallet synchronization run is complete. Will sleep for %d seconds.', seconds_to_sleep)
-        sleep(seconds_to_sleep)
+        scheduler.heartbeat(worker, HEARTBEAT_TIMEOUT)
+        sleep(HEARTBEAT_INTERVAL)
+
+def wallet_synchronization(sessionmaker, stop=None):
+    """
+    Works off due items of the SyncScheduler until stop, a multiprocessing.Event, is set.
+
+    Any number of processes can run this. Neither a keypair nor a wallet is synchronized by two of them at once.
+    Items the previous run of this process or any dead one has been working on are resumed first.
+    """
+    worker = current_process().name
+    logging.info("Wallet synchronization %s has been started.", worker)
+    # Connections must not be shared with the parent process, which keeps using them; nor closed, which would
+    # end their sessions on the database server. They are kept from being garbage-collected, which closes them.
+    engine = DeclarativeBase.metadata.bind
+    _inherited_pools.append(engine.pool)
+    engine.pool = engine.pool.recreate()
+    eveapi.metrics = metrics
+    eveapi_ctx = eveapi.EVEAPIConnection(cacheHandler=eveapi.TieredEVEAPICacheHandler(eveapi.RedisEVEAPICacheHandler()))
+    db = sessionmaker()
+    scheduler = SyncScheduler(get_redis())
+    known_ids = KnownIDs()
+    breaker = CircuitBreaker(scheduler.redis, eveapi_ctx._host)
+    beat = Thread(target=heartbeat, args=(scheduler, worker), name='%s-heartbeat' % worker)
+    beat.daemon = True
+    beat.start()
+    last_recovery = time()
+    for item in scheduler.recover(worker):
+        logging.info('Resuming %s, which has been interrupted.', item)
+
+    # Keys which are missing from the queue (e.g., it has been lost) are synchronized right away.
+    for keypair in keypairs_with_wallet_access(db):
+        scheduler.schedule_new(WorkItem.for_keypair(keypair.keyID), time())
+
+    while not (stop and stop.is_set()):
+        if time() - last_recovery > HEARTBEAT_TIMEOUT:
+            for item in scheduler.recover():
+                logging.info('Resuming %s, whose worker has died.', item)
+            last_recovery = time()
+        item = scheduler.next(timeout=STOP_POLL_INTERVAL, worker=worker)
+        if item is None:
+            continue
+        wait = breaker.open_for()
+        if wait:
+            logging.debug('Calls to %s are suspended for %d seconds. Postponing %s.', breaker.host, wait, item)
+            metrics.count('evedir_sync_skipped_total', endpoint=item.endpoint, reason='circuit_open')
+            scheduler.schedule(item, time() + wait)
+            scheduler.release(item)
+            continue
+        try:
+            logging.debug('Syncing %s', item)
+            process_item(db, scheduler, eveapi_ctx, item, known_ids)
+            scheduler.succeeded(item)
+            breaker.success()
+        except Exception, e:
+            kind = handle_failure(db, scheduler, breaker, item, e)
+            if kind == OTHER and options.debug:
+                raise
+            # else do nothing, the service must keep going on
+        finally:
+            scheduler.release(item)
+            db.rollback() # ends the transaction, so the next item sees current keypairs
+            metrics.flush(scheduler.redis)
+    logging.info("Wallet synchronization %s has been stopped.", worker)
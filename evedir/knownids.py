@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from anzu.options import options
+
+__all__ = ['KnownIDs']
+
+class KnownIDs(object):
+    """
+    Remembers the IDs (refIDs or transactionIDs) which are stored already, per wallet.
+
+    For every wallet a sorted array of all stored IDs from a lower bound on is kept. It is
+    filled from the database by one range query when IDs below that bound come in.
+    In total up to budget IDs are kept, at 8 bytes each; the least recently used wallets
+    are dropped first, and of a single wallet too large for the budget the oldest IDs.
+    Anything dropped is simply loaded again when needed, so nothing needs to be persisted.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget or options.known_ids_budget
+        self.size = 0
+        self._wallets = OrderedDict() # wallet -> [lower bound, array of IDs]; least recently used first
+
+    def known(self, wallet, ids, load):
+        """
+        Returns the set of those ids which are stored already.
+
+        load(low, high) has to return the stored IDs of the wallet with low <= ID < high,
+        whereby high can be None for no upper bound.
+        """
+        if not ids:
+            return set()
+        lowest = min(ids)
+        entry = self._wallets.pop(wallet, None)
+        if entry is None:
+            entry = [lowest, array('l', sorted(load(lowest, None)))]
+            self.size += len(entry[1])
+        elif lowest < entry[0]:
+            older = array('l', sorted(load(lowest, entry[0])))
+            self.size += len(older)
+            entry = [lowest, older + entry[1]]
+        self._wallets[wallet] = entry
+        # before shrinking, which may drop IDs just loaded
+        stored = entry[1]
+        known = set(i for i in ids if _contains(stored, i))
+        self._shrink()
+        return known
+
+    def add(self, wallet, ids):
+        """Records that the ids have been stored."""
+        entry = self._wallets.get(wallet)
+        if entry is None:
+            return
+        low, stored = entry
+        new = sorted(set(i for i in ids if i >= low and not _contains(stored, i)))
+        if not new:
+            return
+        if not stored or new[0] > stored[-1]:
+            stored.extend(new)
+        else:
+            entry[1] = array('l', sorted(stored.tolist() + new))
+        self.size += len(new)
+        self._shrink()
+
+    def forget(self, wallet):
+        """Drops what is known about the wallet, such as after rows have been deleted."""
+        entry = self._wallets.pop(wallet, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def _shrink(self):
+        while self.size > self.budget and len(self._wallets) > 1:
+            wallet, (low, stored) = self._wallets.popitem(last=False)
+            self.size -= len(stored)
+        if self.size > self.budget:
+            wallet, entry = self._wallets.items()[0]
+            excess = self.size - self.budget
+            entry[1] = entry[1][excess:]
+            self.size -= excess
+            if entry[1]:
+                entry[0] = entry[1][0]
+            else:
+                del self._wallets[wallet]
+
+def _contains(stored, i):
+    ix = bisect_left(stored, i)
+    return ix < len(stored) and stored[ix] == i
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Links wallet transactions to the journal entries which booked them (journalTransactionID).
+"""
+
+from sqlalchemy import String, and_, cast, func, select
+
+from evedir.bulk import key_ranges
+from evedir.model import WalletJournalEntry, WalletTransaction
+
+__all__ = ['MARKET_TRANSACTION', 'link_transactions', 'link_all_transactions']
+
+# refTypeID of journal entries of market transactions; their argName1 is the transactionID
+MARKET_TRANSACTION = 2
+
+def journal_link_update(owned_by_corporation, criteria):
+    """
+    Returns an UPDATE which sets journalTransactionID of unlinked transactions matching all criteria
+    to the refID of the same wallet's journal entry for them.
+    """
+    wt = WalletTransaction.__table__
+    journal = WalletJournalEntry.__table__
+    if owned_by_corporation:
+        is_owned = wt.c.corporationID != None
+        same_wallet = journal.c.corporationID == wt.c.corporationID
+    else:
+        is_owned = wt.c.character != None
+        same_wallet = journal.c.character == wt.c.character
+    refID = select([func.min(journal.c.refID)], and_(
+        journal.c.refTypeID == MARKET_TRANSACTION,
+        journal.c.argName1 == cast(wt.c.transaction, String),
+        journal.c.accountKey == wt.c.accountKey,
+        same_wallet,
+    )).correlate(wt).as_scalar()
+    # Transactions whose journal entry is not there (yet) are left alone.
+    return wt.update() \
+        .where(and_(wt.c.journalTransactionID == None, is_owned, refID != None, *criteria)) \
+        .values(journalTransactionID=refID)
+
+def link_transactions(owned_by_corporation, criteria, bind=None):
+    """
+    Links the unlinked transactions of corporations or characters which match all criteria.
+
+    Returns how many have been linked.
+    """
+    bind = bind or WalletTransaction.__table__.bind
+    return bind.execute(journal_link_update(owned_by_corporation, criteria)).rowcount
+
+def link_all_transactions(chunk_size, bind=None):
+    """
+    Links all unlinked transactions, in chunks of chunk_size transactions.
+
+    Yields the first transactionID of every chunk done and how many transactions have been linked in it.
+    """
+    bind = bind or WalletTransaction.__table__.bind
+    for low, in_chunk in key_ranges(WalletTransaction.__table__.c.transaction, chunk_size, bind):
+        yield low, link_transactions(True, in_chunk, bind) + link_transactions(False, in_chunk, bind)
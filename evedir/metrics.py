@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Counters and latency histograms of the wallet synchronization.
+
+Every process records into its own Metrics, which are added up in Redis on flush().
+render() formats what has been collected by all processes in Prometheus' text format.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import re
+from time import time
+
+__all__ = ['Metrics', 'registry', 'render']
+
+# upper bounds of the histograms' buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+COUNTERS = 'evedir:metrics:counters'
+HISTOGRAMS = 'evedir:metrics:histograms'
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').encode('UTF-8')
+
+def _series(name, labels, extra=()):
+    """Returns the name of a time series in Prometheus' notation, such as: name{label="value"}"""
+    pairs = sorted(labels.iteritems()) + list(extra)
+    if not pairs:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs))
+
+
+class Metrics(object):
+    """
+    Counters and histograms of one process, kept until they are flushed to Redis.
+
+    Both are identified by a name and labels, given as keyword arguments.
+    """
+
+    def __init__(self):
+        self._counters = defaultdict(float)
+        self._histograms = defaultdict(float)
+
+    def count(self, name, value=1, **labels):
+        self._counters[_series(name, labels)] += value
+
+    def observe(self, name, seconds, **labels):
+        """Records a duration into the histogram; its buckets are cumulative."""
+        histograms = self._histograms
+        for bound in BUCKETS:
+            # buckets are exported even while empty, as Prometheus expects all of them
+            histograms[_series(name + '_bucket', labels, [('le', repr(bound))])] += 1 if seconds <= bound else 0
+        histograms[_series(name + '_bucket', labels, [('le', '+Inf')])] += 1
+        histograms[_series(name + '_sum', labels)] += seconds
+        histograms[_series(name + '_count', labels)] += 1
+
+    @contextmanager
+    def timed(self, name, **labels):
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(name, time() - start, **labels)
+
+    def flush(self, redis):
+        """Adds everything recorded since the last flush to the totals in Redis."""
+        if not self._counters and not self._histograms:
+            return
+        pipe = redis.pipeline(transaction=False)
+        for key, values in ((COUNTERS, self._counters), (HISTOGRAMS, self._histograms)):
+            for series, value in values.iteritems():
+                pipe.hincrbyfloat(key, series, value)
+        pipe.execute()
+        self._counters.clear()
+        self._histograms.clear()
+
+# the Metrics of this process
+registry = Metrics()
+
+def _metric_name(series, histogram):
+    name = series.split('{', 1)[0]
+    if histogram:
+        for suffix in ('_bucket', '_count', '_sum'):
+            if name.endswith(suffix):
+                return name[:-len(suffix)]
+    return name
+
+_bucket_bound = re.compile(r'[{,]le="([^"]*)"')
+
+def _sort_key(item):
+    # buckets in ascending order of their bounds, +Inf last
+    series, value = item
+    match = _bucket_bound.search(series)
+    if not match:
+        return (series, 0)
+    le = match.group(1)
+    return (series[:match.start()], float('inf') if le == '+Inf' else float(le))
+
+def _format(value):
+    value = float(value)
+    return '%d' % value if value.is_integer() else repr(value)
+
+def render(redis):
+    """Returns the totals of all processes in Prometheus' text exposition format."""
+    lines = []
+    for key, kind in ((COUNTERS, 'counter'), (HISTOGRAMS, 'histogram')):
+        by_name = defaultdict(list)
+        for series, value in redis.hgetall(key).iteritems():
+            by_name[_metric_name(series, kind == 'histogram')].append((series, value))
+        for name in sorted(by_name):
+            lines.append('# TYPE %s %s' % (name, kind))
+            for series, value in sorted(by_name[name], key=_sort_key):
+                lines.append('%s %s' % (series, _format(value)))
+    return '\n'.join(lines) + '\n'
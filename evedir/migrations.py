@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Changes to the schema of existing databases, which create_all() does not make.
+
+create_all() only creates missing tables. Anything else, such as indexes added to existing tables,
+is done by a migration. Migrations are applied once and in the order they have been registered;
+those applied are recorded in the table 'schema_migrations'.
+
+Migrations have to be idempotent: new databases get the current schema by create_all(),
+and all migrations are recorded as applied after they found nothing to do.
+"""
+
+import logging
+
+from sqlalchemy import Column, Index, Integer, MetaData, Table
+from sqlalchemy.engine.reflection import Inspector
+
+from evedir.model import SchemaMigration
+
+__all__ = ['migration', 'migrate', 'MIGRATIONS']
+
+# pairs of name and function, which gets a connection inside a transaction
+MIGRATIONS = []
+
+def migration(name):
+    """Registers the decorated function as migration."""
+    def register(func):
+        MIGRATIONS.append((name, func))
+        return func
+    return register
+
+def migrate(bind):
+    """Applies all migrations which have not been applied to the database yet. Returns their names."""
+    table = SchemaMigration.__table__
+    table.create(bind, checkfirst=True)
+    applied = set(row[0] for row in bind.execute(table.select().with_only_columns([table.c.name])))
+    done = []
+    for name, func in MIGRATIONS:
+        if name in applied:
+            continue
+        logging.info("Applying migration %s.", name)
+        connection = bind.connect()
+        try:
+            with connection.begin():
+                func(connection)
+                connection.execute(table.insert().values(name=name))
+        finally:
+            connection.close()
+        done.append(name)
+    return done
+
+def _has_index(connection, table_name, index_name):
+    return index_name in [ix['name'] for ix in Inspector.from_engine(connection).get_indexes(table_name)]
+
+def _index(table_name, index_name, columns):
+    # a stand-in of the table, with just the columns of the index; their types do not matter
+    table = Table(table_name, MetaData(), *[Column(column, Integer) for column in columns])
+    return Index(index_name, *table.c)
+
+def create_index(connection, table_name, index_name, *columns):
+    """Creates the index unless the table has one of that name already."""
+    if not _has_index(connection, table_name, index_name):
+        _index(table_name, index_name, columns).create(connection)
+
+def drop_index(connection, table_name, index_name):
+    """Drops the index of the table, if there is one of that name."""
+    if _has_index(connection, table_name, index_name):
+        _index(table_name, index_name, ['unused']).drop(connection)
+
+
+@migration('0001_wallet_journal_reftype_argname')
+def journal_index_for_linking(connection):
+    create_index(connection, 'wallet_journal', 'ix_wallet_journal_reftype_argname', 'refTypeID', 'argName1')
+
+@migration('0002_covering_wallet_indexes')
+def covering_wallet_indexes(connection):
+    # These have been declared as Index('stationID', 'transactionType'), which names the index
+    # after the first column and covers the second only.
+    drop_index(connection, 'wallet_transactions', 'stationID')
+    drop_index(connection, 'wallet_transactions', 'typeID')
+    create_index(connection, 'wallet_transactions', 'ix_wallet_transactions_station_type',
+                 'stationID', 'transactionType')
+    create_index(connection, 'wallet_transactions', 'ix_wallet_transactions_item_type',
+                 'typeID', 'transactionType')
+    for owner in ('corporation', 'character'):
+        column = 'corporationID' if owner == 'corporation' else 'character'
+        create_index(connection, 'wallet_transactions', 'ix_wallet_transactions_%s_tag' % owner,
+                     column, 'accountKey', 'transactionType', 'tag')
+        create_index(connection, 'wallet_journal', 'ix_wallet_journal_%s_reftype' % owner,
+                     column, 'accountKey', 'refTypeID')
+        for table_name in ('wallet_transactions_daily', 'wallet_journal_daily'):
+            create_index(connection, table_name, 'ix_%s_%s' % (table_name, owner), column, 'accountKey', 'day')
+    # its leading column corporationID made it useless for characters
+    for table_name in ('wallet_transactions_daily', 'wallet_journal_daily'):
+        drop_index(connection, table_name, 'ix_%s_owner' % table_name)
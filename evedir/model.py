@@ -9,15 +9,20 @@ import logging
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, synonym
-from sqlalchemy import BigInteger, Boolean, Column, DateTime, Enum, ForeignKey, Integer, Index, Numeric, \
+from sqlalchemy import BigInteger, Boolean, Column, Date, DateTime, Enum, ForeignKey, Integer, Index, Numeric, \
                        String, Unicode, UniqueConstraint
 
+from eveapi import Rowset
+from evedir.bulk import bulk_writer_for
+from evedir.metrics import registry as metrics
+
 DeclarativeBase = declarative_base()
 
 __all__ = [
     'DeclarativeBase', 'User', 'Keypair', 'Toon', 'Corporation',
     'ACCOUNT_KEYS', 'WalletJournalEntry', 'WalletTransaction',
-    'DefaultItemTag', 'WalletTag',
+    'DefaultItemTag', 'WalletTag', 'WalletSyncState',
+    'WalletTransactionRollup', 'WalletJournalRollup', 'SchemaMigration', 'WalletArchive',
 ]
 
 class User(DeclarativeBase):
@@ -161,6 +166,13 @@ class WalletJournalEntry(DeclarativeBase):
 #    __table_args__ = (
 #        UniqueConstraint('datetime', 'ownerID1', 'ownerID2', 'RefTypeID',),
 #    )
+    __table_args__ = (
+        # for linking transactions to their entries
+        Index('ix_wallet_journal_reftype_argname', 'refTypeID', 'argName1'),
+        # for the details of reports
+        Index('ix_wallet_journal_corporation_reftype', 'corporationID', 'accountKey', 'refTypeID'),
+        Index('ix_wallet_journal_character_reftype', 'character', 'accountKey', 'refTypeID'),
+    )
     __conversions__ = {
         'date': ('datetime', lambda v: datetime.fromtimestamp(v)),
         'reason': ('reason', lambda v: WalletJournalEntry.fix_reason_field(v)),
@@ -216,8 +228,11 @@ class WalletTransaction(DeclarativeBase):
     """
     __tablename__ = 'wallet_transactions'
     __table_args__ = (
-        Index('stationID', 'transactionType'),
-        Index('typeID', 'transactionType'),
+        Index('ix_wallet_transactions_station_type', 'stationID', 'transactionType'),
+        Index('ix_wallet_transactions_item_type', 'typeID', 'transactionType'),
+        # for tagging and anything else filtering by the wallet
+        Index('ix_wallet_transactions_corporation_tag', 'corporationID', 'accountKey', 'transactionType', 'tag'),
+        Index('ix_wallet_transactions_character_tag', 'character', 'accountKey', 'transactionType', 'tag'),
     )
     __conversions__ = {
         'transactionID': ('transaction', ),
@@ -324,33 +339,186 @@ class WalletTag(DeclarativeBase):
     wallet_transactions     = relationship("WalletTransaction", backref="tag")
 
 
+class WalletSyncState(DeclarativeBase):
+    """
+    How far a wallet's journal or transactions have been synchronized.
+
+    The high-water mark is the newest refID or transactionID stored, respectively.
+    """
+    __tablename__ = 'wallet_sync_state'
+    __table_args__ = (
+        UniqueConstraint('corporationID', 'character', 'accountKey', 'endpoint'),
+    )
+
+    id                  = Column(Integer, autoincrement=True, primary_key=True)
+    # owner
+    corporation_id      = Column('corporationID', BigInteger,
+                                 ForeignKey('corporations.corporationID', onupdate='CASCADE', ondelete='CASCADE'),
+                                 nullable=True, index=True)
+    character_id        = Column('character', BigInteger,
+                                 ForeignKey('characters.character', onupdate='CASCADE', ondelete='CASCADE'),
+                                 nullable=True, index=True)
+    accountKey          = Column(Enum(*ACCOUNT_KEYS), default=ACCOUNT_KEYS[0], nullable=False)
+    endpoint            = Column(Enum('WalletJournal', 'WalletTransactions'), nullable=False)
+
+    high_water_mark     = Column(BigInteger, nullable=False)
+    updated             = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class WalletTransactionRollup(DeclarativeBase):
+    """
+    Sums of a wallet's transactions per day, tag and transactionType, which reports are made of.
+
+    Kept up to date by evedir.rollups.
+    """
+    __tablename__ = 'wallet_transactions_daily'
+    __table_args__ = (
+        Index('ix_wallet_transactions_daily_corporation', 'corporationID', 'accountKey', 'day'),
+        Index('ix_wallet_transactions_daily_character', 'character', 'accountKey', 'day'),
+    )
+
+    id                  = Column(Integer, autoincrement=True, primary_key=True)
+    # owner
+    corporation_id      = Column('corporationID', BigInteger,
+                                 ForeignKey('corporations.corporationID', onupdate='CASCADE', ondelete='CASCADE'),
+                                 nullable=True)
+    character_id        = Column('character', BigInteger,
+                                 ForeignKey('characters.character', onupdate='CASCADE', ondelete='CASCADE'),
+                                 nullable=True)
+    accountKey          = Column(Enum(*ACCOUNT_KEYS), default=ACCOUNT_KEYS[0], nullable=False)
+
+    day                 = Column(Date, nullable=False)
+    tag_id              = Column('tag', Integer,
+                                 ForeignKey('wallet_tag.tag', onupdate='CASCADE', ondelete='SET NULL'),
+                                 nullable=True, index=True)
+    transactionType     = Column(Enum('buy', 'sell'), nullable=False)
+
+    transactions        = Column(Integer, nullable=False)
+    quantity            = Column(BigInteger, nullable=False)
+    amount              = Column(Numeric(precision=30, scale=2), nullable=False) # sum of quantity * price
+
+
+class WalletJournalRollup(DeclarativeBase):
+    """
+    Sums of a wallet's journal entries per day, refTypeID and counterparty, which reports are made of.
+
+    Kept up to date by evedir.rollups.
+    """
+    __tablename__ = 'wallet_journal_daily'
+    __table_args__ = (
+        Index('ix_wallet_journal_daily_corporation', 'corporationID', 'accountKey', 'day'),
+        Index('ix_wallet_journal_daily_character', 'character', 'accountKey', 'day'),
+    )
+
+    id                  = Column(Integer, autoincrement=True, primary_key=True)
+    # owner
+    corporation_id      = Column('corporationID', BigInteger,
+                                 ForeignKey('corporations.corporationID', onupdate='CASCADE', ondelete='CASCADE'),
+                                 nullable=True)
+    character_id        = Column('character', BigInteger,
+                                 ForeignKey('characters.character', onupdate='CASCADE', ondelete='CASCADE'),
+                                 nullable=True)
+    accountKey          = Column(Enum(*ACCOUNT_KEYS), default=ACCOUNT_KEYS[0], nullable=False)
+
+    day                 = Column(Date, nullable=False)
+    refTypeID           = Column(Integer, nullable=False)
+    counterparty        = Column(Unicode(128), nullable=False) # see evedir.rollups.COUNTERPARTY_IS_SECOND_OWNER
+
+    entries             = Column(Integer, nullable=False)
+    amount              = Column(Numeric(precision=30, scale=2), nullable=True)
+
+
+class SchemaMigration(DeclarativeBase):
+    """
+    A change to the schema of existing databases which has been applied, see evedir.migrations.
+    """
+    __tablename__ = 'schema_migrations'
+
+    name                = Column(String(64), primary_key=True)
+    applied             = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class WalletArchive(DeclarativeBase):
+    """
+    A month of a wallet table whose rows have been moved into a compressed file, see evedir.archive.
+    """
+    __tablename__ = 'wallet_archives'
+    __table_args__ = (
+        UniqueConstraint('table_name', 'month'),
+    )
+
+    id                  = Column(Integer, autoincrement=True, primary_key=True)
+    table_name          = Column(String(64), nullable=False)
+    month               = Column(Date, nullable=False) # its first day
+    path                = Column(Unicode(255), nullable=False) # relative to the archive's directory
+    rows                = Column(Integer, nullable=False)
+    archived            = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+
+_row_converters = {}
+
+def row_converter(cls, cols, common_keys):
+    """
+    Returns a function which converts a raw row with the given cols into a tuple of values,
+    prefixed by the tuple of common values it gets passed; and the table's column names
+    of the common values and of the whole tuple.
+
+    The function is compiled once per model, cols and common_keys.
+    """
+    key = (cls, cols, common_keys)
+    try:
+        return _row_converters[key]
+    except KeyError:
+        pass
+
+    namespace = {}
+    targets = []
+    expressions = []
+    for i, colname in enumerate(cols):
+        value = "(None if row[%d] == '' else row[%d])" % (i, i)
+        if colname in cls.__conversions__:
+            converter = cls.__conversions__[colname]
+            targets.append(converter[0])
+            if len(converter) >= 2:
+                namespace['convert_%d' % i] = converter[1]
+                value = 'convert_%d(%s)' % (i, value)
+        elif hasattr(cls, colname):
+            targets.append(colname)
+        else:
+            logging.debug("Column %s is not part of model %r.", colname, cls)
+            continue
+        expressions.append(value)
+    source = 'def convert(row, common):\n    return common + (%s)\n' % ''.join(e + ', ' for e in expressions)
+    exec source in namespace
+
+    # columns of the row win over common values of the same name
+    common_columns = [k for k in common_keys if k not in targets]
+    _row_converters[key] = converter = (namespace['convert'], common_columns, common_columns + targets)
+    return converter
+
 def bulk_insert_into(cls, rows, **common_values):
     """
     Meant for bulk.inserting into tables from EVE API calls.
 
     rows is expected to have a list of defined columns as list row._cols.
     __conversions__ converts the names to /table/ names - not member variable names!
+    Rows already present are skipped. Returns a BulkWriteResult.
     """
-    new_entries = []
-    for row in rows:
-        vals = common_values.copy()
-        for colname in row._cols:
-            colvalue = getattr(row, colname)
-            colvalue = colvalue if colvalue != '' else None
-            if colname in cls.__conversions__:
-                converter = cls.__conversions__[colname]
-                if len(converter) >= 2:
-                    vals[converter[0]] = converter[1](colvalue)
-                else:
-                    vals[converter[0]] = colvalue
-            elif hasattr(cls, colname):
-                vals[colname] = colvalue
-            else:
-                logging.debug("Column %s is not part of model %r.", colname, cls)
-        new_entries.append(vals)
-
-    inserter = cls.__table__.insert().prefix_with("OR IGNORE")
-    return inserter.execute(new_entries)
+    if isinstance(rows, Rowset):
+        cols, raw_rows = rows._cols, rows._rows
+    else:
+        rows = list(rows)
+        cols, raw_rows = (rows[0]._cols if rows else []), [row._row for row in rows]
+    table = cls.__table__.name
+    with metrics.timed('evedir_bulk_convert_seconds', table=table):
+        convert, common_columns, columns = row_converter(cls, tuple(cols), tuple(sorted(common_values)))
+        common = tuple(common_values[k] for k in common_columns)
+        converted = [convert(row, common) for row in raw_rows]
+    with metrics.timed('evedir_bulk_write_seconds', table=table):
+        result = bulk_writer_for(cls.__table__).write(columns, converted)
+    metrics.count('evedir_bulk_rows_total', result.inserted, table=table, outcome='inserted')
+    metrics.count('evedir_bulk_rows_total', result.skipped, table=table, outcome='skipped')
+    return result
 
 
 def test_create_tables():
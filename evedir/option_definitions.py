@@ -18,4 +18,18 @@ define("hostname", help="public hostname (including http:// or https://) of this
 
 define("file_storage", default="/var/lib/evedir", help="this directory will be used to store files related to capaigns")
 
-define("sync_wallets_every", default=8, help="hours to wait between wallet synchronization runs")
+define("sync_wallets_every", default=8, help="hours after which the characters of keys are looked up again, and failed wallet synchronizations are retried")
+define("sync_min_interval", default=900, help="seconds to wait at least before fetching the same wallet again", type=int)
+define("sync_jitter", default=120, help="up to this many seconds are randomly added to every wallet's next synchronization", type=int)
+define("sync_workers", default=2, help="number of processes synchronizing wallets in parallel", type=int)
+define("bulk_batch_size", default=1000, help="rows written to the database per statement when storing wallets", type=int)
+define("known_ids_budget", default=1000000, help="how many IDs of stored wallet rows every synchronization process keeps in memory, at 8 bytes each", type=int)
+define("maintenance_chunk_size", default=10000, help="rows a maintenance command processes per statement", type=int)
+define("sync_backoff_base", default=60, help="seconds to wait before retrying a wallet after the API server failed; doubled with every further failure", type=int)
+define("sync_backoff_max", default=4*3600, help="seconds to wait at most before retrying a wallet after the API server failed", type=int)
+define("sync_breaker_threshold", default=10, help="failures of the API server within sync_breaker_cooldown seconds which suspend all calls to it", type=int)
+define("sync_breaker_cooldown", default=300, help="seconds for which calls to a failing API server are suspended", type=int)
+define("activity_poll_timeout", default=60, help="seconds a browser waits for news of its wallet before asking again", type=int)
+define("report_cache_ttl", default=24*3600, help="seconds a report is cached for, unless the wallet changes before", type=int)
+define("hot_months", default=12, help="months of wallet rows kept in the database besides the current one; older ones can be archived", type=int)
+define("analytics_cache_wallets", default=100, help="wallets whose rows the web server keeps in memory for analyses, if NumPy is installed", type=int)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shows how the database executes the queries run most often, and flags those which scan whole tables.
+
+Queries are registered with @hot_query. They are built for a sample wallet found in the database,
+so the plans are those of a populated database. SQLite and PostgreSQL are supported.
+"""
+
+import re
+
+from sqlalchemy import select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from evedir.archive import hot_since
+from evedir.linking import journal_link_update
+from evedir.model import WalletTransaction
+from evedir.reports import report_queries
+from evedir.rollups import ROLLUPS
+from evedir.tagging import default_tag_update
+
+__all__ = ['hot_query', 'HOT_QUERIES', 'sample_wallets', 'explain']
+
+# pairs of name and function, which gets the session and a sample wallet and returns a statement or Query
+HOT_QUERIES = []
+
+def hot_query(name):
+    """Registers the decorated function as builder of a hot query."""
+    def register(func):
+        HOT_QUERIES.append((name, func))
+        return func
+    return register
+
+
+class Explain(Executable, ClauseElement):
+
+    def __init__(self, statement):
+        self.statement = statement
+
+def _process(compiler, statement):
+    sql = compiler.process(statement)
+    # EXPLAIN returns rows, whatever it explains
+    compiler.isinsert = compiler.isupdate = compiler.isdelete = False
+    return sql
+
+@compiles(Explain)
+def _explain(element, compiler, **kw):
+    return 'EXPLAIN %s' % _process(compiler, element.statement)
+
+@compiles(Explain, 'sqlite')
+def _explain_sqlite(element, compiler, **kw):
+    return 'EXPLAIN QUERY PLAN %s' % _process(compiler, element.statement)
+
+# SQLite: 'SCAN TABLE t' or 'SCAN t', but not 'SCAN TABLE t USING INDEX i'
+_sqlite_full_scan = re.compile(r'^SCAN (?:TABLE )?(\w+)(?!.* USING )')
+# PostgreSQL
+_postgresql_full_scan = re.compile(r'Seq Scan on (\w+)')
+
+def explain(statement, bind=None):
+    """
+    Returns the plan of the statement as list of lines, and the tables it reads completely.
+    """
+    if hasattr(statement, 'statement'):
+        statement = statement.statement # of a Query
+    bind = bind or WalletTransaction.__table__.bind
+    dialect = bind.dialect.name
+    if dialect == 'sqlite':
+        lines = [tuple(row)[-1] for row in bind.execute(Explain(statement))] # the detail
+        full_scan = _sqlite_full_scan
+    elif dialect == 'postgresql':
+        lines = [row[0] for row in bind.execute(Explain(statement))]
+        full_scan = _postgresql_full_scan
+    else:
+        raise NotImplementedError("Query plans of %s databases cannot be examined." % dialect)
+    scanned = []
+    for line in lines:
+        match = full_scan.search(line.strip())
+        if match:
+            scanned.append(match.group(1))
+    return lines, scanned
+
+def sample_wallets(bind=None):
+    """Returns a wallet of a corporation and one of a character, as dicts, as far as there are any."""
+    wt = WalletTransaction.__table__
+    bind = bind or wt.bind
+    samples = []
+    for owner, column in (('corp', wt.c.corporationID), ('char', wt.c.character)):
+        row = bind.execute(select([column, wt.c.accountKey, wt.c.typeID], column != None).limit(1)).first()
+        if row:
+            samples.append({'owner': owner, 'ownerID': row[0], 'accountKey': row[1], 'typeID': row[2]})
+    return samples
+
+
+for _part in ('by_tag', 'by_counterparty', 'entries'):
+    def _report_part(db, wallet, part=_part):
+        return report_queries(db, wallet['owner'], wallet['ownerID'], wallet['accountKey'], hot_since())[part]
+    hot_query('report: %s' % _part)(_report_part)
+
+def _of_wallet(wallet):
+    column = WalletTransaction.corporation_id if wallet['owner'] == 'corp' else WalletTransaction.character_id
+    return [column == wallet['ownerID'], WalletTransaction.accountKey == wallet['accountKey']]
+
+@hot_query('tagging: apply default tags')
+def _apply_default_tags(db, wallet):
+    return default_tag_update(wallet['owner'] == 'corp',
+                              _of_wallet(wallet) + [WalletTransaction.typeID == wallet['typeID']])
+
+@hot_query('linking: link transactions')
+def _link_transactions(db, wallet):
+    return journal_link_update(wallet['owner'] == 'corp', _of_wallet(wallet))
+
+@hot_query('rollups: affected days of transactions')
+def _affected_days(db, wallet):
+    return ROLLUPS['transactions'].affected_query(_of_wallet(wallet))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The figures of a wallet's report, and their cache.
+"""
+
+import cPickle as pickle
+from datetime import datetime
+
+from anzu.options import options
+from sqlalchemy import and_, case, func
+
+from evedir.activity import current_version
+from evedir.archive import hot_since
+from evedir.model import WalletJournalEntry, WalletJournalRollup, WalletTag, WalletTransactionRollup
+
+__all__ = ['report_queries', 'wallet_report', 'cached_wallet_report']
+
+REPORT_CACHE = 'evedir:report:%s:%d:%s:%d:%s'
+
+# refTypeIDs of journal entries listed as deposits and payouts, in this order
+DEPOSIT = 10
+PAYOUT = 37
+
+def report_queries(db, owner, ownerID, accountKey, since):
+    """
+    Returns the queries the report of a wallet is made of, by part: 'by_tag', 'by_counterparty' and 'entries'.
+
+    owner is 'corp' or 'char'. The sums cover all days, the listed entries only those from since (a date) on.
+    """
+    # --- Wallet Transactions, from their daily sums
+    rollup = WalletTransactionRollup
+    is_owner = rollup.corporation_id == ownerID if owner == 'corp' else rollup.character_id == ownerID
+    by_tag = db.query(WalletTag.tagname,
+                      func.sum(case([(rollup.transactionType == 'sell', rollup.amount)], else_=0)),
+                      func.sum(case([(rollup.transactionType == 'buy', rollup.amount)], else_=0))) \
+        .join((rollup, rollup.tag_id == WalletTag.tag)) \
+        .filter(and_(is_owner, rollup.accountKey == accountKey)) \
+        .group_by(WalletTag.tagname)
+
+    # --- Journal Entries, from their daily sums by counterparty
+    rollup = WalletJournalRollup
+    is_owner = rollup.corporation_id == ownerID if owner == 'corp' else rollup.character_id == ownerID
+    by_counterparty = db.query(rollup.refTypeID, rollup.counterparty, func.sum(rollup.amount)) \
+        .filter(and_(is_owner, rollup.refTypeID.in_([DEPOSIT, PAYOUT]), rollup.accountKey == accountKey)) \
+        .group_by(rollup.refTypeID, rollup.counterparty)
+
+    # --- Journal Entries - Details
+    journal = WalletJournalEntry
+    is_owner = journal.corporation_id == ownerID if owner == 'corp' else journal.character_id == ownerID
+    entries = db.query(journal.refTypeID, journal.ownerName1, journal.ownerName2, journal.amount, journal.reason,
+                       journal.argName1) \
+        .filter(and_(is_owner, journal.refTypeID.in_([DEPOSIT, PAYOUT]), journal.accountKey == accountKey,
+                     journal.datetime >= datetime(since.year, since.month, since.day)))
+
+    return {
+        'by_tag': by_tag,
+        'by_counterparty': by_counterparty,
+        'entries': entries,
+    }
+
+def wallet_report(db, owner, ownerID, accountKey, since):
+    """
+    Returns the figures of the report of a wallet, as keyword arguments to the template 'reports/sheet.html'.
+
+    owner is 'corp' or 'char'. Every part of the report is read by one query.
+    """
+    queries = report_queries(db, owner, ownerID, accountKey, since)
+    transactions_by_tag = dict((tagname, {'sell': sell, 'buy': buy}) for tagname, sell, buy in queries['by_tag'])
+    deposits_payouts = [(name, amount) for refTypeID, name, amount
+                        in sorted(queries['by_counterparty'], key=lambda r: r[0])]
+    deposits_payouts_details = []
+    for refTypeID, name1, name2, amount, reason, argName1 in sorted(queries['entries'], key=lambda r: r[0]):
+        if refTypeID == DEPOSIT:
+            deposits_payouts_details.append((name1, amount, reason, name2))
+        else:
+            deposits_payouts_details.append((name2, amount, reason, argName1))
+
+    return {
+        'transactions_by_tag': transactions_by_tag,
+        'deposits_payouts': deposits_payouts,
+        'deposits_payouts_details': deposits_payouts_details,
+        'details_since': since,
+    }
+
+def cached_wallet_report(redis, db, owner, ownerID, accountKey):
+    """
+    Like wallet_report of the months kept in the database, but cached by the wallet's version;
+    a report is made only once per version.
+
+    Returns the version, and the figures.
+    """
+    version, since = current_version(redis, (owner, ownerID, accountKey)), hot_since()
+    key = REPORT_CACHE % (owner, ownerID, accountKey, version, since.isoformat())
+    cached = redis.get(key)
+    if cached is not None:
+        return version, pickle.loads(cached)
+    report = wallet_report(db, owner, ownerID, accountKey, since)
+    redis.setex(name=key, value=pickle.dumps(report, pickle.HIGHEST_PROTOCOL), time=options.report_cache_ttl)
+    return version, report
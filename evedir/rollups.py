@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Maintains the daily sums of wallets (WalletTransactionRollup, WalletJournalRollup) reports are made of.
+
+Whenever rows of a wallet are added or change, the sums of the days they fall on are computed anew
+from the rows of these days. That is idempotent, so rows which have been skipped as duplicates
+or refreshed twice do no harm.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import Date, and_, case, func, literal_column, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable, FunctionElement
+
+from evedir.model import WalletJournalEntry, WalletJournalRollup, WalletTransaction, WalletTransactionRollup
+
+__all__ = ['TRANSACTIONS_BY_DAY', 'JOURNAL_BY_DAY', 'ROLLUPS', 'day_of']
+
+# refTypeIDs of journal entries which name the wallet's owner first and the counterparty second,
+# such as withdrawals from a corporation's account; all others name the counterparty first
+COUNTERPARTY_IS_SECOND_OWNER = (37, )
+
+# at most this many days are refreshed by one statement
+DAYS_PER_STATEMENT = 400
+
+ONE_DAY = timedelta(days=1)
+
+
+class day_of(FunctionElement):
+    """The date of a DateTime column."""
+    type = Date()
+    name = 'day_of'
+
+@compiles(day_of)
+def _day_of(element, compiler, **kw):
+    return 'CAST(%s AS DATE)' % compiler.process(element.clauses)
+
+@compiles(day_of, 'sqlite')
+def _day_of_sqlite(element, compiler, **kw):
+    return 'date(%s)' % compiler.process(element.clauses)
+
+def _midnight(day):
+    return datetime(day.year, day.month, day.day)
+
+
+class InsertFromSelect(Executable, ClauseElement):
+    """INSERT INTO table (columns) SELECT ..."""
+    _execution_options = Executable._execution_options.union({'autocommit': True})
+
+    def __init__(self, table, columns, select):
+        self.table = table
+        self.columns = columns
+        self.select = select
+
+@compiles(InsertFromSelect)
+def _insert_from_select(element, compiler, **kw):
+    return 'INSERT INTO %s (%s) %s' % (
+        compiler.process(element.table, asfrom=True),
+        ', '.join(compiler.preparer.quote(name, name) for name in element.columns),
+        compiler.process(element.select),
+    )
+
+
+class Rollup(object):
+    """
+    Sums of a wallet table, grouped by owner, accountKey, day and keys.
+
+    keys and aggregates are pairs of a column name of the rollup table and an expression over the source table.
+    """
+
+    def __init__(self, model, source, keys, aggregates):
+        self.table = model.__table__
+        self.source = source
+        self.keys = keys
+        self.aggregates = aggregates
+
+    def _of_slice(self, table, wallet):
+        corporationID, character, accountKey = wallet
+        return [table.c.corporationID == corporationID, table.c.character == character,
+                table.c.accountKey == accountKey]
+
+    def _source_keys(self):
+        source = self.source
+        return [source.c.corporationID, source.c.character, source.c.accountKey, day_of(source.c.datetime)] \
+               + [expression for name, expression in self.keys]
+
+    def affected_query(self, criteria):
+        source = self.source
+        # labeled, else the day would not be converted into a date
+        return select([source.c.corporationID, source.c.character, source.c.accountKey,
+                       day_of(source.c.datetime).label('day')], and_(*criteria)).distinct()
+
+    def affected(self, criteria, bind):
+        """Returns the days of the rows matching all criteria, by wallet as (corporationID, character, accountKey)."""
+        days = defaultdict(set)
+        for corporationID, character, accountKey, day in bind.execute(self.affected_query(criteria)):
+            days[(corporationID, character, accountKey)].add(day)
+        return days
+
+    def refresh(self, criteria, bind=None):
+        """
+        Computes the sums anew for the days of the rows which match all criteria.
+
+        Returns the wallets whose sums have been refreshed.
+        """
+        bind = bind or self.table.bind
+        affected = self.affected(criteria, bind)
+        for wallet, days in affected.iteritems():
+            days = sorted(days)
+            for i in range(0, len(days), DAYS_PER_STATEMENT):
+                self._rebuild(wallet, days[i:i + DAYS_PER_STATEMENT], bind)
+        return affected.keys()
+
+    def _since(self, wallet, since):
+        # the sums of days before since are kept, as their rows have been archived
+        in_table, in_source = self._of_slice(self.table, wallet), self._of_slice(self.source, wallet)
+        if since is not None:
+            in_table.append(self.table.c.day >= since)
+            in_source.append(self.source.c.datetime >= _midnight(since))
+        return in_table, in_source
+
+    def _rebuild(self, wallet, days, bind, since=None):
+        """Replaces the sums of the wallet, only of the given days unless they are None, and from since on."""
+        table, source = self.table, self.source
+        in_table, in_source = self._since(wallet, since)
+        if days is not None:
+            in_table.append(table.c.day.in_(days))
+            # the range lets the database use the index on datetime
+            in_source += [source.c.datetime >= _midnight(days[0]), source.c.datetime < _midnight(days[-1]) + ONE_DAY,
+                          day_of(source.c.datetime).in_(days)]
+        keys = self._source_keys()
+        query = select(keys + [expression for name, expression in self.aggregates], and_(*in_source)) \
+            .group_by(*keys)
+        columns = ['corporationID', 'character', 'accountKey', 'day'] \
+                  + [name for name, expression in self.keys + self.aggregates]
+        connection = bind.connect()
+        try:
+            with connection.begin():
+                connection.execute(table.delete().where(and_(*in_table)))
+                connection.execute(InsertFromSelect(table, columns, query))
+        finally:
+            connection.close()
+
+    def wallets(self, bind):
+        """Returns all wallets which have rows or sums."""
+        wallets = set()
+        for table in (self.source, self.table):
+            query = select([table.c.corporationID, table.c.character, table.c.accountKey]).distinct()
+            wallets.update(tuple(row) for row in bind.execute(query))
+        return sorted(wallets)
+
+    def rebuild(self, bind=None, since=None):
+        """
+        Computes all sums anew, one wallet at a time, of the days from since on if given.
+        Yields every wallet when it is done.
+        """
+        bind = bind or self.table.bind
+        for wallet in self.wallets(bind):
+            self._rebuild(wallet, None, bind, since)
+            yield wallet
+
+    def check(self, bind=None, since=None):
+        """
+        Compares the sums with the rows they are made of, of the days from since on if given.
+
+        Yields the wallet, the day and keys, and the aggregates computed from the rows
+        and as found in the sums, for every group where they differ.
+        """
+        bind = bind or self.table.bind
+        table = self.table
+        key_names = [name for name, expression in self.keys]
+        aggregate_names = [name for name, expression in self.aggregates]
+        for wallet in self.wallets(bind):
+            in_table, in_source = self._since(wallet, since)
+            keys = self._source_keys()[3:]
+            expected = self._fetch(bind, select([keys[0].label('day')] + keys[1:] + [e for n, e in self.aggregates],
+                                                and_(*in_source)).group_by(*keys))
+            keys = [table.c.day] + [table.c[name] for name in key_names]
+            found = self._fetch(bind, select(keys + [func.sum(table.c[name]) for name in aggregate_names],
+                                             and_(*in_table)).group_by(*keys))
+            for group in sorted(set(expected) | set(found)):
+                if expected.get(group) != found.get(group):
+                    yield wallet, group, expected.get(group), found.get(group)
+
+    def _fetch(self, bind, query):
+        n = 1 + len(self.keys)
+        # sums are compared to the cent, as some databases add up in floating point
+        return dict((tuple(row[:n]), tuple(round(v, 2) if v is not None else None for v in row[n:]))
+                    for row in bind.execute(query))
+
+
+_wt = WalletTransaction.__table__
+TRANSACTIONS_BY_DAY = Rollup(WalletTransactionRollup, _wt,
+    keys=[('tag', _wt.c.tag), ('transactionType', _wt.c.transactionType)],
+    aggregates=[('transactions', func.count()), ('quantity', func.sum(_wt.c.quantity)),
+                ('amount', func.sum(_wt.c.quantity * _wt.c.price))],
+)
+
+_journal = WalletJournalEntry.__table__
+JOURNAL_BY_DAY = Rollup(WalletJournalRollup, _journal,
+    keys=[('refTypeID', _journal.c.refTypeID),
+          # literals, as a GROUP BY with bound parameters does not match the selected column everywhere
+          ('counterparty', case([(_journal.c.refTypeID.in_([literal_column(str(t)) for t in COUNTERPARTY_IS_SECOND_OWNER]),
+                                  _journal.c.ownerName2)],
+                                else_=_journal.c.ownerName1))],
+    aggregates=[('entries', func.count()), ('amount', func.sum(_journal.c.amount))],
+)
+
+ROLLUPS = {
+    'transactions': TRANSACTIONS_BY_DAY,
+    'journal': JOURNAL_BY_DAY,
+}
@@ -9,11 +9,13 @@ import anzu.web
 from anzu.options import options
 import eveapi
 
-from evedir import uimodule
+from evedir import analytics, uimodule
+from evedir.activity import ActivityListener
+from evedir.jobs.scheduler import SyncScheduler
 import evedir.option_definitions
 
 __all__ = [
-    'get_db', 'read_configuration_and_options', 'get_main_application',
+    'get_db', 'get_redis', 'read_configuration_and_options', 'get_main_application',
 ]
 
 def get_db(echo=False):
@@ -23,6 +25,7 @@ def get_db(echo=False):
     from warnings import filterwarnings
 
     from evedir.model import DeclarativeBase
+    from evedir.migrations import migrate
 
     # That conversion is done automatically. Therefore we can ignore the warning:
     filterwarnings('ignore', '^Unicode type received non-unicode bind param value', SAWarning)
@@ -39,6 +42,8 @@ def get_db(echo=False):
     # And, this will crete any missing tables.
     DeclarativeBase.metadata.create_all(engine)
     DeclarativeBase.metadata.bind = engine
+    # Existing tables are brought up to date by migrations.
+    migrate(engine)
 
     # This maps objects to database engines.
     bindings = dict(
@@ -46,6 +51,13 @@ def get_db(echo=False):
     )
     return sessionmaker(binds=bindings)
 
+def get_redis():
+    """
+    Returns a Redis client which shares its connections with the EVE API cache handlers of this process.
+    """
+    from redis import Redis
+    return Redis(connection_pool=eveapi.RedisConnectionPool())
+
 def get_main_application(options):
     settings = {
         "static_path":                  os.path.join(os.path.dirname(__file__), "..", "static"),
@@ -60,19 +72,30 @@ def get_main_application(options):
     }
     application = anzu.web.Application(**settings)
     application._db = get_db()
-    application.eveapi = eveapi.EVEAPIConnection(cacheHandler=eveapi.RedisEVEAPICacheHandler())
+    # The IOLoop must not wait for documents being fetched by the sync process.
+    application.eveapi = eveapi.EVEAPIConnection(cacheHandler=eveapi.TieredEVEAPICacheHandler(eveapi.RedisEVEAPICacheHandler(waitTimeout=0)))
+    application.eveapi_async = eveapi.AsyncEVEAPIConnection(cacheHandler=application.eveapi._handler)
+    application.sync_scheduler = SyncScheduler(get_redis())
+    application.activity = ActivityListener(get_redis())
+    application.analytics = None
+    if analytics.HAS_NUMPY:
+        application.analytics = analytics.WalletColumnsCache(options.analytics_cache_wallets)
+        application.activity.watch(application.analytics.update)
     return application
 
 def read_configuration_and_options(machine_config = "/etc/evedir.conf"):
+    """Returns the command line arguments which are no options."""
     anzu.options.parse_config_file("default.conf")
     try:
         anzu.options.parse_config_file(machine_config)
     except IOError:
         logging.info("%s was not found, running with defaults" % machine_config)
-    anzu.options.parse_command_line()
+    arguments = anzu.options.parse_command_line()
 
     # check for vital options and their values:
 
 #    if not options.public_keyfile or not options.private_keyfile:
 #        logging.exception("You need to set filenames for public and private key.")
 #        sys.exit(3)
+
+    return arguments
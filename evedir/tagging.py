@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Applies the owners' default tags (DefaultItemTag) to their untagged wallet transactions.
+"""
+
+from sqlalchemy import and_, func, select
+
+from evedir.bulk import key_ranges
+from evedir.model import DefaultItemTag, Toon, WalletTag, WalletTransaction
+from evedir.rollups import TRANSACTIONS_BY_DAY
+
+__all__ = ['apply_default_tags', 'retag_transactions']
+
+def default_tag_update(owned_by_corporation, criteria):
+    """
+    Returns an UPDATE which sets the tag of untagged transactions matching all criteria
+    to the tag their owner has chosen as default for the item and account.
+
+    Transactions of corporations are tagged by the corporation's default tags,
+    those of characters by the default tags of the user the character belongs to.
+    The tag is found by a correlated subquery, which unlike UPDATE ... JOIN every database understands.
+    """
+    wt = WalletTransaction.__table__
+    defaults = DefaultItemTag.__table__
+    tags = WalletTag.__table__
+    if owned_by_corporation:
+        is_owned = wt.c.corporationID != None
+        scope = and_(defaults.c.corporationID == wt.c.corporationID,
+                     tags.c.corporationID == defaults.c.corporationID)
+    else:
+        is_owned = wt.c.character != None
+        user = select([Toon.__table__.c.user], Toon.__table__.c.character == wt.c.character).correlate(wt).as_scalar()
+        scope = and_(defaults.c.user == user,
+                     tags.c.user == defaults.c.user)
+    default_tag = select([func.min(tags.c.tag)], and_(
+        defaults.c.typeID == wt.c.typeID,
+        defaults.c.accountKey == wt.c.accountKey,
+        tags.c.tagname == defaults.c.tagname,
+        scope,
+    )).correlate(wt).as_scalar()
+    # Rows without a default tag are left alone instead of being written with NULL again.
+    return wt.update() \
+        .where(and_(wt.c.tag == None, is_owned, default_tag != None, *criteria)) \
+        .values(tag=default_tag)
+
+def apply_default_tags(owned_by_corporation, criteria, bind=None):
+    """
+    Tags the untagged transactions of corporations or characters which match all criteria.
+
+    Returns how many have been tagged.
+    """
+    bind = bind or WalletTransaction.__table__.bind
+    return bind.execute(default_tag_update(owned_by_corporation, criteria)).rowcount
+
+def retag_transactions(chunk_size, bind=None):
+    """
+    Applies default tags to all untagged transactions, in chunks of chunk_size transactions,
+    and updates the daily sums of chunks in which any have been tagged.
+
+    Yields the first transactionID of every chunk done, how many transactions have been tagged in it,
+    and the wallets whose sums have been updated as (corporationID, character, accountKey).
+    """
+    bind = bind or WalletTransaction.__table__.bind
+    for low, in_chunk in key_ranges(WalletTransaction.__table__.c.transaction, chunk_size, bind):
+        tagged = apply_default_tags(True, in_chunk, bind) + apply_default_tags(False, in_chunk, bind)
+        wallets = []
+        if tagged:
+            wallets = TRANSACTIONS_BY_DAY.refresh(in_chunk + [WalletTransaction.__table__.c.tag != None], bind)
+        yield low, tagged, wallets
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of evedir.knownids.
+#
+#   python knownids_test.py
+
+import unittest
+
+from evedir.knownids import KnownIDs
+
+class Wallet(object):
+    # the IDs stored of a wallet, and the range queries made for them
+
+    def __init__(self, ids):
+        self.ids = set(ids)
+        self.loads = []
+
+    def load(self, low, high):
+        self.loads.append((low, high))
+        return [i for i in self.ids if i >= low and (high is None or i < high)]
+
+class KnownIDsTest(unittest.TestCase):
+
+    def test_known(self):
+        wallet = Wallet(range(100, 200, 2))
+        known = KnownIDs(budget=1000)
+        self.assertEqual(known.known('w', [150, 151, 198, 199, 250], wallet.load), set([150, 198]))
+        self.assertEqual(wallet.loads, [(150, None)])
+        self.assertEqual(known.size, 25)
+
+    def test_no_ids(self):
+        wallet = Wallet([1])
+        known = KnownIDs(budget=1000)
+        self.assertEqual(known.known('w', [], wallet.load), set())
+        self.assertEqual(wallet.loads, [])
+
+    def test_older(self):
+        wallet = Wallet(range(100, 200))
+        known = KnownIDs(budget=1000)
+        known.known('w', [150], wallet.load)
+        self.assertEqual(known.known('w', [120, 160], wallet.load), set([120, 160]))
+        # only the IDs below those loaded before are asked for
+        self.assertEqual(wallet.loads, [(150, None), (120, 150)])
+        self.assertEqual(known.known('w', [130, 199, 200], wallet.load), set([130, 199]))
+        self.assertEqual(len(wallet.loads), 2)
+        self.assertEqual(known.size, 80)
+
+    def test_add(self):
+        wallet = Wallet(range(100, 110))
+        known = KnownIDs(budget=1000)
+        self.assertEqual(known.known('w', [105, 120], wallet.load), set([105]))
+        known.add('w', [120, 121, 105, 90])
+        # 105 is known already, and 90 below the lower bound, under which nothing is kept
+        self.assertEqual(known.size, 7)
+        known.add('w', [108, 111])
+        self.assertEqual(known.known('w', [111, 112, 120, 121], wallet.load), set([111, 120, 121]))
+        self.assertEqual(len(wallet.loads), 1)
+        self.assertEqual(known.size, 8)
+        # nothing is known of other wallets before they are loaded
+        known.add('v', [1, 2])
+        self.assertEqual(known.size, 8)
+
+    def test_wallets_apart(self):
+        a, b = Wallet([1, 2, 3]), Wallet([3, 4])
+        known = KnownIDs(budget=1000)
+        self.assertEqual(known.known('a', [3, 4], a.load), set([3]))
+        self.assertEqual(known.known('b', [3, 4], b.load), set([3, 4]))
+
+    def test_forget(self):
+        wallet = Wallet(range(10))
+        known = KnownIDs(budget=1000)
+        known.known('w', [5], wallet.load)
+        wallet.ids.discard(7)
+        known.forget('w')
+        self.assertEqual(known.size, 0)
+        self.assertEqual(known.known('w', [5, 7], wallet.load), set([5]))
+        self.assertEqual(len(wallet.loads), 2)
+
+    def test_least_recently_used_dropped(self):
+        wallets = dict((name, Wallet(range(10))) for name in 'abc')
+        known = KnownIDs(budget=25)
+        for name in 'abac':
+            known.known(name, [0], wallets[name].load)
+        self.assertEqual(known.size, 20)
+        self.assertEqual(sorted(known._wallets), ['a', 'c'])
+        known.known('b', [0], wallets['b'].load)
+        self.assertEqual(len(wallets['b'].loads), 2)
+
+    def test_oldest_dropped(self):
+        wallet = Wallet(range(100))
+        known = KnownIDs(budget=30)
+        self.assertEqual(known.known('w', [50, 99], wallet.load), set([50, 99]))
+        self.assertEqual(known.size, 30)
+        self.assertEqual(known._wallets['w'][0], 70)
+        # the IDs dropped are loaded again when needed
+        self.assertEqual(known.known('w', [60], wallet.load), set([60]))
+        self.assertEqual(wallet.loads[-1], (60, 70))
+        self.assertTrue(known.size <= 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Maintenance tasks on the stored wallets, run by an operator:
+#
+#   evedir-maintenance [--options] <command>
+#
+# Commands:
+#   retag       applies default tags to all untagged wallet transactions
+#   link        links all wallet transactions to their journal entries
+#   rebuild     computes the daily sums of all wallets anew, of 'transactions' or 'journal' only if given
+#   check       compares the daily sums with the wallets' rows, exits with 1 if they differ
+#   explain     shows the query plans of the hot queries, exits with 1 if any reads a whole table
+#   archive     moves the wallet rows of all months older than --hot_months into files below --file_storage
+#   restore     puts an archived month back into the database, given as <wallet_journal|wallet_transactions> YYYY-MM
+
+from datetime import datetime
+import logging
+import sys
+
+from anzu.options import options, enable_pretty_logging
+from sqlalchemy.orm import Session
+
+import evedir.option_definitions
+from evedir import activity
+from evedir.archive import ARCHIVED_TABLES, archivable_months, archive_month, archived_until, \
+                           restore as restore_month
+from evedir.startaux import get_db, get_redis, read_configuration_and_options
+from evedir.linking import link_all_transactions
+from evedir.queryplans import HOT_QUERIES, explain as explain_query, sample_wallets
+from evedir.rollups import ROLLUPS
+from evedir.tagging import retag_transactions
+
+__all__ = ['main', ]
+
+def _changed(wallets):
+    # cached reports of these wallets are outdated, and pages showing them get reloaded
+    redis = get_redis()
+    for wallet in wallets:
+        activity.changed(redis, activity.wallet_of(*wallet))
+
+def retag():
+    tagged = 0
+    for first_transactionID, tagged_in_chunk, wallets in retag_transactions(options.maintenance_chunk_size):
+        tagged += tagged_in_chunk
+        _changed(wallets)
+        logging.info("Tagged %d transactions from %d on.", tagged_in_chunk, first_transactionID)
+    logging.info("Tagged %d transactions in total.", tagged)
+
+def link():
+    linked = 0
+    for first_transactionID, linked_in_chunk in link_all_transactions(options.maintenance_chunk_size):
+        linked += linked_in_chunk
+        logging.info("Linked %d transactions from %d on.", linked_in_chunk, first_transactionID)
+    logging.info("Linked %d transactions in total.", linked)
+
+def _rollups(which):
+    if which is None:
+        return sorted(ROLLUPS.items())
+    if which not in ROLLUPS:
+        print "Daily sums are kept of: %s" % ', '.join(sorted(ROLLUPS))
+        sys.exit(2)
+    return [(which, ROLLUPS[which])]
+
+def rebuild(which=None):
+    for name, rollup in _rollups(which):
+        for corporationID, character, accountKey in rollup.rebuild(since=archived_until(rollup.source.name)):
+            _changed([(corporationID, character, accountKey)])
+            logging.info("Rebuilt the daily sums of %s of corporation %s, character %s, account %s.",
+                         name, corporationID, character, accountKey)
+
+def check(which=None):
+    differences = 0
+    for name, rollup in _rollups(which):
+        for wallet, group, expected, found in rollup.check(since=archived_until(rollup.source.name)):
+            differences += 1
+            logging.warning("Daily sums of %s of %r differ at %r: %r from the rows, but %r stored.",
+                            name, wallet, group, expected, found)
+    logging.info("Found %d differences.", differences)
+    if differences:
+        sys.exit(1)
+
+def explain():
+    db = Session() # only builds the queries
+    wallets = sample_wallets()
+    if not wallets:
+        logging.warning("There are no wallet transactions. Plans of an empty database tell nothing.")
+        sys.exit(2)
+    full_scans = 0
+    for wallet in wallets:
+        for name, build in HOT_QUERIES:
+            lines, scanned = explain_query(build(db, wallet))
+            print "--- %s, of %s %s, account %s" % (name, wallet['owner'], wallet['ownerID'], wallet['accountKey'])
+            for line in lines:
+                print "    %s" % line
+            for table in scanned:
+                full_scans += 1
+                print "!!! reads all of %s" % table
+    logging.info("Found %d full table scans.", full_scans)
+    if full_scans:
+        sys.exit(1)
+
+def archive():
+    moved = 0
+    for table_name in ARCHIVED_TABLES:
+        for month in archivable_months(table_name):
+            moved += archive_month(table_name, month)
+    logging.info("Archived %d rows in total.", moved)
+
+def restore(table_name=None, month=None):
+    if table_name not in ARCHIVED_TABLES or month is None:
+        print "Usage: %s restore <%s> YYYY-MM" % (sys.argv[0], '|'.join(ARCHIVED_TABLES))
+        sys.exit(2)
+    result, wallets = restore_month(table_name, datetime.strptime(month, '%Y-%m').date())
+    _changed(wallets)
+    logging.info("Restored %d rows of %s from %s, skipped %d present already.",
+                 result.inserted, table_name, month, result.skipped)
+
+COMMANDS = {
+    'retag': retag,
+    'link': link,
+    'rebuild': rebuild,
+    'check': check,
+    'explain': explain,
+    'archive': archive,
+    'restore': restore,
+}
+
+def main():
+    enable_pretty_logging()
+    arguments = read_configuration_and_options()
+    if not arguments or arguments[0] not in COMMANDS:
+        print "Usage: %s [--options] <%s>" % (sys.argv[0], '|'.join(sorted(COMMANDS)))
+        sys.exit(2)
+    get_db()
+    COMMANDS[arguments[0]](*arguments[1:])
+
+if __name__ == "__main__":
+    main()
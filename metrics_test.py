@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of evedir.metrics, against fakeredis.
+#
+#   python metrics_test.py
+
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from evedir.metrics import BUCKETS, Metrics, render
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+
+    def test_counters(self):
+        for process in range(2):
+            metrics = Metrics()
+            metrics.count('evedir_rows_total', 3, table='wallet_journal')
+            metrics.count('evedir_rows_total', table='wallet_transactions')
+            metrics.flush(self.redis)
+        self.assertEqual(render(self.redis), '\n'.join([
+            '# TYPE evedir_rows_total counter',
+            'evedir_rows_total{table="wallet_journal"} 6',
+            'evedir_rows_total{table="wallet_transactions"} 2',
+        ]) + '\n')
+
+    def test_histogram(self):
+        metrics = Metrics()
+        metrics.observe('evedir_stage_seconds', 0.2, stage='fetch')
+        metrics.observe('evedir_stage_seconds', 100, stage='fetch')
+        metrics.flush(self.redis)
+        lines = render(self.redis).splitlines()
+        self.assertEqual(lines[0], '# TYPE evedir_stage_seconds histogram')
+        buckets = [line for line in lines if '_bucket' in line]
+        # cumulative, in ascending order of their bounds
+        self.assertEqual(len(buckets), len(BUCKETS) + 1)
+        self.assertEqual(buckets[0], 'evedir_stage_seconds_bucket{stage="fetch",le="0.005"} 0')
+        self.assertTrue('evedir_stage_seconds_bucket{stage="fetch",le="0.25"} 1' in buckets)
+        self.assertEqual(buckets[-2], 'evedir_stage_seconds_bucket{stage="fetch",le="60.0"} 1')
+        self.assertEqual(buckets[-1], 'evedir_stage_seconds_bucket{stage="fetch",le="+Inf"} 2')
+        self.assertTrue('evedir_stage_seconds_count{stage="fetch"} 2' in lines)
+        self.assertTrue('evedir_stage_seconds_sum{stage="fetch"} 100.2' in lines)
+
+    def test_timed(self):
+        metrics = Metrics()
+        try:
+            with metrics.timed('evedir_stage_seconds', stage='insert'):
+                raise ValueError()
+        except ValueError:
+            pass
+        metrics.flush(self.redis)
+        self.assertTrue('evedir_stage_seconds_count{stage="insert"} 1' in render(self.redis).splitlines())
+
+    def test_flushed_once(self):
+        metrics = Metrics()
+        metrics.count('evedir_rows_total')
+        metrics.flush(self.redis)
+        metrics.flush(self.redis)
+        self.assertEqual(render(self.redis).splitlines()[1], 'evedir_rows_total 1')
+
+    def test_escaped(self):
+        metrics = Metrics()
+        metrics.count('evedir_errors_total', reason=u'"quoted"\n\xfc')
+        metrics.flush(self.redis)
+        self.assertEqual(render(self.redis).splitlines()[1],
+                         'evedir_errors_total{reason="\\"quoted\\"\\n\xc3\xbc"} 1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of the conversion of API rows into wallet rows, on an in-memory SQLite database.
+#
+#   python model_test.py
+
+from datetime import datetime
+from decimal import Decimal
+import unittest
+
+from sqlalchemy import create_engine
+
+from eveapi import ParseXML
+import evedir.option_definitions
+from evedir.model import DeclarativeBase, WalletJournalEntry, WalletTransaction, bulk_insert_into, row_converter
+
+TRANSACTIONS = """<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2011-06-01 10:00:00</currentTime>
+  <result>
+    <rowset name="transactions" key="transactionID" columns="transactionDateTime,transactionID,quantity,typeName,typeID,price,clientID,clientName,characterID,characterName,stationID,stationName,transactionType,transactionFor,journalTransactionID,clientTypeID">
+      <row transactionDateTime="2011-05-01 12:00:00" transactionID="1309776438" quantity="3" typeName="Tritanium" typeID="34" price="5.01" clientID="90000001" clientName="Some Client" characterID="90000000" characterName="Some Pilot" stationID="60003760" stationName="Jita IV - Moon 4" transactionType="sell" transactionFor="corporation" journalTransactionID="1000000002" clientTypeID="1373" />
+      <row transactionDateTime="2011-05-01 12:05:00" transactionID="1309776439" quantity="1" typeName="" typeID="35" price="10" clientID="90000001" clientName="Some Client" characterID="90000000" characterName="Some Pilot" stationID="60003760" stationName="Jita IV - Moon 4" transactionType="buy" transactionFor="corporation" journalTransactionID="" clientTypeID="1373" />
+    </rowset>
+  </result>
+  <cachedUntil>2011-06-01 10:30:00</cachedUntil>
+</eveapi>"""
+
+OWNER = {'corporationID': 1000125, 'character': None, 'accountKey': '1000'}
+
+
+class RowConverterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rowset = ParseXML(TRANSACTIONS).transactions
+
+    def converter(self, common_keys=('accountKey', 'character', 'corporationID')):
+        return row_converter(WalletTransaction, tuple(self.rowset._cols), common_keys)
+
+    def test_columns(self):
+        convert, common_columns, columns = self.converter()
+        self.assertEqual(common_columns, ['accountKey', 'character', 'corporationID'])
+        # renamed by __conversions__, and clientTypeID left out as the table has no such column
+        self.assertEqual(columns, common_columns + [
+            'datetime', 'transaction', 'quantity', 'typeName', 'typeID', 'price', 'clientID', 'clientName',
+            'executorID', 'executorName', 'stationID', 'stationName', 'transactionType', 'transactionFor',
+            'journalTransactionID'])
+
+    def test_values(self):
+        convert, common_columns, columns = self.converter()
+        common = tuple(OWNER[k] for k in common_columns)
+        first, second = [dict(zip(columns, convert(row, common))) for row in self.rowset._rows]
+        self.assertEqual(first['datetime'], datetime.fromtimestamp(self.rowset[0].transactionDateTime))
+        self.assertEqual(first['transaction'], 1309776438)
+        self.assertEqual(first['corporationID'], 1000125)
+        self.assertEqual(first['executorName'], u'Some Pilot')
+        self.assertEqual(first['price'], 5.01)
+        self.assertEqual(first['journalTransactionID'], 1000000002)
+        # empty strings are NULL
+        self.assertEqual(second['typeName'], None)
+        self.assertEqual(second['journalTransactionID'], None)
+
+    def test_common_overridden(self):
+        # columns of the rows win over common values of the same name
+        convert, common_columns, columns = self.converter(('accountKey', 'stationID'))
+        self.assertEqual(common_columns, ['accountKey'])
+        self.assertEqual(columns.count('stationID'), 1)
+
+    def test_compiled_once(self):
+        self.assertTrue(self.converter() is self.converter())
+        self.assertFalse(self.converter() is self.converter(('accountKey', )))
+
+    def test_journal(self):
+        cols = ('date', 'refID', 'reason', 'taxAmount')
+        convert, common_columns, columns = row_converter(WalletJournalEntry, cols, ())
+        self.assertEqual(columns, ['datetime', 'refID', 'reason', 'taxAmount'])
+        row = convert([1304251200, 1000000000, u' DESC: "foo" ', u''], ())
+        self.assertEqual(row, (datetime.fromtimestamp(1304251200), 1000000000, u'DESC: foo', None))
+
+
+class BulkInsertTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bind = DeclarativeBase.metadata.bind
+        DeclarativeBase.metadata.bind = engine = create_engine('sqlite://')
+        DeclarativeBase.metadata.create_all(engine)
+
+    def tearDown(self):
+        DeclarativeBase.metadata.bind = self.bind
+
+    def test_insert(self):
+        rowset = ParseXML(TRANSACTIONS).transactions
+        self.assertEqual(tuple(bulk_insert_into(WalletTransaction, rowset, **OWNER)), (2, 0))
+        self.assertEqual(tuple(WalletTransaction.bulk_insert(list(rowset), **OWNER)), (0, 2))
+        table = WalletTransaction.__table__
+        rows = table.bind.execute(table.select().order_by(table.c['transaction'])).fetchall()
+        self.assertEqual([(row.corporationID, row.character, row.accountKey) for row in rows],
+                         [(1000125, None, '1000')] * 2)
+        self.assertEqual([row.executorID for row in rows], [90000000] * 2)
+        self.assertEqual(rows[1].price, Decimal(10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of evedir.rollups on an in-memory SQLite database.
+#
+#   python rollups_test.py
+
+from datetime import date, datetime
+from decimal import Decimal
+import unittest
+
+from sqlalchemy import and_, create_engine, select
+
+from evedir.model import DeclarativeBase
+from evedir.rollups import JOURNAL_BY_DAY, TRANSACTIONS_BY_DAY
+
+CORPORATION = (1000125, None, '1000')
+CHARACTER = (None, 90000000, '1000')
+
+def _transaction(transactionID, wallet, day, quantity=2, price='10.25', transactionType='sell', tag=None):
+    corporationID, character, accountKey = wallet
+    return {'transaction': transactionID, 'corporationID': corporationID, 'character': character,
+            'accountKey': accountKey, 'datetime': datetime(2011, 5, day, 12, transactionID % 60),
+            'quantity': quantity, 'typeName': u'Tritanium', 'typeID': 34, 'price': Decimal(price),
+            'clientID': 90000001, 'clientName': u'Client', 'stationID': 60003760, 'stationName': u'Jita',
+            'transactionType': transactionType, 'transactionFor': 'corporation',
+            'executorID': 90000000, 'executorName': u'Pilot', 'tag': tag}
+
+def _entry(refID, wallet, day, amount, refTypeID=10):
+    corporationID, character, accountKey = wallet
+    return {'refID': refID, 'corporationID': corporationID, 'character': character, 'accountKey': accountKey,
+            'datetime': datetime(2011, 5, day, 23, 59, 59), 'refTypeID': refTypeID,
+            'ownerName1': u'First', 'ownerID1': 1, 'ownerName2': u'Second', 'ownerID2': 2,
+            'argName1': None, 'argID1': 0, 'amount': Decimal(amount)}
+
+class RollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        DeclarativeBase.metadata.create_all(self.engine)
+        self.transactions = TRANSACTIONS_BY_DAY.source
+        self.journal = JOURNAL_BY_DAY.source
+        self.engine.execute(self.transactions.insert(), [
+            _transaction(1, CORPORATION, 1),
+            _transaction(2, CORPORATION, 1, quantity=3, price='0.50'),
+            _transaction(3, CORPORATION, 1, transactionType='buy'),
+            _transaction(4, CORPORATION, 2),
+            _transaction(5, CHARACTER, 1),
+        ])
+        self.engine.execute(self.journal.insert(), [
+            _entry(1, CORPORATION, 1, '100.10'),
+            _entry(2, CORPORATION, 1, '-0.10'),
+            _entry(3, CORPORATION, 1, '5', refTypeID=37),
+            _entry(4, CHARACTER, 2, '1'),
+        ])
+
+    def refresh_all(self):
+        TRANSACTIONS_BY_DAY.refresh([self.transactions.c['transaction'] > 0], self.engine)
+        JOURNAL_BY_DAY.refresh([self.journal.c.refID > 0], self.engine)
+
+    def sums(self, rollup, wallet, *columns):
+        table = rollup.table
+        query = select([table.c.day] + [table.c[name] for name in columns],
+                       and_(*rollup._of_slice(table, wallet))).order_by(table.c.day, *[table.c[n] for n in columns])
+        return [tuple(row) for row in self.engine.execute(query)]
+
+    def test_refresh(self):
+        wallets = TRANSACTIONS_BY_DAY.refresh([self.transactions.c['transaction'] > 0], self.engine)
+        self.assertEqual(sorted(wallets), sorted([CORPORATION, CHARACTER]))
+        self.assertEqual(self.sums(TRANSACTIONS_BY_DAY, CORPORATION, 'transactionType', 'transactions', 'quantity'),
+                         [(date(2011, 5, 1), 'buy', 1, 2), (date(2011, 5, 1), 'sell', 2, 5),
+                          (date(2011, 5, 2), 'sell', 1, 2)])
+        amounts = self.sums(TRANSACTIONS_BY_DAY, CORPORATION, 'transactionType', 'amount')
+        self.assertEqual(round(amounts[1][2], 2), 22.0)
+        self.assertEqual(list(TRANSACTIONS_BY_DAY.check(self.engine)), [])
+
+    def test_counterparty(self):
+        JOURNAL_BY_DAY.refresh([self.journal.c.refID > 0], self.engine)
+        self.assertEqual(self.sums(JOURNAL_BY_DAY, CORPORATION, 'refTypeID', 'counterparty', 'entries'),
+                         [(date(2011, 5, 1), 10, u'First', 2), (date(2011, 5, 1), 37, u'Second', 1)])
+        self.assertEqual(list(JOURNAL_BY_DAY.check(self.engine)), [])
+
+    def test_check(self):
+        self.refresh_all()
+        self.engine.execute(self.transactions.insert(), [_transaction(6, CORPORATION, 2)])
+        self.engine.execute(self.journal.update().where(self.journal.c.refID == 1).values(amount=Decimal('1')))
+        mismatches = list(TRANSACTIONS_BY_DAY.check(self.engine)) + list(JOURNAL_BY_DAY.check(self.engine))
+        self.assertEqual([(wallet, group) for wallet, group, expected, found in mismatches],
+                         [(CORPORATION, (date(2011, 5, 2), None, 'sell')), (CORPORATION, (date(2011, 5, 1), 10, u'First'))])
+        self.assertEqual(mismatches[0][2:], ((2, 4, 41.0), (1, 2, 20.5)))
+        self.assertEqual(mismatches[1][2:], ((2, 0.9), (2, 100.0)))
+
+        # only the days of the rows in question are refreshed
+        TRANSACTIONS_BY_DAY.refresh([self.transactions.c['transaction'] == 6], self.engine)
+        JOURNAL_BY_DAY.refresh([self.journal.c.refID == 1], self.engine)
+        self.assertEqual(list(TRANSACTIONS_BY_DAY.check(self.engine)), [])
+        self.assertEqual(list(JOURNAL_BY_DAY.check(self.engine)), [])
+
+    def test_retagged(self):
+        self.refresh_all()
+        criteria = [self.transactions.c['transaction'].in_([1, 4])]
+        self.engine.execute(self.transactions.update().where(and_(*criteria)).values(tag=7))
+        self.assertEqual(len(list(TRANSACTIONS_BY_DAY.check(self.engine))), 4)
+        self.assertEqual(sorted(TRANSACTIONS_BY_DAY.refresh(criteria, self.engine)), [CORPORATION])
+        self.assertEqual(list(TRANSACTIONS_BY_DAY.check(self.engine)), [])
+        self.assertEqual(self.sums(TRANSACTIONS_BY_DAY, CORPORATION, 'tag', 'transactionType', 'transactions'),
+                         [(date(2011, 5, 1), None, 'buy', 1), (date(2011, 5, 1), None, 'sell', 1),
+                          (date(2011, 5, 1), 7, 'sell', 1), (date(2011, 5, 2), 7, 'sell', 1)])
+
+    def test_rebuild_since(self):
+        self.refresh_all()
+        before = self.sums(TRANSACTIONS_BY_DAY, CORPORATION, 'transactionType', 'transactions')
+        # the first day has been archived
+        self.engine.execute(self.transactions.delete().where(self.transactions.c.datetime < datetime(2011, 5, 2)))
+        self.assertEqual(sorted(TRANSACTIONS_BY_DAY.rebuild(self.engine, since=date(2011, 5, 2))),
+                         sorted([CORPORATION, CHARACTER]))
+        self.assertEqual(self.sums(TRANSACTIONS_BY_DAY, CORPORATION, 'transactionType', 'transactions'), before)
+        self.assertEqual(list(TRANSACTIONS_BY_DAY.check(self.engine, since=date(2011, 5, 2))), [])
+        self.assertEqual(len(list(TRANSACTIONS_BY_DAY.check(self.engine))), 3)
+
+        list(TRANSACTIONS_BY_DAY.rebuild(self.engine))
+        self.assertEqual(list(TRANSACTIONS_BY_DAY.check(self.engine)), [])
+        self.assertEqual(self.sums(TRANSACTIONS_BY_DAY, CHARACTER, 'transactions'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
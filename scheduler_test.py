@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline tests of evedir.jobs.scheduler, against fakeredis.
+#
+#   python scheduler_test.py
+
+from os import getpid
+from time import time
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from evedir.jobs.scheduler import SyncScheduler, WorkItem
+
+JOURNAL = WorkItem(1, 'WalletJournal', 90000000, '1000')
+TRANSACTIONS = WorkItem(1, 'WalletTransactions', 90000000, '1000')
+OTHER_ACCOUNT = WorkItem(1, 'WalletJournal', 90000000, '1001')
+OTHER_KEYPAIR = WorkItem(2, 'WalletJournal', 90000001, '1000')
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.scheduler = SyncScheduler(self.redis, min_interval=60, jitter=0)
+
+    def queued(self):
+        return sorted(WorkItem.parse(member) for member in self.redis.zrange(SyncScheduler.QUEUE, 0, -1))
+
+    def test_next(self):
+        now = time()
+        self.scheduler.schedule(TRANSACTIONS, now - 1)
+        self.scheduler.schedule(JOURNAL, now - 2)
+        self.scheduler.schedule(OTHER_KEYPAIR, now + 3600)
+        self.assertEqual(self.scheduler.next(0), JOURNAL)
+        self.assertEqual(self.scheduler.next(0), TRANSACTIONS)
+        self.assertEqual(self.scheduler.next(0), None)
+        self.assertEqual(self.queued(), [OTHER_KEYPAIR])
+
+    def test_next_claims(self):
+        self.scheduler.schedule(JOURNAL, time() - 1)
+        self.assertEqual(self.scheduler.next(0, 'worker-1'), JOURNAL)
+        self.assertEqual(self.redis.hget(SyncScheduler.CLAIMED, str(JOURNAL)), 'worker-1 %d' % getpid())
+        self.assertEqual(self.queued(), [])
+        # the worker dies right away
+        self.assertEqual(self.scheduler.recover(), [JOURNAL])
+        self.assertEqual(self.scheduler.next(0), JOURNAL)
+        self.assertEqual(self.redis.hgetall(SyncScheduler.CLAIMED), {})
+
+    def test_next_waits(self):
+        self.scheduler.schedule(JOURNAL, time() + 0.2)
+        self.assertEqual(self.scheduler.next(0.1), None)
+        self.assertEqual(self.scheduler.next(1), JOURNAL)
+
+    def test_schedule_new(self):
+        self.scheduler.schedule(JOURNAL, 100)
+        self.scheduler.schedule_new(JOURNAL, 50)
+        self.assertEqual(self.redis.zscore(SyncScheduler.QUEUE, str(JOURNAL)), 100)
+
+    def test_recover_dead(self):
+        self.scheduler.claim(JOURNAL, 'worker-1')
+        self.scheduler.claim(OTHER_KEYPAIR, 'worker-2')
+        self.scheduler.heartbeat('worker-2', 60)
+        # worker-1 has no heartbeat
+        self.assertEqual(self.scheduler.recover(), [JOURNAL])
+        self.assertEqual(self.queued(), [JOURNAL])
+        self.assertEqual(self.scheduler.next(0), JOURNAL)
+        self.assertEqual(self.redis.hkeys(SyncScheduler.CLAIMED), [str(OTHER_KEYPAIR)])
+        # recovered once only
+        self.assertEqual(self.scheduler.recover(), [])
+
+    def test_recover_restarted(self):
+        self.scheduler.claim(JOURNAL, 'worker-1')
+        self.scheduler.heartbeat('worker-1', 60)
+        self.assertEqual(self.scheduler.recover(), [])
+        # the worker's claims are its predecessor's, whose heartbeat has not expired yet
+        self.assertEqual(self.scheduler.recover('worker-1'), [JOURNAL])
+        self.assertEqual(self.queued(), [JOURNAL])
+
+    def test_released(self):
+        self.scheduler.claim(JOURNAL, 'worker-1')
+        self.scheduler.release(JOURNAL)
+        self.assertEqual(self.scheduler.recover('worker-1'), [])
+
+    def test_keypair_lock(self):
+        wallet = ('corp', 1000125, '1000', 'WalletJournal')
+        self.assertTrue(self.scheduler.lock(JOURNAL, wallet, 60))
+        # the same keypair's other endpoint and account
+        self.assertFalse(self.scheduler.lock(TRANSACTIONS, wallet[:3] + ('WalletTransactions', ), 60))
+        self.assertFalse(self.scheduler.lock(OTHER_ACCOUNT, wallet[:2] + ('1001', 'WalletJournal'), 60))
+        # nothing is left marked by the attempts
+        self.assertEqual(sorted(self.redis.keys('evedir:sync:wallet:*')), [SyncScheduler.WALLET_LOCK % wallet])
+        self.scheduler.unlock(JOURNAL)
+        self.assertTrue(self.scheduler.lock(TRANSACTIONS, wallet[:3] + ('WalletTransactions', ), 60))
+
+    def test_wallet_lock(self):
+        wallet = ('corp', 1000125, '1000', 'WalletJournal')
+        self.assertTrue(self.scheduler.lock(JOURNAL, wallet, 60))
+        # another keypair of the same corporation
+        self.assertFalse(self.scheduler.lock(OTHER_KEYPAIR, wallet, 60))
+        self.assertFalse(self.redis.exists(SyncScheduler.KEYPAIR_LOCK % OTHER_KEYPAIR.keyID))
+        self.scheduler.unlock(JOURNAL)
+        self.assertTrue(self.scheduler.lock(OTHER_KEYPAIR, wallet, 60))
+        self.scheduler.unlock(JOURNAL)
+        self.assertFalse(self.scheduler.lock(JOURNAL, wallet, 60))
+
+    def test_unlock_keeps_others_locks(self):
+        # this process' marks have expired, and another process has set them since
+        wallet = ('corp', 1000125, '1000', 'WalletJournal')
+        self.scheduler.lock(JOURNAL, wallet, 60)
+        for lock in (SyncScheduler.KEYPAIR_LOCK % JOURNAL.keyID, SyncScheduler.WALLET_LOCK % wallet):
+            self.redis.set(lock, '%d %s' % (getpid() + 1, JOURNAL))
+        self.scheduler.unlock(JOURNAL)
+        self.assertFalse(self.scheduler.lock(OTHER_KEYPAIR, wallet, 60))
+        self.assertFalse(self.scheduler.lock(TRANSACTIONS, wallet[:3] + ('WalletTransactions', ), 60))
+
+    def test_recover_unlocks(self):
+        wallet = ('corp', 1000125, '1000', 'WalletJournal')
+        self.scheduler.claim(JOURNAL, 'worker-1')
+        self.scheduler.lock(JOURNAL, wallet, 60)
+        self.assertEqual(self.scheduler.recover(), [JOURNAL])
+        self.assertTrue(self.scheduler.lock(OTHER_KEYPAIR, wallet, 60))
+        self.assertTrue(self.scheduler.lock(TRANSACTIONS, wallet[:3] + ('WalletTransactions', ), 60))
+
+    def test_recover_keeps_others_locks(self):
+        # the dead worker's mark has expired, and another process has marked the wallet since
+        wallet = ('corp', 1000125, '1000', 'WalletJournal')
+        self.scheduler.claim(JOURNAL, 'worker-1')
+        self.scheduler.lock(JOURNAL, wallet, 60)
+        self.redis.set(SyncScheduler.WALLET_LOCK % wallet, '%d %s' % (getpid() + 1, OTHER_KEYPAIR))
+        self.assertEqual(self.scheduler.recover(), [JOURNAL])
+        self.assertFalse(self.scheduler.lock(OTHER_KEYPAIR, wallet, 60))
+
+    def test_remove(self):
+        self.scheduler.schedule(JOURNAL, time())
+        self.scheduler.failed(JOURNAL)
+        self.scheduler.checkpoint(JOURNAL, 60).save(fromID=5)
+        self.scheduler.remove(JOURNAL)
+        self.assertEqual(self.queued(), [])
+        self.assertEqual(self.scheduler.failed(JOURNAL), 1)
+        self.assertEqual(self.scheduler.checkpoint(JOURNAL, 60).load(), {})
+
+    def test_items_of(self):
+        for item in (JOURNAL, TRANSACTIONS, OTHER_ACCOUNT, OTHER_KEYPAIR):
+            self.scheduler.schedule(item, time())
+        self.scheduler.schedule(JOURNAL, time() + 60)
+        self.assertEqual(sorted(self.scheduler.items_of(1)), sorted([JOURNAL, TRANSACTIONS, OTHER_ACCOUNT]))
+        # including those being worked on
+        self.assertEqual(self.scheduler.next(0, 'worker-1'), TRANSACTIONS)
+        self.assertEqual(len(self.scheduler.items_of(1)), 3)
+        self.scheduler.remove(TRANSACTIONS)
+        self.scheduler.remove(OTHER_KEYPAIR)
+        self.assertEqual(sorted(self.scheduler.items_of(1)), sorted([JOURNAL, OTHER_ACCOUNT]))
+        self.assertEqual(self.scheduler.items_of(2), [])
+        self.assertEqual(self.scheduler.items_of(3), [])
+
+    def test_checkpoint(self):
+        checkpoint = self.scheduler.checkpoint(JOURNAL, 60)
+        checkpoint.save(fromID=5, high_water_mark=None, newest=9)
+        self.assertEqual(checkpoint.load(), {'fromID': 5, 'newest': 9})
+        self.assertTrue(0 < self.redis.ttl(checkpoint.key) <= 60)
+        checkpoint.clear()
+        self.assertEqual(checkpoint.load(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -45,6 +45,7 @@ distutils.core.setup(
         'console_scripts': [
             'evedir-start = start:main',
             'evedir-initialization = initialize:main',
+            'evedir-maintenance = maintenance:main',
 #            'evedir-shell = shell:main',
         ],
     },
@@ -60,6 +61,10 @@ distutils.core.setup(
         "FormEncode >= 1.2.4",
         "python-dateutil >= 1.5",
         "pytz >= 2011e",
-        "redis >= 2.0.0",
+        "redis >= 2.7.4",
     ],
+    extras_require = {
+        # for evedir.analytics
+        'analytics': ["numpy >= 1.7"],
+    },
 )
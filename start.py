@@ -4,6 +4,8 @@
 # Copyright (c) 2011 W-Mark Kubacki; wmark@hurrikane.de
 #
 
+from multiprocessing import Event
+
 import anzu.httpserver
 import anzu.ioloop
 import anzu.locale
@@ -11,13 +13,18 @@ import anzu.options
 from anzu.options import options, enable_pretty_logging
 
 import evedir.option_definitions
-from evedir.controller import uac, dashboard
+from evedir.controller import uac, dashboard, metrics, activity
 from evedir.startaux import get_main_application, read_configuration_and_options
-from evedir.jobs import Process
+from evedir.jobs import Supervisor
 from evedir.jobs.wallet import wallet_synchronization
 
 __all__ = ['main', ]
 
+# seconds co-processes get to stop on their own before they are terminated
+SHUTDOWN_TIMEOUT = 30
+# milliseconds between checks whether co-processes have died
+SUPERVISION_INTERVAL = 1000
+
 def main():
     enable_pretty_logging()
     read_configuration_and_options()
@@ -28,10 +35,13 @@ def main():
     http_server.listen(options.port)
 
     # (threads and co-processes get started here)
-    processes = []
-    p = Process(target=wallet_synchronization, args=(application._db, ))
-    p.start()
-    processes.append(p)
+    application.activity.start()
+    supervisor = Supervisor()
+    stop = Event()
+    for i in range(options.sync_workers):
+        supervisor.spawn(wallet_synchronization, args=(application._db, stop),
+                         name='wallet_synchronization-%d' % i)
+    anzu.ioloop.PeriodicCallback(supervisor.check, SUPERVISION_INTERVAL).start()
 
     # ... and started
     try:
@@ -39,11 +49,8 @@ def main():
     except KeyboardInterrupt:
         pass
 
-    # end all threads or coprocesses
-    for process in processes:
-        if process.is_alive():
-            process.terminate()
-            process.join()
+    # end all threads or coprocesses, giving them the chance to finish what they are doing
+    supervisor.stop(stop, SHUTDOWN_TIMEOUT)
 
 if __name__ == "__main__":
     main()
@@ -43,8 +43,10 @@ function getJSON(url, postVars, onCompleteCallback) {
 
 /* Spinner spins spinning spins. */
 Ajax.Responders.register({
-	onCreate: function() {
-		$('global_spinner').show();
+	onCreate: function(request) {
+		if(!request.options.background) {
+			$('global_spinner').show();
+		}
 	},
 	onComplete: function() {
 		if(Ajax.activeRequestCount <= 0) {
@@ -58,6 +60,29 @@ document.observe('dom:loaded', function() {
 	if(spinner) { spinner.hide(); }
 });
 
+/* Long-polls for new rows of a wallet, and calls onChange once there are some. */
+var WalletActivity = {
+	retryDelay: 10,
+	watch: function(url, version, onChange) {
+		new Ajax.Request(url, {
+			method: 'get',
+			parameters: {'since': version},
+			background: true,
+			onSuccess: function(r) {
+				var json = r.responseText.evalJSON();
+				if(json['version'] > version) {
+					onChange(json);
+				} else {
+					WalletActivity.watch(url, version, onChange);
+				}
+			},
+			onFailure: function(r) {
+				WalletActivity.watch.delay(WalletActivity.retryDelay, url, version, onChange);
+			}
+		});
+	}
+}
+
 /* Your application-specific JS goes here. */
 var Something = {
 	someMethod: function() {